@@ -0,0 +1,134 @@
+# Холодная история: диск и память JSON-хранилища без переноса старых сообщений
+# в messages.cold и с переносом (zlib и lzma), плюс время листания назад.
+# Запуск: python benchmarks/bench_cold.py [--conversations 2000] [--messages 300000] [--days 730]
+import argparse
+import gc
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import ColdStore, Conversation, Database, Message
+
+WORDS = ('привет как дела что нового завтра встречаемся у метро в семь не забудь купить '
+         'хлеб молоко сегодня работа проект отчёт готов посмотри пожалуйста ссылку '
+         'спасибо ок хорошо да нет может быть позже созвонимся вечером фото видео '
+         'ok thanks see you tomorrow meeting lunch coffee deadline').split()
+PAGE = 50
+SAMPLES = 200
+
+
+def make_corpus(args, rnd):
+    # Размеры переписок по Ципфу, сообщения равномерно по последним args.days дням,
+    # в каждой переписке - по возрастанию времени
+    now = int(time.time())
+    weights = [1 / (rank + 1) for rank in range(args.conversations)]
+    sizes = [0] * args.conversations
+    for index in rnd.choices(range(args.conversations), weights, k=args.messages):
+        sizes[index] += 1
+    messages = {}
+    for index, size in enumerate(sizes):
+        if not size:
+            continue
+        user1, user2 = f'user{index:05d}', f'user{index + 1:05d}'
+        times = sorted(rnd.randint(now - args.days * 86400, now) for _ in range(size))
+        conversation = Conversation()
+        for seq, timestamp in enumerate(times, 1):
+            content = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 12)))
+            conversation.append(Message.create(rnd.choice((user1, user2)), content, seq, timestamp))
+        messages[f'{user1}_{user2}'] = conversation
+    return messages
+
+
+def disk_usage(paths):
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+
+def measure(corpus, cold_after, codec):
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        db = Database()
+        db.cold_after = cold_after
+        db.cold_codec = codec
+        start = time.perf_counter()
+        db.save_messages(corpus)
+        saved = time.perf_counter() - start
+        disk = disk_usage([db.messages_file, db.cold_file])
+        db.close()
+
+        db = Database()
+        gc.collect()
+        tracemalloc.start()
+        messages = db.load_messages()
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del messages
+
+        # Листание назад от конца самой длинной переписки до её начала
+        conv_key = max(db.messages, key=lambda key: len(db.messages[key]))
+        user1, user2 = conv_key.split('_')
+        timings = []
+        before = None
+        while before is None or before > 1:
+            start = time.perf_counter()
+            page = db.get_messages(user1, user2, before, PAGE)
+            timings.append((time.perf_counter() - start) * 1000)
+            before = page[0].seq
+        # Случайные страницы по всей истории: попадания и промахи кэша
+        rnd = random.Random(2)
+        random_timings = []
+        for _ in range(SAMPLES):
+            start = time.perf_counter()
+            db.get_messages(user1, user2, rnd.randint(2, len(db.messages[conv_key]) + 1), PAGE)
+            random_timings.append((time.perf_counter() - start) * 1000)
+        stats = (db.cold_store.hits, db.cold_store.misses)
+        db.close()
+        return {
+            'disk': disk,
+            'memory': memory,
+            'save_s': saved,
+            'scroll_ms': sorted(timings)[len(timings) // 2],
+            'random_p95_ms': sorted(random_timings)[int(len(random_timings) * 0.95)],
+            'cache': stats
+        }
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Холодная история Шилиграм')
+    parser.add_argument('--conversations', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=300000)
+    parser.add_argument('--days', type=int, default=730, help='глубина истории, дней')
+    parser.add_argument('--cold-after', type=int, default=90, help='порог переноса, дней')
+    args = parser.parse_args()
+
+    corpus = make_corpus(args, random.Random(1))
+    print(f'переписок: {len(corpus)}, сообщений: {args.messages}, история: {args.days} дн., '
+          f'порог: {args.cold_after} дн.')
+    print(f'{"режим":>12} {"диск, МБ":>10} {"память, МБ":>11} {"снимок":>9} '
+          f'{"страница":>10} {"случайная p95":>14} {"кэш попад./пром.":>17}')
+    variants = [('без переноса', None, 'zlib')]
+    variants += [(codec, args.cold_after * 86400, codec) for codec in ColdStore.CODECS]
+    baseline = None
+    for name, cold_after, codec in variants:
+        result = measure(corpus, cold_after, codec)
+        baseline = baseline or result
+        print(f'{name:>12} {result["disk"] / 2 ** 20:>10.1f} {result["memory"] / 2 ** 20:>11.1f} '
+              f'{result["save_s"]:>7.2f} с {result["scroll_ms"]:>7.3f} мс '
+              f'{result["random_p95_ms"]:>11.3f} мс {"%d/%d" % result["cache"]:>17}')
+        if result is not baseline:
+            print(f'{"":>12} экономия: диск {1 - result["disk"] / baseline["disk"]:.0%}, '
+                  f'память {1 - result["memory"] / baseline["memory"]:.0%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# Граф контактов: добавление по одному и пачкой, байты на диске на одно изменение,
+# обратный поиск и общие контакты.
+# Запуск: python benchmarks/bench_contacts.py [--users 20000] [--degree 200] [--ops 2000]
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import ContactSet, Database, User
+
+
+def disk_usage(paths):
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+
+def median_ms(samples):
+    return sorted(samples)[len(samples) // 2] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Граф контактов Шилиграм')
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--degree', type=int, default=200, help='контактов у пользователя')
+    parser.add_argument('--ops', type=int, default=2000)
+    args = parser.parse_args()
+
+    rnd = random.Random(1)
+    names = [f'user{i:06d}' for i in range(args.users)]
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        db = Database()
+        users = []
+        for name in names:
+            user = User(name, 'secret')
+            user.contacts = ContactSet(rnd.sample(names, args.degree))
+            users.append(user)
+        start = time.perf_counter()
+        db.import_users(users)
+        db.flush()
+        print(f'пользователей: {args.users}, связей: {db.contact_graph.edges}, '
+              f'импорт: {time.perf_counter() - start:.2f} с')
+
+        files = [db.users_file, db.contacts_file]
+        before = disk_usage(files)
+        timings = []
+        for _ in range(args.ops):
+            username, contact = rnd.sample(names, 2)
+            start = time.perf_counter()
+            db.add_contact(username, contact)
+            timings.append(time.perf_counter() - start)
+        db.flush()
+        written = disk_usage(files) - before
+        print(f'add_contact: медиана {median_ms(timings):.3f} мс, '
+              f'на диск {written / args.ops:.0f} байт на изменение')
+
+        start = time.perf_counter()
+        for _ in range(args.ops // 100):
+            username = rnd.choice(names)
+            db.add_contacts(username, rnd.sample(names, 100))
+        db.flush()
+        print(f'add_contacts по 100: {(time.perf_counter() - start) / (args.ops // 100) * 1000:.3f} мс '
+              f'на пачку')
+
+        reverse = []
+        mutual = []
+        for _ in range(args.ops):
+            user1, user2 = rnd.sample(names, 2)
+            start = time.perf_counter()
+            db.contacted_by(user1)
+            reverse.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            db.mutual_contacts(user1, user2)
+            mutual.append(time.perf_counter() - start)
+        print(f'contacted_by: медиана {median_ms(reverse):.3f} мс, '
+              f'mutual_contacts: медиана {median_ms(mutual):.3f} мс')
+        db.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+# Набор замеров ядра хранилища без Kivy и без дисплея.
+# Запуск: python benchmarks/bench_core.py [--backend json] [--scale 1000:200:50000 ...]
+#                                         [--output results.json]
+# Масштаб задаётся как пользователи:переписки:сообщения. Данные генерируются
+# и замеряются в отдельных процессах, чтобы пиковый RSS относился только к замеру.
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import open_database
+
+DEFAULT_SCALES = ['1000:200:10000', '10000:2000:100000', '50000:10000:1000000']
+SYLLABLES = ['ka', 'ri', 'mo', 'an', 'to', 'shi', 'li', 'gra', 've', 'ne',
+             'sa', 'pu', 'do', 'ry', 'el', 'ix', 'or', 'zu', 'be', 'qi']
+SAMPLES = 200
+
+
+def make_usernames(count, rnd):
+    names = set()
+    while len(names) < count:
+        name = ''.join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 4)))
+        names.add(name + str(rnd.randint(0, 999)))
+    return sorted(names)
+
+
+def plan(users, conversations, messages, seed=1):
+    # Размеры переписок распределены по закону Ципфа:
+    # немного очень длинных чатов и много коротких
+    rnd = random.Random(seed)
+    names = make_usernames(users, rnd)
+    pairs = set()
+    while len(pairs) < conversations:
+        a, b = rnd.sample(names, 2)
+        pairs.add((min(a, b), max(a, b)))
+    pairs = sorted(pairs)
+    weights = [1 / (rank + 1) for rank in range(len(pairs))]
+    counts = [0] * len(pairs)
+    for index in rnd.choices(range(len(pairs)), weights=weights, k=messages):
+        counts[index] += 1
+    return names, pairs, counts
+
+
+def generate(names, pairs, counts, seed=1):
+    # users.json и messages.json в формате приложения
+    rnd = random.Random(seed)
+    contacts = {name: [] for name in names}
+    for a, b in pairs:
+        contacts[a].append(b)
+        contacts[b].append(a)
+    with open('users.json', 'w', encoding='utf-8') as f:
+        json.dump({name: {'password': 'secret', 'contacts': contacts[name]} for name in names},
+                  f, ensure_ascii=False)
+
+    base = 1700000000
+    with open('messages.json', 'w', encoding='utf-8') as f:
+        f.write('{')
+        for i, ((a, b), count) in enumerate(zip(pairs, counts)):
+            history = [{
+                'sender': a if n % 2 else b,
+                'content': f'Сообщение {n} ' + 'текст ' * rnd.randint(0, 12),
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(base + n * 60)),
+                'seq': n + 1
+            } for n in range(count)]
+            if i:
+                f.write(',')
+            f.write(json.dumps(f'{a}_{b}', ensure_ascii=False) + ':')
+            json.dump(history, f, ensure_ascii=False)
+        f.write('}')
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return {
+        'p50_ms': samples[len(samples) // 2],
+        'p95_ms': samples[int(len(samples) * 0.95)],
+        'max_ms': samples[-1]
+    }
+
+
+def timed(func, args_list):
+    samples = []
+    for args in args_list:
+        start = time.perf_counter()
+        func(*args)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def prepare(backend, scale):
+    generate(*plan(*scale))
+    # Однократная миграция в SQLite или шарды не входит в замер загрузки
+    open_database(backend).close()
+
+
+def run_scale(backend, scale):
+    users, conversations, messages = scale
+    result = {'backend': backend, 'users': users, 'conversations': conversations,
+              'messages': messages}
+    names, pairs, counts = plan(*scale)
+    result['disk_bytes'] = sum(os.path.getsize(os.path.join(root, f))
+                               for root, _, files in os.walk('.') for f in files)
+
+    start = time.perf_counter()
+    db = open_database(backend)
+    result['load_s'] = time.perf_counter() - start
+
+    rnd = random.Random(2)
+    busiest = pairs[counts.index(max(counts))]
+    picks = [rnd.choice(pairs) for _ in range(SAMPLES)]
+
+    result['get_messages_page'] = percentiles(timed(
+        lambda a, b: db.get_messages(a, b, limit=50), picks))
+    result['get_messages_full_busiest'] = percentiles(timed(
+        lambda a, b: len(db.get_messages(a, b)), [busiest] * 20))
+
+    # Набор ника по буквам, как в MainScreen.on_search_text
+    keystrokes = []
+    for name in rnd.sample(names, 10):
+        keystrokes.extend((name[:i], names[0]) for i in range(1, len(name) + 1))
+    result['search_users_keystroke'] = percentiles(timed(db.search_users, keystrokes))
+
+    sends = [(a, b, f'замер {i}') for i, (a, b) in enumerate(picks * 5)]
+    start = time.perf_counter()
+    samples = timed(db.send_message, sends)
+    elapsed = time.perf_counter() - start
+    result['send_message'] = percentiles(samples)
+    result['send_message']['per_second'] = len(sends) / elapsed
+
+    start = time.perf_counter()
+    db.flush()
+    result['flush_s'] = time.perf_counter() - start
+    db.close()
+
+    # ru_maxrss в килобайтах на Linux и в байтах на macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result['peak_rss_mb'] = peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return result
+
+
+def run_child(backend, mode, scale, directory):
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--backend', backend,
+         '--' + mode, scale],
+        cwd=directory, check=True, capture_output=True, text=True).stdout
+    return json.loads(output) if output.strip() else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Замеры ядра хранилища Шилиграм')
+    parser.add_argument('--backend', default='json', choices=['json', 'archive', 'sqlite', 'sharded'])
+    parser.add_argument('--scale', action='append', help='пользователи:переписки:сообщения')
+    parser.add_argument('--output', help='файл для результатов в JSON')
+    parser.add_argument('--prepare', help=argparse.SUPPRESS)
+    parser.add_argument('--measure', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.prepare:
+        prepare(args.backend, [int(x) for x in args.prepare.split(':')])
+        return
+    if args.measure:
+        print(json.dumps(run_scale(args.backend, [int(x) for x in args.measure.split(':')])))
+        return
+
+    results = []
+    for scale in args.scale or DEFAULT_SCALES:
+        with tempfile.TemporaryDirectory() as tmp:
+            start = time.perf_counter()
+            run_child(args.backend, 'prepare', scale, tmp)
+            prepared = time.perf_counter() - start
+            result = run_child(args.backend, 'measure', scale, tmp)
+        result['prepare_s'] = prepared
+        results.append(result)
+        print(f"{scale:>22}  загрузка {result['load_s']:.2f} с  "
+              f"send p50 {result['send_message']['p50_ms']:.3f} мс  "
+              f"страница p50 {result['get_messages_page']['p50_ms']:.3f} мс  "
+              f"поиск p95 {result['search_users_keystroke']['p95_ms']:.3f} мс  "
+              f"RSS {result['peak_rss_mb']:.0f} МБ", file=sys.stderr)
+
+    report = {
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
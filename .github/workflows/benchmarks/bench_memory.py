@@ -0,0 +1,82 @@
+# Память на одно сообщение: словари с ISO-датами против столбцов Conversation.
+# Запуск: python benchmarks/bench_memory.py [число сообщений]
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import Conversation, Message
+
+CONVERSATIONS = 1000
+SENDERS = 2000
+
+
+def sample(i):
+    return f'user{i % SENDERS}', f'Привет! Сообщение номер {i}', 1700000000 + i
+
+
+def build_dicts(total):
+    # Прежний формат Database.messages
+    messages = {}
+    for i in range(total):
+        sender, content, timestamp = sample(i)
+        msgs = messages.setdefault(f'conv{i % CONVERSATIONS}', [])
+        msgs.append({
+            'sender': sender,
+            'content': content,
+            'timestamp': datetime.fromtimestamp(timestamp).isoformat(),
+            'seq': len(msgs) + 1
+        })
+    return messages
+
+
+def build_slots(total):
+    messages = {}
+    for i in range(total):
+        sender, content, timestamp = sample(i)
+        msgs = messages.setdefault(f'conv{i % CONVERSATIONS}', [])
+        msgs.append(Message.create(sender, content, len(msgs) + 1, timestamp))
+    return messages
+
+
+def build_columns(total):
+    messages = {}
+    for i in range(total):
+        sender, content, timestamp = sample(i)
+        conversation = messages.setdefault(f'conv{i % CONVERSATIONS}', Conversation())
+        conversation.append(Message.create(sender, content, len(conversation) + 1, timestamp))
+    return messages
+
+
+def measure(build, total):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    data = build(total)
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del data
+    return size / total, elapsed
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    # Таблица ников заполняется заранее, чтобы не учитывать её в замерах
+    for i in range(SENDERS):
+        Message.intern_sender(sample(i)[0])
+    print(f'сообщений: {total}')
+    print(f'{"формат":>22} {"байт/сообщение":>16} {"построение":>12}')
+    for name, build in (('словари + ISO-строки', build_dicts),
+                        ('Message со __slots__', build_slots),
+                        ('столбцы Conversation', build_columns)):
+        per_message, elapsed = measure(build, total)
+        print(f'{name:>22} {per_message:>16.1f} {elapsed:>10.2f} с')
+
+
+if __name__ == '__main__':
+    main()
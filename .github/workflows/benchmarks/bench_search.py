@@ -0,0 +1,66 @@
+# Задержка поиска пользователей на каждое нажатие клавиши.
+# Запуск: python benchmarks/bench_search.py [число пользователей]
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import UsernameIndex
+
+SYLLABLES = ['ka', 'ri', 'mo', 'an', 'to', 'shi', 'li', 'gra', 've', 'ne',
+             'sa', 'pu', 'do', 'ry', 'el', 'ix', 'or', 'zu', 'be', 'qi']
+QUERIES = ['shiligram', 'Kamoto', 'xyz', 'elor', 'an']
+
+
+def make_usernames(count, seed=42):
+    rnd = random.Random(seed)
+    names = set()
+    while len(names) < count:
+        name = ''.join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 5)))
+        if rnd.random() < 0.3:
+            name = name.capitalize()
+        if rnd.random() < 0.4:
+            name += str(rnd.randint(0, 9999))
+        names.add(name)
+    return list(names)
+
+
+def linear_search(usernames, query, current_user):
+    # Прежняя реализация Database.search_users
+    return [u for u in usernames if query.lower() in u.lower() and u != current_user]
+
+
+def keystrokes(search):
+    samples = []
+    for query in QUERIES:
+        for i in range(1, len(query) + 1):
+            start = time.perf_counter()
+            search(query[:i])
+            samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return samples[len(samples) // 2], samples[int(len(samples) * 0.95)], samples[-1]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    usernames = make_usernames(count)
+
+    start = time.perf_counter()
+    index = UsernameIndex(usernames)
+    print(f'пользователей: {count}, построение индекса: {time.perf_counter() - start:.2f} с')
+
+    start = time.perf_counter()
+    index.add('shiligram_новый')
+    print(f'добавление ника: {(time.perf_counter() - start) * 1000:.3f} мс')
+
+    indexed = keystrokes(lambda q: index.search(q, exclude=usernames[0]))
+    linear = keystrokes(lambda q: linear_search(usernames, q, usernames[0]))
+    print(f'{"":>10} {"p50":>10} {"p95":>10} {"max":>10}')
+    for name, (p50, p95, worst) in (('индекс', indexed), ('перебор', linear)):
+        print(f'{name:>10} {p50:>7.3f} мс {p95:>7.3f} мс {worst:>7.3f} мс')
+
+
+if __name__ == '__main__':
+    main()
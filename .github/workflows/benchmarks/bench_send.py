@@ -0,0 +1,66 @@
+# Задержка send_message в зависимости от размера истории.
+# Запуск: python benchmarks/bench_send.py [размер ...]
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import Conversation, Database, Message, User
+
+SENDS = 200
+
+
+def fill_history(db, total):
+    for i in range(total):
+        conv_key = db.get_conversation_key('alice', f'user{i % 100}')
+        conversation = db.messages.setdefault(conv_key, Conversation())
+        conversation.append(Message.create('alice', f'сообщение номер {i}', len(conversation) + 1))
+
+
+def measure(db, send):
+    samples = []
+    for i in range(SENDS):
+        start = time.perf_counter()
+        send(i)
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return samples[len(samples) // 2], samples[int(len(samples) * 0.95)]
+
+
+def run(total):
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        db = Database()
+        db.compact_threshold = 10 ** 9
+        db.users['alice'] = User('alice', 'secret')
+        db.users['bob'] = User('bob', 'secret')
+        fill_history(db, total)
+        db.save_messages()
+
+        journal = measure(db, lambda i: db.send_message('alice', 'bob', f'новое {i}'))
+
+        # Старое поведение: полная перезапись messages.json после каждой отправки
+        def legacy_send(i):
+            conversation = db.messages.setdefault('alice_bob', Conversation())
+            conversation.append(Message.create('alice', f'новое {i}', len(conversation) + 1))
+            db.save_messages()
+
+        rewrite = measure(db, legacy_send) if total <= 100000 else None
+        db.close()
+        os.chdir('/')
+    return journal, rewrite
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [0, 10000, 100000, 300000]
+    print(f'{"история":>10} {"журнал p50":>12} {"журнал p95":>12} {"перезапись p50":>16}')
+    for total in sizes:
+        (p50, p95), rewrite = run(total)
+        legacy = f'{rewrite[0]:.3f} мс' if rewrite else '-'
+        print(f'{total:>10} {p50:>9.3f} мс {p95:>9.3f} мс {legacy:>16}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+# Нагрузка на сервер (server.py): тысячи одновременных соединений на localhost.
+# Запуск: python benchmarks/bench_server.py [--clients 2000] [--messages 20] [--backend json]
+# Каждый клиент входит под своим ником и пишет соседу; замеряется время ответа
+# на send_message и задержка доставки события получателю.
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server.py')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    return {
+        'count': len(samples),
+        'p50_ms': samples[len(samples) // 2],
+        'p95_ms': samples[int(len(samples) * 0.95)],
+        'p99_ms': samples[int(len(samples) * 0.99)],
+        'max_ms': samples[-1]
+    }
+
+
+class LoadClient:
+    def __init__(self, name, sent, deliveries):
+        self.name = name
+        self.sent = sent
+        self.deliveries = deliveries
+        self.ids = 0
+        self.pending = {}
+
+    async def connect(self, port):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', port, limit=1 << 20)
+        self.reading = asyncio.ensure_future(self.read_loop())
+
+    async def read_loop(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                break
+            data = json.loads(line)
+            if 'event' in data:
+                details = data['details']
+                key = (details['sender'], details['seq'])
+                if data['event'] == 'message' and details['receiver'] == self.name \
+                        and key in self.sent:
+                    self.deliveries.append((time.perf_counter() - self.sent[key]) * 1000)
+                continue
+            future = self.pending.pop(data['id'], None)
+            if future is not None:
+                future.set_result(data.get('result'))
+
+    async def call(self, op, *args):
+        self.ids += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[self.ids] = future
+        self.writer.write(json.dumps({'id': self.ids, 'op': op, 'args': args}).encode() + b'\n')
+        return await future
+
+    async def close(self):
+        self.writer.close()
+        self.reading.cancel()
+
+
+async def run_client(index, clients, args, sent, sends):
+    client = clients[index]
+    peer = clients[index ^ 1].name
+    for seq in range(1, args.messages + 1):
+        await asyncio.sleep(random.uniform(0, 2 * args.interval))
+        if index % 2:
+            continue
+        start = time.perf_counter()
+        # Номер известен заранее: в паре пишет только чётный клиент
+        sent[(client.name, seq)] = start
+        await client.call('send_message', client.name, peer, f'нагрузка {seq}')
+        sends.append((time.perf_counter() - start) * 1000)
+
+
+async def load(port, args):
+    sent = {}
+    sends = []
+    deliveries = []
+    clients = [LoadClient(f'load{i:05d}', sent, deliveries) for i in range(args.clients)]
+
+    start = time.perf_counter()
+    for chunk in range(0, len(clients), 200):
+        await asyncio.gather(*(client.connect(port) for client in clients[chunk:chunk + 200]))
+    connected = time.perf_counter() - start
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client.call('register_user', client.name, 'secret123')
+                           for client in clients))
+    registered = time.perf_counter() - start
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_client(i, clients, args, sent, sends)
+                           for i in range(len(clients))))
+    elapsed = time.perf_counter() - start
+    # Даём последним событиям дойти до получателей
+    await asyncio.sleep(0.5)
+    for client in clients:
+        await client.close()
+
+    return {
+        'clients': args.clients,
+        'connect_s': connected,
+        'register_s': registered,
+        'messages': len(sends),
+        'messages_per_second': len(sends) / elapsed,
+        'send_message': percentiles(sends),
+        'delivery': percentiles(deliveries),
+        'delivered_ratio': len(deliveries) / max(len(sends), 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузка на сервер Шилиграм')
+    parser.add_argument('--clients', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=20, help='сообщений на клиента')
+    parser.add_argument('--interval', type=float, default=0.05, help='средняя пауза, с')
+    parser.add_argument('--backend', default='json', choices=['json', 'archive', 'sqlite', 'sharded'])
+    args = parser.parse_args()
+    args.clients += args.clients % 2
+
+    port = free_port()
+    with tempfile.TemporaryDirectory() as tmp:
+        server = subprocess.Popen([sys.executable, SERVER, '--port', str(port),
+                                   '--backend', args.backend], cwd=tmp,
+                                  stderr=subprocess.DEVNULL)
+        try:
+            for _ in range(100):
+                try:
+                    socket.create_connection(('127.0.0.1', port)).close()
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            result = asyncio.run(load(port, args))
+        finally:
+            server.terminate()
+            server.wait()
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -9,3 +9,5 @@ requirements = python3,kivy
 orientation = portrait
 android.api = 21
 android.minapi = 21
+source.exclude_dirs = benchmarks,tests
+source.exclude_patterns = server.py,bulk.py
@@ -0,0 +1,191 @@
+# Потоковый экспорт и импорт пользователей и истории Шилиграм.
+# Запуск: python bulk.py export [--backend json] [--per-conversation] путь
+#         python bulk.py import [--backend json] [--batch-size 10000] путь
+# Формат - JSON по строке на запись:
+#   {"type": "user", "username": ..., "password": ..., "contacts": [...]}
+#   {"type": "group", "group": ..., "title": ..., "owner": ..., "members": [...]}
+#   {"type": "cursor", "user": ..., "peer": ..., "seq": ...}
+#   {"type": "message", "conv": ..., "sender": ..., "content": ..., "timestamp": ..., "seq": ...}
+# С --per-conversation путь - каталог: users.jsonl и по файлу на переписку.
+# Записи читаются и пишутся по одной, память не зависит от объёма истории.
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+from storage import ShardedDatabase, User, open_database
+
+logger = logging.getLogger('shiligram.bulk')
+
+USERS_FILE = 'users.jsonl'
+
+class Progress:
+    # Строка прогресса не чаще раза в interval секунд
+    def __init__(self, what, interval=1.0):
+        self.what = what
+        self.interval = interval
+        self.start = self.last = time.perf_counter()
+        self.count = 0
+    
+    def update(self, count):
+        self.count = count
+        now = time.perf_counter()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.report()
+    
+    def report(self):
+        elapsed = time.perf_counter() - self.start
+        rate = self.count / elapsed if elapsed else 0
+        print(f"{self.what}: {self.count} за {elapsed:.1f} с ({rate:.0f} в секунду)",
+              file=sys.stderr)
+
+def user_record(user):
+    return {'type': 'user', 'username': user.username, 'password': user.password,
+            'contacts': list(user.contacts)}
+
+def group_record(group):
+    return {'type': 'group', 'group': group['group'], 'title': group['title'],
+            'owner': group['owner'], 'members': group['members']}
+
+def cursor_record(username, peer, seq):
+    return {'type': 'cursor', 'user': username, 'peer': peer, 'seq': seq}
+
+def message_record(conv_key, message):
+    record = {'type': 'message', 'conv': conv_key}
+    record.update(message.to_dict())
+    return record
+
+def write_line(f, record):
+    f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+def conversation_file(directory, conv_key):
+    # Файл переписки называется так же, как её шард
+    return os.path.join(directory, ShardedDatabase.shard_name(conv_key))
+
+def export_data(db, path, per_conversation=False):
+    db.messages_ready.wait()
+    progress = Progress("Экспортировано сообщений")
+    if per_conversation:
+        os.makedirs(path, exist_ok=True)
+        users_path = os.path.join(path, USERS_FILE)
+    else:
+        users_path = path
+    f = open(users_path, 'w', encoding='utf-8')
+    try:
+        # Группы и курсоры - до сообщений: при импорте они нужны раньше истории
+        for user in list(db.users.values()):
+            write_line(f, user_record(user))
+        for group in db.export_groups():
+            write_line(f, group_record(group))
+        for username, peer, seq in db.export_read_cursors():
+            write_line(f, cursor_record(username, peer, seq))
+        current = None
+        for conv_key, message in db.export_messages():
+            if per_conversation and conv_key != current:
+                # Сообщения приходят переписка за переписку
+                f.close()
+                f = open(conversation_file(path, conv_key), 'w', encoding='utf-8')
+                current = conv_key
+            write_line(f, message_record(conv_key, message))
+            progress.update(progress.count + 1)
+    finally:
+        f.close()
+    progress.report()
+    return progress.count
+
+def read_records(path):
+    # Каталог читается так же, как один файл: сначала пользователи, потом переписки
+    if os.path.isdir(path):
+        names = sorted(name for name in os.listdir(path)
+                       if name.endswith('.jsonl') and name != USERS_FILE)
+        paths = [os.path.join(path, name) for name in [USERS_FILE] + names
+                 if os.path.exists(os.path.join(path, name))]
+    else:
+        paths = [path]
+    for file_path in paths:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logger.warning("Пропущена повреждённая строка %s:%d", file_path, number)
+
+def import_contacts(db, contacts, batch_size):
+    # Контакты - после всех пользователей: ссылка на ник из следующей пачки
+    # иначе отбросилась бы как ссылка на неизвестного
+    for start in range(0, len(contacts), batch_size):
+        users = []
+        for username, names in contacts[start:start + batch_size]:
+            user = User(username, None)
+            user.contacts = names
+            users.append(user)
+        db.import_users(users)
+    contacts.clear()
+
+def message_records(db, records, batch_size):
+    # Пользователи сохраняются пачками по ходу чтения, группы и курсоры - по одной,
+    # сообщения уходят в import_messages
+    users = []
+    contacts = []
+    for record in records:
+        kind = record.get('type')
+        if kind == 'user':
+            users.append(User(record['username'], record['password']))
+            if record.get('contacts'):
+                contacts.append((record['username'], record['contacts']))
+            if len(users) >= batch_size:
+                db.import_users(users)
+                users = []
+            continue
+        if users:
+            db.import_users(users)
+            users = []
+        if contacts:
+            import_contacts(db, contacts, batch_size)
+        if kind == 'group':
+            db.import_groups([record])
+        elif kind == 'cursor':
+            db.import_read_cursors([(record['user'], record['peer'], record['seq'])])
+        else:
+            yield record['conv'], record
+    if users:
+        db.import_users(users)
+    if contacts:
+        import_contacts(db, contacts, batch_size)
+
+def import_data(db, path, batch_size=10000):
+    progress = Progress("Импортировано сообщений")
+    count = db.import_messages(message_records(db, read_records(path), batch_size),
+                               batch_size, progress.update)
+    db.flush()
+    progress.report()
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description='Экспорт и импорт данных Шилиграм')
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('path', help='файл JSONL или каталог (--per-conversation)')
+    parser.add_argument('--backend', default='json', choices=['json', 'archive', 'sqlite', 'sharded'])
+    parser.add_argument('--durability', default='batch', choices=['write', 'batch', 'timer'])
+    parser.add_argument('--per-conversation', action='store_true',
+                        help='экспорт в каталог, по файлу на переписку')
+    parser.add_argument('--batch-size', type=int, default=10000)
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(message)s')
+    db = open_database(args.backend, args.durability)
+    try:
+        if args.command == 'export':
+            export_data(db, args.path, args.per_conversation)
+        else:
+            import_data(db, args.path, args.batch_size)
+    finally:
+        db.close()
+
+if __name__ == '__main__':
+    main()
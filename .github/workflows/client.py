@@ -0,0 +1,299 @@
+# Клиент сервера Шилиграм (см. server.py) с тем же интерфейсом, что и Database:
+# экраны работают с ним так же, как с локальной базой
+import itertools
+import json
+import logging
+import queue
+import socket
+import threading
+
+from storage import GROUP_PREFIX, ContactSet, ConversationSummary, User
+
+logger = logging.getLogger('shiligram.client')
+
+class RemoteDatabase:
+    TIMEOUT = 10
+    RECONNECT_DELAY = 1.0
+    
+    def __init__(self, host='127.0.0.1', port=8765):
+        self.host = host
+        self.port = port
+        # Известные клиенту пользователи: только вошедший и его контакты
+        self.users = {}
+        self.contact_versions = {}
+        self.summary_versions = {}
+        self.version = 0
+        self.writer = None
+        # Файлы вложений с сервера не передаются: видны только ссылки на них
+        self.attachments = None
+        self._listeners = []
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._send_lock = threading.Lock()
+        self._sock = None
+        self._login = None
+        self._closed = False
+        
+        # Экраны ждут готовности так же, как при фоновой загрузке базы
+        self.users_ready = threading.Event()
+        self.messages_ready = threading.Event()
+        self.search_ready = threading.Event()
+        self.connector = threading.Thread(target=self.run, name='shiligram-client', daemon=True)
+        self.connector.start()
+        # Вызовы из интерфейса ждут ответа здесь, а не в главном потоке
+        self._calls = queue.Queue()
+        self.caller = threading.Thread(target=self.run_calls, name='shiligram-client-calls',
+                                       daemon=True)
+        self.caller.start()
+    
+    def run(self):
+        while not self._closed:
+            try:
+                sock = socket.create_connection((self.host, self.port), timeout=self.TIMEOUT)
+            except OSError:
+                self._wait_reconnect()
+                continue
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._sock = sock
+            if self._login is not None:
+                # После переподключения сервер должен снова знать, кому слать события
+                threading.Thread(target=self.call, args=('login_user',) + self._login,
+                                 daemon=True).start()
+            self.users_ready.set()
+            self.messages_ready.set()
+            self.search_ready.set()
+            self.read_loop(sock)
+            self.users_ready.clear()
+            self.messages_ready.clear()
+            self.search_ready.clear()
+            self._sock = None
+            self.fail_pending()
+            if not self._closed:
+                logger.info("Соединение с сервером потеряно, переподключение")
+                self._wait_reconnect()
+    
+    def submit(self, func, callback=None):
+        # Выполняется по порядку в потоке вызовов, callback получает результат там же
+        self._calls.put((func, callback))
+    
+    def run_calls(self):
+        while True:
+            item = self._calls.get()
+            if item is None:
+                break
+            func, callback = item
+            try:
+                result = func()
+                if callback is not None:
+                    callback(result)
+            except Exception:
+                logger.exception("Ошибка вызова сервера")
+    
+    def _wait_reconnect(self):
+        threading.Event().wait(self.RECONNECT_DELAY)
+    
+    def read_loop(self, sock):
+        try:
+            for line in sock.makefile('rb'):
+                data = json.loads(line)
+                if 'event' in data:
+                    self.on_event(data['event'], data['details'])
+                    continue
+                waiter = self._pending.pop(data.get('id'), None)
+                if waiter is not None:
+                    waiter[1] = data
+                    waiter[0].set()
+        except (OSError, ValueError):
+            pass
+    
+    def fail_pending(self):
+        pending, self._pending = self._pending, {}
+        for waiter in pending.values():
+            waiter[0].set()
+    
+    def call(self, op, *args):
+        sock = self._sock
+        if sock is None:
+            return None
+        request_id = next(self._ids)
+        waiter = [threading.Event(), None]
+        self._pending[request_id] = waiter
+        line = json.dumps({'id': request_id, 'op': op, 'args': args}, ensure_ascii=False)
+        try:
+            with self._send_lock:
+                sock.sendall(line.encode('utf-8') + b'\n')
+        except OSError:
+            self._pending.pop(request_id, None)
+            return None
+        if not waiter[0].wait(self.TIMEOUT):
+            self._pending.pop(request_id, None)
+            return None
+        response = waiter[1]
+        if response is None or 'error' in response:
+            return None
+        return response['result']
+    
+    def on_event(self, kind, details):
+        # Вызывается в потоке чтения: здесь нельзя ждать ответов сервера
+        if kind == 'contact':
+            user = self.users.get(details['username'])
+            if user is not None and details.get('removed'):
+                user.contacts.discard(details['contact'])
+            elif user is not None:
+                user.contacts.add(details['contact'])
+            self.contact_versions[details['username']] = \
+                self.contact_versions.get(details['username'], 0) + 1
+        elif kind == 'message':
+            # События групп сервер шлёт только участникам, то есть вошедшему
+            usernames = (details['sender'], details['receiver'])
+            if 'group' in details and self._login is not None:
+                usernames = (self._login[0],)
+            for username in usernames:
+                self.summary_versions[username] = self.summary_versions.get(username, 0) + 1
+        elif kind == 'group':
+            for username in details['members']:
+                self.summary_versions[username] = self.summary_versions.get(username, 0) + 1
+        elif kind == 'read':
+            self.summary_versions[details['username']] = \
+                self.summary_versions.get(details['username'], 0) + 1
+        self.notify(kind, **details)
+    
+    def refresh_user(self, username):
+        data = self.call('get_user', username)
+        if data is None:
+            return
+        user = User(username, None)
+        user.contacts = ContactSet(data['contacts'])
+        self.users[username] = user
+        self.contact_versions[username] = data['contacts_version']
+    
+    def register_user(self, username, password):
+        result = self.call('register_user', username, password)
+        if result is None:
+            return False, "Нет связи с сервером"
+        if result[0]:
+            self._login = (username, password)
+            self.refresh_user(username)
+        return tuple(result)
+    
+    def login_user(self, username, password):
+        result = self.call('login_user', username, password)
+        if result is None:
+            return False, "Нет связи с сервером"
+        if result[0]:
+            self._login = (username, password)
+            self.refresh_user(username)
+        return tuple(result)
+    
+    def search_users(self, query, current_user, limit=50):
+        return self.call('search_users', query, current_user, limit) or []
+    
+    def add_contact(self, username, contact_username):
+        result = self.call('add_contact', username, contact_username)
+        if result is None:
+            return False, "Нет связи с сервером"
+        return tuple(result)
+    
+    def add_contacts(self, username, contact_usernames):
+        result = self.call('add_contacts', username, list(contact_usernames))
+        if result is None:
+            return False, "Нет связи с сервером"
+        return tuple(result)
+    
+    def remove_contact(self, username, contact_username):
+        result = self.call('remove_contact', username, contact_username)
+        if result is None:
+            return False, "Нет связи с сервером"
+        return tuple(result)
+    
+    def remove_contacts(self, username, contact_usernames):
+        result = self.call('remove_contacts', username, list(contact_usernames))
+        if result is None:
+            return False, "Нет связи с сервером"
+        return tuple(result)
+    
+    def contacted_by(self, username):
+        return self.call('contacted_by', username) or []
+    
+    def mutual_contacts(self, user1, user2):
+        return self.call('mutual_contacts', user1, user2) or []
+    
+    def get_conversation_key(self, user1, user2):
+        # Ники не могут начинаться с префикса групп, так что проверки префикса хватает
+        if user2.startswith(GROUP_PREFIX):
+            return user2
+        return f"{min(user1, user2)}_{max(user1, user2)}"
+    
+    def send_message(self, sender, receiver, content, attachment=None):
+        if attachment is not None:
+            return False, "Вложения через сервер пока не поддерживаются"
+        result = self.call('send_message', sender, receiver, content)
+        if result is None:
+            return False, "Нет связи с сервером"
+        return tuple(result)
+    
+    def get_messages(self, user1, user2, before=None, limit=None):
+        return self.call('get_messages', user1, user2, before, limit) or []
+    
+    def get_messages_since(self, user1, user2, seq):
+        return self.call('get_messages_since', user1, user2, seq) or []
+    
+    def search_messages(self, username, query, limit=20):
+        return [tuple(hit) for hit in self.call('search_messages', username, query, limit) or []]
+    
+    def get_chat_list(self, username):
+        return [(contact, ConversationSummary.from_dict(summary) if summary else None)
+                for contact, summary in self.call('get_chat_list', username) or []]
+    
+    def mark_read(self, username, peer):
+        return bool(self.call('mark_read', username, peer))
+    
+    def create_group(self, owner, title, members):
+        result = self.call('create_group', owner, title, list(members))
+        if result is None:
+            return False, "Нет связи с сервером"
+        return tuple(result)
+    
+    def add_group_members(self, group_key, username, members):
+        result = self.call('add_group_members', group_key, username, list(members))
+        if result is None:
+            return False, "Нет связи с сервером"
+        return tuple(result)
+    
+    def leave_group(self, group_key, username):
+        result = self.call('leave_group', group_key, username)
+        if result is None:
+            return False, "Нет связи с сервером"
+        return tuple(result)
+    
+    def subscribe(self, callback):
+        self._listeners.append(callback)
+    
+    def unsubscribe(self, callback):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+    
+    def notify(self, kind, **details):
+        self.version += 1
+        for callback in list(self._listeners):
+            callback(kind, details)
+    
+    def refresh(self):
+        # Изменения приходят событиями от сервера
+        pass
+    
+    def flush(self):
+        # Данные сохраняет сервер
+        pass
+    
+    def close(self):
+        self._closed = True
+        self._calls.put(None)
+        sock = self._sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
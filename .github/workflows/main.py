@@ -1,3 +1,8 @@
+import time
+
+# Отметки времени запуска для отчёта о времени до первого кадра
+STARTUP_TIMES = {'start': time.perf_counter()}
+
 import kivy
 from kivy.app import App
 from kivy.uix.screenmanager import ScreenManager, Screen
@@ -5,137 +10,32 @@ from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.label import Label
 from kivy.uix.textinput import TextInput
 from kivy.uix.button import Button
-from kivy.uix.scrollview import ScrollView
-from kivy.uix.popup import Popup
-from kivy.properties import StringProperty, BooleanProperty
+from kivy.properties import StringProperty, BooleanProperty, ObjectProperty
 from kivy.clock import Clock
-from kivy.core.window import Window
+from kivy.logger import Logger
+from kivy.utils import platform, escape_markup
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import io
 import json
 import os
-from datetime import datetime
-
-# Устанавливаем размер окна для мобильных устройств
-Window.size = (360, 640)
+import threading
 
-class User:
-    def __init__(self, username, password):
-        self.username = username
-        self.password = password
-        self.contacts = []
-        self.messages = {}
+from storage import AttachmentStore, open_database
+from profiling import profiler
+from search import SearchPipeline
 
-class Message:
-    def __init__(self, sender, receiver, content, timestamp=None):
-        self.sender = sender
-        self.receiver = receiver
-        self.content = content
-        self.timestamp = timestamp or datetime.now()
+STARTUP_TIMES['imports'] = time.perf_counter()
 
-class Database:
-    def __init__(self):
-        self.users_file = "users.json"
-        self.messages_file = "messages.json"
-        self.users = self.load_users()
-        self.messages = self.load_messages()
-        
-    def load_users(self):
-        if os.path.exists(self.users_file):
-            try:
-                with open(self.users_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    users = {}
-                    for username, user_data in data.items():
-                        user = User(username, user_data['password'])
-                        user.contacts = user_data.get('contacts', [])
-                        users[username] = user
-                    return users
-            except:
-                return {}
-        return {}
-    
-    def load_messages(self):
-        if os.path.exists(self.messages_file):
-            try:
-                with open(self.messages_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except:
-                return {}
-        return {}
-    
-    def save_users(self):
-        data = {}
-        for username, user in self.users.items():
-            data[username] = {
-                'password': user.password,
-                'contacts': user.contacts
-            }
-        with open(self.users_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    
-    def save_messages(self):
-        with open(self.messages_file, 'w', encoding='utf-8') as f:
-            json.dump(self.messages, f, ensure_ascii=False, indent=2)
-    
-    def register_user(self, username, password):
-        if username in self.users:
-            return False, "Пользователь с таким ником уже существует"
-        
-        if len(username) < 3:
-            return False, "Ник должен быть не менее 3 символов"
-        
-        if len(password) < 4:
-            return False, "Пароль должен быть не менее 4 символов"
-        
-        self.users[username] = User(username, password)
-        self.save_users()
-        return True, "Регистрация успешна!"
-    
-    def login_user(self, username, password):
-        if username in self.users and self.users[username].password == password:
-            return True, "Вход выполнен!"
-        return False, "Неверный ник или пароль"
-    
-    def search_users(self, query, current_user):
-        results = []
-        for username in self.users:
-            if query.lower() in username.lower() and username != current_user:
-                results.append(username)
-        return results
-    
-    def add_contact(self, username, contact_username):
-        if contact_username in self.users and contact_username != username:
-            if contact_username not in self.users[username].contacts:
-                self.users[username].contacts.append(contact_username)
-                self.save_users()
-                return True, f"{contact_username} добавлен в контакты!"
-        return False, "Пользователь не найден"
-    
-    def get_conversation_key(self, user1, user2):
-        return f"{min(user1, user2)}_{max(user1, user2)}"
-    
-    def send_message(self, sender, receiver, content):
-        if receiver not in self.users:
-            return False, "Пользователь не найден"
-        
-        conv_key = self.get_conversation_key(sender, receiver)
-        message = {
-            'sender': sender,
-            'content': content,
-            'timestamp': datetime.now().isoformat()
-        }
-        
-        if conv_key not in self.messages:
-            self.messages[conv_key] = []
-        
-        self.messages[conv_key].append(message)
-        self.save_messages()
-        return True, "Сообщение отправлено!"
-    
-    def get_messages(self, user1, user2):
-        conv_key = self.get_conversation_key(user1, user2)
-        if conv_key in self.messages:
-            return self.messages[conv_key]
-        return []
+def call_db(db, func, callback=None):
+    # Удалённая база отвечает в потоке клиента: результат возвращается в главный поток.
+    # Локальная база вызывает callback сразу
+    def deliver(result):
+        if threading.current_thread() is threading.main_thread():
+            callback(result)
+        else:
+            Clock.schedule_once(lambda dt: callback(result))
+    db.submit(func, deliver if callback is not None else None)
 
 class LoginScreen(Screen):
     def __init__(self, **kwargs):
@@ -219,20 +119,29 @@ class LoginScreen(Screen):
             self.show_popup("Ошибка", "Заполните все поля")
             return
         
-        success, message = self.db.login_user(username, password)
-        if success:
-            app = App.get_running_app()
-            app.current_user = username
-            self.manager.current = 'main'
-            self.username_input.text = ''
-            self.password_input.text = ''
-        else:
-            self.show_popup("Ошибка входа", message)
+        if not self.db.users_ready.is_set():
+            # Пользователи ещё читаются с диска: повторим, не блокируя интерфейс
+            Clock.schedule_once(lambda dt: self.login(instance), 0.1)
+            return
+        
+        def done(result):
+            success, message = result
+            if success:
+                app = App.get_running_app()
+                app.current_user = username
+                app.show_screen('main')
+                self.username_input.text = ''
+                self.password_input.text = ''
+            else:
+                self.show_popup("Ошибка входа", message)
+        
+        call_db(self.db, lambda: self.db.login_user(username, password), done)
     
     def go_to_register(self, instance):
-        self.manager.current = 'register'
+        App.get_running_app().show_screen('register')
     
     def show_popup(self, title, message):
+        from kivy.uix.popup import Popup
         popup = Popup(
             title=title, 
             content=Label(text=message), 
@@ -327,20 +236,28 @@ class RegisterScreen(Screen):
             self.show_popup("Ошибка", "Пароли не совпадают")
             return
         
-        success, message = self.db.register_user(username, password)
-        if success:
-            self.show_popup("Успех!", "Аккаунт создан! Теперь войдите в систему.")
-            self.go_back(instance)
-        else:
-            self.show_popup("Ошибка регистрации", message)
+        if not self.db.users_ready.is_set():
+            Clock.schedule_once(lambda dt: self.register(instance), 0.1)
+            return
+        
+        def done(result):
+            success, message = result
+            if success:
+                self.show_popup("Успех!", "Аккаунт создан! Теперь войдите в систему.")
+                self.go_back(instance)
+            else:
+                self.show_popup("Ошибка регистрации", message)
+        
+        call_db(self.db, lambda: self.db.register_user(username, password), done)
     
     def go_back(self, instance):
-        self.manager.current = 'login'
+        App.get_running_app().show_screen('login')
         self.username_input.text = ''
         self.password_input.text = ''
         self.confirm_password_input.text = ''
     
     def show_popup(self, title, message):
+        from kivy.uix.popup import Popup
         popup = Popup(
             title=title, 
             content=Label(text=message), 
@@ -353,12 +270,109 @@ class MessageBubble(BoxLayout):
     message_text = StringProperty()
     is_my_message = BooleanProperty()
     timestamp = StringProperty()
+    attachment = ObjectProperty(None, allownone=True)
+    
+    IMAGE_SIZE = 120
+    # Текстуры последних показанных картинок, общие для всех пузырей
+    textures = OrderedDict()
+    TEXTURE_CACHE = 32
+    # Файлы читаются и декодируются в фоне, текстура создаётся в главном потоке
+    decoder = None
+    
+    # RecycleView переиспользует пузыри: содержимое меняется через свойства
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # Виджет картинки нужен только с первым пузырём, не при запуске
+        from kivy.uix.image import Image
+        self.padding = 5
+        self.image = Image(size_hint_x=None, width=0)
+        self.add_widget(self.image)
+        self.text_label = Label(color=(0.2, 0.2, 0.2, 1), valign='middle')
+        self.text_label.bind(width=self.update_text_size)
+        self.add_widget(self.text_label)
+        self.time_label = Label(size_hint_x=0.2, font_size='10sp', color=(0.5, 0.5, 0.5, 1))
+        self.add_widget(self.time_label)
+        self.bind(message_text=self.text_label.setter('text'),
+                  timestamp=self.time_label.setter('text'),
+                  is_my_message=self.update_side,
+                  attachment=self.update_attachment)
+        self.text_label.text = self.message_text
+        self.time_label.text = self.timestamp
+        self.update_side(self, self.is_my_message)
+        self.update_attachment(self, self.attachment)
+    
+    def update_attachment(self, instance, attachment):
+        self.image.texture = None
+        self.image.width = 0
+        if attachment is None or not AttachmentStore.is_image(attachment) \
+                or App.get_running_app().db.attachments is None:
+            return
+        # Пузыри существуют только для видимых строк, поэтому файл читается,
+        # когда строка показана, и не раньше
+        Clock.schedule_once(lambda dt: self.load_image(attachment))
+    
+    def load_image(self, attachment):
+        if self.attachment is None or self.attachment['hash'] != attachment['hash']:
+            # Пузырь уже показывает другую строку
+            return
+        texture = self.textures.get(attachment['hash'])
+        if texture is not None:
+            self.textures.move_to_end(attachment['hash'])
+            self.show_texture(texture)
+            return
+        store = App.get_running_app().db.attachments
+        
+        def decode():
+            from kivy.core.image import ImageLoader
+            try:
+                data = store.read(attachment['hash'])
+                ext = os.path.splitext(attachment['name'])[1][1:].lower()
+                # Текстура создаётся лениво, при первом обращении к ней
+                image = ImageLoader.load('__inline__', ext=ext, rawdata=io.BytesIO(data),
+                                         nocache=True)
+            except Exception:
+                Logger.warning("Shiligram: не удалось открыть вложение %s", attachment['name'])
+                return
+            Clock.schedule_once(lambda dt: self.show_image(attachment, image))
+        
+        if MessageBubble.decoder is None:
+            MessageBubble.decoder = ThreadPoolExecutor(max_workers=2,
+                                                       thread_name_prefix='shiligram-images')
+        MessageBubble.decoder.submit(decode)
+    
+    def show_image(self, attachment, image):
+        texture = self.textures.get(attachment['hash'])
+        if texture is None:
+            texture = self.textures[attachment['hash']] = image.texture
+            while len(self.textures) > self.TEXTURE_CACHE:
+                self.textures.popitem(last=False)
+        if self.attachment is not None and self.attachment['hash'] == attachment['hash']:
+            self.show_texture(texture)
+    
+    def show_texture(self, texture):
+        self.image.texture = texture
+        self.image.width = self.IMAGE_SIZE
+    
+    def update_text_size(self, instance, width):
+        instance.text_size = (width, None)
+    
+    def update_side(self, instance, is_my_message):
+        self.text_label.halign = 'right' if is_my_message else 'left'
+        self.text_label.color = (0.2, 0.6, 1, 1) if is_my_message else (0.2, 0.2, 0.2, 1)
 
 class ChatScreen(Screen):
+    PAGE_SIZE = 50
+    
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.target_user = None
+        # Название группы, если открыт чат группы
+        self.group_title = None
+        self.first_seq = 0
+        self.last_seq = 0
+        self.loading_older = False
         self.db = App.get_running_app().db
+        self.new_messages_trigger = Clock.create_trigger(self.append_new_messages)
         
         layout = BoxLayout(orientation='vertical')
         
@@ -382,20 +396,34 @@ class ChatScreen(Screen):
         
         layout.add_widget(header)
         
-        # Messages area
-        self.messages_layout = ScrollView()
-        self.messages_container = BoxLayout(
+        # Messages area: виджеты создаются только для видимых строк
+        from kivy.uix.recycleview import RecycleView
+        from kivy.uix.recycleboxlayout import RecycleBoxLayout
+        self.messages_layout = RecycleView(viewclass=MessageBubble)
+        self.messages_container = RecycleBoxLayout(
             orientation='vertical',
             size_hint_y=None,
+            default_size_hint=(1, None),
+            default_size=(None, 60),
             spacing=5,
             padding=10
         )
         self.messages_container.bind(minimum_height=self.messages_container.setter('height'))
         self.messages_layout.add_widget(self.messages_container)
+        self.messages_layout.bind(scroll_y=self.on_messages_scroll)
         layout.add_widget(self.messages_layout)
         
         # Input area
         input_layout = BoxLayout(size_hint_y=0.12, spacing=10, padding=10)
+        if self.db.attachments is not None:
+            attach_btn = Button(
+                text='📎',
+                size_hint_x=0.12,
+                background_color=(0.9, 0.95, 1, 1),
+                color=(0.2, 0.2, 0.2, 1)
+            )
+            attach_btn.bind(on_press=self.show_attach_popup)
+            input_layout.add_widget(attach_btn)
         self.message_input = TextInput(
             hint_text='Напишите сообщение...',
             multiline=False,
@@ -417,52 +445,227 @@ class ChatScreen(Screen):
         
         self.add_widget(layout)
     
-    def set_target_user(self, username):
+    def set_target_user(self, username, title=None):
         self.target_user = username
-        self.chat_title.text = f"Шилиграм - {username}"
+        self.group_title = title
+        self.chat_title.text = f"Шилиграм - {title or username}"
         self.load_messages()
     
-    def load_messages(self):
-        self.messages_container.clear_widgets()
-        
+    def load_messages(self, dt=None):
         if not self.target_user:
+            self.messages_layout.data = []
             return
         
-        messages = self.db.get_messages(App.get_running_app().current_user, self.target_user)
+        if not self.db.messages_ready.is_set():
+            # История ещё загружается в фоне
+            self.messages_layout.data = []
+            Clock.schedule_once(self.load_messages, 0.1)
+            return
         
-        for msg_data in messages:
-            message_widget = MessageBubble(
-                message_text=msg_data['content'],
-                is_my_message=msg_data['sender'] == App.get_running_app().current_user,
-                timestamp=msg_data['timestamp'][11:16]
-            )
-            self.messages_container.add_widget(message_widget)
+        current_user = App.get_running_app().current_user
+        target_user = self.target_user
+        
+        def show(messages):
+            if target_user != self.target_user:
+                # Пока ждали ответа, открыли другой чат
+                return
+            self.messages_layout.data = [self.bubble_data(msg_data, current_user)
+                                         for msg_data in messages]
+            self.first_seq = messages[0]['seq'] if messages else 0
+            self.last_seq = messages[-1]['seq'] if messages else 0
+            call_db(self.db, lambda: self.db.mark_read(current_user, target_user))
+            Clock.schedule_once(self.scroll_to_bottom, 0.1)
+        
+        # Открываем только последнюю страницу, старые догружаются при прокрутке
+        call_db(self.db, lambda: self.db.get_messages(current_user, target_user,
+                                                      limit=self.PAGE_SIZE), show)
+    
+    def on_messages_scroll(self, instance, scroll_y):
+        if scroll_y >= 0.95 and self.first_seq > 1 and self.target_user:
+            self.load_older_messages()
+    
+    def load_older_messages(self):
+        if self.loading_older:
+            return
+        self.loading_older = True
+        current_user = App.get_running_app().current_user
+        target_user = self.target_user
+        before = self.first_seq
+        
+        def show(messages):
+            self.loading_older = False
+            if target_user != self.target_user or before != self.first_seq:
+                return
+            if not messages:
+                self.first_seq = 0
+                return
+            
+            rows = [self.bubble_data(msg_data, current_user) for msg_data in messages]
+            added = sum(row['height'] + self.messages_container.spacing for row in rows)
+            view = self.messages_layout
+            # Запоминаем расстояние от верха, чтобы видимые сообщения не сдвинулись
+            offset = (1 - view.scroll_y) * max(self.messages_container.height - view.height, 0)
+            self.first_seq = messages[0]['seq']
+            view.data = rows + view.data
+            
+            def keep_position(dt):
+                scrollable = max(self.messages_container.height - view.height, 1)
+                view.scroll_y = max(0, min(1, 1 - (offset + added) / scrollable))
+            
+            Clock.schedule_once(keep_position, 0)
+        
+        call_db(self.db, lambda: self.db.get_messages(current_user, target_user, before=before,
+                                                      limit=self.PAGE_SIZE), show)
+    
+    def append_new_messages(self, dt=None):
+        if not self.target_user or not self.db.messages_ready.is_set():
+            return
+        
+        current_user = App.get_running_app().current_user
+        target_user = self.target_user
         
-        Clock.schedule_once(self.scroll_to_bottom, 0.1)
+        def show(messages):
+            if target_user != self.target_user:
+                return
+            # Ответы на запросы подряд могут повторять одни и те же сообщения
+            messages = [msg_data for msg_data in messages if msg_data['seq'] > self.last_seq]
+            if not messages:
+                return
+            
+            # Прокручиваем вниз, только если пользователь и так был внизу
+            at_bottom = self.messages_layout.scroll_y <= 0.01
+            self.messages_layout.data.extend(self.bubble_data(msg_data, current_user)
+                                             for msg_data in messages)
+            self.last_seq = messages[-1]['seq']
+            call_db(self.db, lambda: self.db.mark_read(current_user, target_user))
+            if at_bottom:
+                Clock.schedule_once(self.scroll_to_bottom, 0.1)
+        
+        call_db(self.db, lambda: self.db.get_messages_since(current_user, target_user,
+                                                            self.last_seq), show)
+    
+    def bubble_data(self, msg_data, current_user):
+        # Высота строки оценивается заранее, чтобы не измерять невидимые пузыри
+        text = msg_data['content']
+        attachment = msg_data.get('attachment')
+        if attachment is not None:
+            # В данных строки только ссылка, тело файла загрузит сам пузырь
+            text = f"📎 {attachment['name']} ({max(attachment['size'] // 1024, 1)} КБ)\n{text}".rstrip()
+        if self.group_title is not None and msg_data['sender'] != current_user:
+            # В группе видно, кто написал
+            text = f"{msg_data['sender']}: {text}"
+        lines = len(text) // 32 + 1
+        height = 40 + 20 * lines
+        if attachment is not None and AttachmentStore.is_image(attachment):
+            height = max(height, MessageBubble.IMAGE_SIZE + 20)
+        return {
+            'message_text': text,
+            'is_my_message': msg_data['sender'] == current_user,
+            'timestamp': msg_data['timestamp'][11:16],
+            'attachment': attachment,
+            'height': height
+        }
     
     def scroll_to_bottom(self, dt):
         self.messages_layout.scroll_y = 0
     
     def send_message(self, instance):
         message = self.message_input.text.strip()
+        if message and self.target_user and not self.db.messages_ready.is_set():
+            Clock.schedule_once(lambda dt: self.send_message(instance), 0.1)
+            return
         if message and self.target_user:
-            success, _ = self.db.send_message(
+            target_user = self.target_user
+            
+            def done(result):
+                success, _ = result
+                if success:
+                    if self.message_input.text.strip() == message:
+                        # Пока ждали ответа, поле могли начать заполнять заново
+                        self.message_input.text = ''
+                    if target_user == self.target_user:
+                        self.append_new_messages()
+                        Clock.schedule_once(self.scroll_to_bottom, 0.1)
+            
+            call_db(self.db, lambda: self.db.send_message(
                 App.get_running_app().current_user,
-                self.target_user,
+                target_user,
                 message
-            )
-            if success:
-                self.message_input.text = ''
-                self.load_messages()
+            ), done)
     
     def send_message_from_enter(self, instance):
         self.send_message(instance)
     
+    def show_attach_popup(self, instance):
+        from kivy.uix.popup import Popup
+        from kivy.uix.filechooser import FileChooserListView
+        chooser = FileChooserListView(path=os.path.expanduser('~'))
+        popup = Popup(
+            title='Шилиграм - Вложение',
+            content=chooser,
+            size_hint=(0.9, 0.9),
+            separator_color=(0.2, 0.6, 1, 1)
+        )
+        
+        def on_submit(chooser, selection, touch):
+            popup.dismiss()
+            if selection:
+                self.attach_file(selection[0])
+        
+        chooser.bind(on_submit=on_submit)
+        popup.open()
+    
+    def attach_file(self, path):
+        # Файл копируется в хранилище кусками в отдельном потоке, кадр не ждёт диска
+        target_user = self.target_user
+        content = self.message_input.text.strip()
+        self.message_input.text = ''
+        
+        def store():
+            try:
+                attachment = self.db.attachments.put(path)
+            except OSError as e:
+                Logger.warning("Shiligram: не удалось прикрепить %s: %s", path, e)
+                return
+            Clock.schedule_once(lambda dt: self.send_attachment(target_user, content, attachment))
+        
+        threading.Thread(target=store, name='shiligram-attach', daemon=True).start()
+    
+    def send_attachment(self, target_user, content, attachment):
+        def done(result):
+            success, _ = result
+            if success and target_user == self.target_user:
+                self.append_new_messages()
+                Clock.schedule_once(self.scroll_to_bottom, 0.1)
+        
+        current_user = App.get_running_app().current_user
+        call_db(self.db, lambda: self.db.send_message(current_user, target_user, content,
+                                                      attachment), done)
+    
+    def on_enter(self):
+        # Пока чат открыт, новые сообщения подтягиваются по ленте изменений
+        self.db.subscribe(self.on_db_change)
+        self.append_new_messages()
+    
+    def on_leave(self):
+        self.db.unsubscribe(self.on_db_change)
+    
+    def on_db_change(self, kind, details):
+        if kind == 'message' and self.target_user in (details['sender'], details['receiver']) \
+                and (App.get_running_app().current_user in (details['sender'], details['receiver'])
+                     or 'group' in details):
+            self.new_messages_trigger()
+        elif kind == 'reload':
+            # История перечитана с диска: номера сообщений могли сдвинуться
+            Clock.schedule_once(self.load_messages)
+    
     def go_back(self, instance):
-        self.manager.current = 'main'
+        App.get_running_app().show_screen('main')
         self.target_user = None
 
 class MainScreen(Screen):
+    SEARCH_DELAY = 0.25
+    
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.db = App.get_running_app().db
@@ -504,8 +707,19 @@ class MainScreen(Screen):
         self.content_layout = BoxLayout()
         
         # Chats tab
+        from kivy.uix.scrollview import ScrollView
         self.chats_tab = BoxLayout(orientation='vertical')
         
+        new_group_btn = Button(
+            text='👥 Новая группа',
+            size_hint_y=None,
+            height=50,
+            background_color=(0.2, 0.6, 1, 1),
+            color=(1, 1, 1, 1)
+        )
+        new_group_btn.bind(on_press=self.show_group_popup)
+        self.chats_tab.add_widget(new_group_btn)
+        
         self.contacts_scroll = ScrollView()
         self.contacts_layout = BoxLayout(
             orientation='vertical',
@@ -543,7 +757,39 @@ class MainScreen(Screen):
         
         self.add_widget(layout)
         
-        Clock.schedule_interval(self.refresh_chats, 2)
+        # Список контактов обновляется по ленте изменений, а не по таймеру
+        self.contact_buttons = {}
+        # Ключ группы -> название, для строк списка и результатов поиска
+        self.chat_titles = {}
+        self.contacts_state = None
+        self.no_contacts_label = Label(
+            text='Нет контактов\nНайдите друзей через поиск!',
+            text_size=(300, None),
+            halign='center'
+        )
+        self.refresh_trigger = Clock.create_trigger(self.refresh_chats)
+        self.db.subscribe(self.on_db_change)
+        
+        # Поиск запускается после паузы в наборе и выполняется в отдельном потоке
+        self.search_pipeline = SearchPipeline(self.db, self.on_search_results)
+        self.search_trigger = Clock.create_trigger(self.start_search, self.SEARCH_DELAY)
+    
+    def on_db_change(self, kind, details):
+        current_user = App.get_running_app().current_user
+        if kind == 'contact' and details['username'] == current_user:
+            self.refresh_trigger()
+        elif kind == 'message' and current_user in (details['sender'], details['receiver']):
+            self.refresh_trigger()
+        elif kind == 'message' and 'group' in details:
+            # Состав группы здесь не проверяем: без изменений load_contacts ничего не делает
+            self.refresh_trigger()
+        elif kind == 'group' and current_user in details['members']:
+            self.refresh_trigger()
+        elif kind == 'read' and details['username'] == current_user:
+            self.refresh_trigger()
+        elif kind == 'reload':
+            self.contacts_state = None
+            self.refresh_trigger()
     
     def on_enter(self):
         self.refresh_chats()
@@ -553,43 +799,121 @@ class MainScreen(Screen):
             self.load_contacts()
     
     def load_contacts(self):
-        self.contacts_layout.clear_widgets()
+        username = App.get_running_app().current_user
+        ready = self.db.messages_ready.is_set()
+        state = (username, self.db.contact_versions.get(username, 0),
+                 self.db.summary_versions.get(username, 0), ready)
+        if state == self.contacts_state:
+            return
+        self.contacts_state = state
         
-        current_user = self.db.users.get(App.get_running_app().current_user)
+        current_user = self.db.users.get(username)
         if not current_user:
+            self.show_chats(username, [])
+        elif ready:
+            # Сводки уже упорядочены по последнему сообщению
+            call_db(self.db, lambda: self.db.get_chat_list(username),
+                    lambda chats: self.show_chats(username, chats))
+        else:
+            # История ещё загружается в фоне: строки без сводок, по событию reload
+            # список перерисуется
+            self.show_chats(username, [(contact, None) for contact in list(current_user.contacts)])
+    
+    def show_chats(self, username, chats):
+        if username != App.get_running_app().current_user:
             return
+        current_user = self.db.users.get(username)
+        contacts = [contact for contact, summary in chats]
         
-        if not current_user.contacts:
-            no_contacts_label = Label(
-                text='Нет контактов\nНайдите друзей через поиск!',
-                text_size=(300, None),
-                halign='center'
-            )
-            self.contacts_layout.add_widget(no_contacts_label)
+        # Удаляем только исчезнувшие строки и создаём только новые
+        wanted = set(contacts)
+        for contact in list(self.contact_buttons):
+            if contact not in wanted:
+                self.contacts_layout.remove_widget(self.contact_buttons.pop(contact))
+        
+        if not current_user:
             return
         
-        for contact in current_user.contacts:
-            btn = Button(
-                text=f'💬 {contact}',
-                size_hint_y=None,
-                height=70,
-                background_color=(0.9, 0.95, 1, 1),
-                color=(0.2, 0.2, 0.2, 1)
-            )
-            btn.bind(on_press=lambda instance, username=contact: self.open_chat(username))
-            self.contacts_layout.add_widget(btn)
+        if not contacts:
+            if self.no_contacts_label.parent is None:
+                self.contacts_layout.add_widget(self.no_contacts_label)
+            return
+        if self.no_contacts_label.parent is not None:
+            self.contacts_layout.remove_widget(self.no_contacts_label)
+        
+        for contact, summary in chats:
+            if summary is not None and summary.title is not None:
+                self.chat_titles[contact] = summary.title
+            if contact not in self.contact_buttons:
+                btn = Button(
+                    size_hint_y=None,
+                    height=70,
+                    background_color=(0.9, 0.95, 1, 1),
+                    color=(0.2, 0.2, 0.2, 1),
+                    halign='left',
+                    markup=True
+                )
+                btn.bind(on_press=lambda instance, username=contact: self.open_chat(username))
+                btn.bind(size=lambda instance, size: setattr(instance, 'text_size', size))
+                self.contact_buttons[contact] = btn
+                self.contacts_layout.add_widget(btn)
+            self.contact_buttons[contact].text = self.chat_row_text(contact, summary)
+        
+        # children в Kivy хранятся в обратном порядке
+        wanted_order = [self.contact_buttons[contact] for contact in contacts]
+        if list(reversed(self.contacts_layout.children)) != wanted_order:
+            self.contacts_layout.clear_widgets()
+            for btn in wanted_order:
+                self.contacts_layout.add_widget(btn)
+    
+    def chat_row_text(self, contact, summary):
+        if summary is None:
+            return f'💬 {escape_markup(contact)}'
+        icon, name = ('👥', summary.title) if summary.title is not None else ('💬', contact)
+        badge = f'  [b]({summary.unread})[/b]' if summary.unread else ''
+        snippet = escape_markup(summary.snippet.replace('\n', ' '))
+        return (f'{icon} {escape_markup(name)}{badge}   {summary.timestamp[11:16]}\n'
+                f'[size=13sp]{snippet}[/size]')
     
     def on_search_text(self, instance, value):
+        # Новое нажатие отменяет начатый поиск и откладывает следующий
+        self.search_pipeline.cancel()
+        self.search_trigger.cancel()
         if value.strip():
-            results = self.db.search_users(value.strip(), App.get_running_app().current_user)
-            self.show_search_results(results)
+            self.search_trigger()
         else:
             self.search_results_layout.clear_widgets()
     
-    def show_search_results(self, results):
+    def start_search(self, dt):
+        query = self.search_input.text.strip()
+        if query:
+            self.search_pipeline.submit(App.get_running_app().current_user, query)
+    
+    def on_search_results(self, generation, results, message_results):
+        # Вызывается в потоке поиска; виджеты меняются только в главном потоке
+        def show(dt):
+            if self.search_pipeline.is_current(generation):
+                self.show_search_results(results, message_results)
+        Clock.schedule_once(show)
+    
+    def show_search_results(self, results, message_results=()):
         self.search_results_layout.clear_widgets()
         
+        for peer, msg in message_results:
+            preview = msg['content'] if len(msg['content']) <= 40 else msg['content'][:40] + '…'
+            message_btn = Button(
+                text=f'💬 {self.chat_titles.get(peer, peer)}: {preview}',
+                size_hint_y=None,
+                height=60,
+                background_color=(0.95, 0.95, 0.95, 1),
+                color=(0.2, 0.2, 0.2, 1)
+            )
+            message_btn.bind(on_press=lambda instance, u=peer: self.open_chat(u))
+            self.search_results_layout.add_widget(message_btn)
+        
         if not results:
+            if message_results:
+                return
             no_results_label = Label(
                 text='Пользователи не найдены',
                 text_size=(300, None),
@@ -620,11 +944,15 @@ class MainScreen(Screen):
             self.search_results_layout.add_widget(user_layout)
     
     def add_contact(self, username):
-        success, message = self.db.add_contact(App.get_running_app().current_user, username)
-        self.show_popup("Шилиграм", message)
-        if success:
-            self.search_input.text = ''
-            self.show_chats_tab()
+        def done(result):
+            success, message = result
+            self.show_popup("Шилиграм", message)
+            if success:
+                self.search_input.text = ''
+                self.show_chats_tab()
+        
+        current_user = App.get_running_app().current_user
+        call_db(self.db, lambda: self.db.add_contact(current_user, username), done)
     
     def show_search(self, instance):
         if self.current_tab == 'search':
@@ -648,15 +976,55 @@ class MainScreen(Screen):
         self.search_results_layout.clear_widgets()
     
     def open_chat(self, username):
-        chat_screen = self.manager.get_screen('chat')
-        chat_screen.set_target_user(username)
-        self.manager.current = 'chat'
+        app = App.get_running_app()
+        app.get_screen('chat').set_target_user(username, self.chat_titles.get(username))
+        app.show_screen('chat')
+    
+    def show_group_popup(self, instance):
+        from kivy.uix.popup import Popup
+        content = BoxLayout(orientation='vertical', spacing=10, padding=10)
+        title_input = TextInput(hint_text='Название группы', multiline=False)
+        members_input = TextInput(hint_text='Участники через запятую', multiline=False)
+        content.add_widget(title_input)
+        content.add_widget(members_input)
+        create_btn = Button(
+            text='Создать',
+            background_color=(0.2, 0.6, 1, 1),
+            color=(1, 1, 1, 1)
+        )
+        content.add_widget(create_btn)
+        popup = Popup(
+            title='Шилиграм - Новая группа',
+            content=content,
+            size_hint=(0.8, 0.5),
+            separator_color=(0.2, 0.6, 1, 1)
+        )
+        
+        def create(instance):
+            members = [name.strip() for name in members_input.text.split(',') if name.strip()]
+            title = title_input.text
+            
+            def done(result):
+                success, result = result
+                if not success:
+                    self.show_popup("Шилиграм", result)
+                    return
+                popup.dismiss()
+                self.chat_titles[result] = title.strip()
+                self.refresh_chats()
+            
+            current_user = App.get_running_app().current_user
+            call_db(self.db, lambda: self.db.create_group(current_user, title, members), done)
+        
+        create_btn.bind(on_press=create)
+        popup.open()
     
     def logout(self, instance):
         App.get_running_app().current_user = None
-        self.manager.current = 'login'
+        App.get_running_app().show_screen('login')
     
     def show_popup(self, title, message):
+        from kivy.uix.popup import Popup
         popup = Popup(
             title=title, 
             content=Label(text=message), 
@@ -668,19 +1036,138 @@ class MainScreen(Screen):
 class ShiliGramApp(App):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.db = Database()
+        # Данные читаются в фоне, окно входа показывается сразу
+        server = os.environ.get('SHILIGRAM_SERVER')
+        if server:
+            # Общая база на сервере (см. server.py), адрес в виде host:port
+            from client import RemoteDatabase
+            host, _, port = server.rpartition(':')
+            self.db = RemoteDatabase(host or '127.0.0.1', int(port))
+        else:
+            self.db = open_database(os.environ.get('SHILIGRAM_BACKEND', 'json'),
+                                    os.environ.get('SHILIGRAM_DURABILITY', 'batch'),
+                                    background=True)
+        profiler.instrument(self.db, self.PROFILED_DB_METHODS, 'db.')
         self.current_user = None
+        self.profile_overlay = None
+    
+    # Замеряемые пути при SHILIGRAM_PROFILE=1
+    PROFILED_DB_METHODS = ['send_message', 'save_messages', 'get_messages', 'search_users']
+    PROFILED_SCREEN_METHODS = {
+        'main': ['load_contacts', 'show_search_results'],
+        'chat': ['load_messages'],
+    }
+    PROFILE_FILE = "profile.json"
+    
+    # Экраны создаются при первом переходе на них
+    SCREENS = {
+        'login': LoginScreen,
+        'register': RegisterScreen,
+        'main': MainScreen,
+        'chat': ChatScreen,
+    }
     
     def build(self):
         self.title = "Шилиграм - Мессенджер"
         
-        sm = ScreenManager()
-        sm.add_widget(LoginScreen(name='login'))
-        sm.add_widget(RegisterScreen(name='register'))
-        sm.add_widget(MainScreen(name='main'))
-        sm.add_widget(ChatScreen(name='chat'))
+        if platform not in ('android', 'ios'):
+            # Устанавливаем размер окна для мобильных устройств
+            from kivy.core.window import Window
+            Window.size = (360, 640)
+        
+        STARTUP_TIMES['build_start'] = time.perf_counter()
+        self.screen_manager = ScreenManager()
+        self.show_screen('login')
+        STARTUP_TIMES['build'] = time.perf_counter()
         
-        return sm
+        return self.screen_manager
+    
+    def get_screen(self, name):
+        if not self.screen_manager.has_screen(name):
+            screen = self.SCREENS[name](name=name)
+            profiler.instrument(screen, self.PROFILED_SCREEN_METHODS.get(name, ()), name + '.')
+            self.screen_manager.add_widget(screen)
+        return self.screen_manager.get_screen(name)
+    
+    def show_screen(self, name):
+        self.get_screen(name)
+        self.screen_manager.current = name
+    
+    def on_start(self):
+        from kivy.core.window import Window
+        # Отложенный вызов Clock срабатывает до отрисовки: первый кадр ловим
+        # по первой смене буферов окна
+        Window.bind(on_flip=self.report_startup)
+        # Изменения, сделанные другими процессами в том же каталоге данных
+        Clock.schedule_interval(self.refresh_database, 1)
+        if profiler.enabled:
+            self.start_profiling()
+    
+    def start_profiling(self):
+        from kivy.core.window import Window
+        # Время кадра - интервал между соседними тиками Clock
+        Clock.schedule_interval(lambda dt: profiler.record('frame', dt * 1000), 0)
+        self.profile_overlay = Label(
+            font_size='10sp',
+            color=(1, 0.2, 0.2, 1),
+            halign='left',
+            valign='top',
+            size_hint=(None, None)
+        )
+        self.profile_overlay.bind(size=self.profile_overlay.setter('text_size'))
+        Window.add_widget(self.profile_overlay)
+        Window.bind(size=lambda window, size: setattr(self.profile_overlay, 'size', size))
+        self.profile_overlay.size = Window.size
+        Clock.schedule_interval(self.update_profile_overlay, 1)
+        Clock.schedule_interval(self.dump_profile, 10)
+    
+    def update_profile_overlay(self, dt):
+        lines = []
+        for name, stats in profiler.report().items():
+            lines.append(f"{name}: {stats['p50_ms']:.1f}/{stats['p95_ms']:.1f}/"
+                         f"{stats['p99_ms']:.1f} мс ×{stats['count']}")
+        self.profile_overlay.text = '\n'.join(lines)
+    
+    def dump_profile(self, dt=None):
+        try:
+            profiler.dump(self.PROFILE_FILE)
+        except OSError:
+            pass
+    
+    def refresh_database(self, dt):
+        self.db.refresh()
+    
+    def report_startup(self, window):
+        # Первый кадр уже на экране; замер нужен только один раз
+        now = time.perf_counter()
+        window.unbind(on_flip=self.report_startup)
+        start = STARTUP_TIMES['start']
+        report = {
+            'imports_ms': (STARTUP_TIMES['imports'] - start) * 1000,
+            'init_ms': (STARTUP_TIMES['build_start'] - STARTUP_TIMES['imports']) * 1000,
+            'build_ms': (STARTUP_TIMES['build'] - STARTUP_TIMES['build_start']) * 1000,
+            'first_frame_ms': (now - STARTUP_TIMES['build']) * 1000,
+            'total_ms': (now - start) * 1000,
+            'platform': platform
+        }
+        Logger.info("Shiligram: запуск %s", report)
+        try:
+            with open("startup_timing.jsonl", 'a', encoding='utf-8') as f:
+                f.write(json.dumps(report) + '\n')
+        except OSError:
+            pass
+    
+    def on_pause(self):
+        # Android может завершить приостановленное приложение без on_stop
+        self.db.flush()
+        return True
+    
+    def on_stop(self):
+        if profiler.enabled:
+            self.dump_profile()
+        self.db.close()
+        if self.db.writer is not None:
+            Logger.info("Shiligram: запись на диск %s", self.db.writer.latency_report())
 
 if __name__ == '__main__':
     ShiliGramApp().run()
@@ -0,0 +1,99 @@
+# Замеры горячих путей по запросу: SHILIGRAM_PROFILE=1.
+# Без переменной методы не оборачиваются, и замеры ничего не стоят.
+import functools
+import json
+import math
+import os
+import threading
+import time
+
+class Histogram:
+    # Логарифмические корзины: запись O(1), память не растёт с числом замеров
+    MIN_MS = 0.001
+    FACTOR = 1.1
+    BUCKETS = 200
+    
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    
+    def record(self, ms):
+        if ms > self.MIN_MS:
+            index = min(int(math.log(ms / self.MIN_MS, self.FACTOR)) + 1, self.BUCKETS - 1)
+        else:
+            index = 0
+        self.counts[index] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+    
+    def percentile(self, fraction):
+        # Верхняя граница корзины, в которую попал нужный по счёту замер
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(self.MIN_MS * self.FACTOR ** index, self.max)
+        return self.max
+    
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean_ms': self.total / self.count if self.count else 0,
+            'p50_ms': self.percentile(0.5),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+            'max_ms': self.max
+        }
+
+class Profiler:
+    def __init__(self, enabled=None):
+        if enabled is None:
+            enabled = os.environ.get('SHILIGRAM_PROFILE', '') not in ('', '0')
+        self.enabled = enabled
+        self.histograms = {}
+        self._lock = threading.Lock()
+    
+    def record(self, name, ms):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.record(ms)
+    
+    def wrap(self, name, func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(name, (time.perf_counter() - start) * 1000)
+        return timed
+    
+    def instrument(self, obj, methods, prefix=''):
+        # Обёртки ставятся на экземпляр: self.method() внутри класса тоже замеряется
+        if not self.enabled:
+            return obj
+        for method in methods:
+            func = getattr(obj, method, None)
+            if func is not None:
+                setattr(obj, method, self.wrap(prefix + method, func))
+        return obj
+    
+    def report(self):
+        with self._lock:
+            return {name: histogram.summary() for name, histogram in sorted(self.histograms.items())}
+    
+    def dump(self, path):
+        data = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'metrics': self.report()}
+        tmp_file = path + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, path)
+
+profiler = Profiler()
@@ -0,0 +1,92 @@
+# Поиск для экрана поиска: запросы выполняются в отдельном потоке, устаревшие
+# отменяются, недавние результаты кэшируются. Kivy здесь не нужен: результат
+# отдаётся через deliver, а в интерфейс его передаёт вызывающий код (через Clock)
+import threading
+from collections import OrderedDict
+
+class SearchPipeline:
+    CACHE_SIZE = 64
+    
+    def __init__(self, db, deliver, limit=50):
+        self.db = db
+        # deliver(generation, users, messages) вызывается в рабочем потоке
+        self.deliver = deliver
+        self.limit = limit
+        # Номер последнего запроса: всё, что с ним не совпадает, устарело
+        self.generation = 0
+        self.pending = None
+        # (ник, запрос) -> [версия базы, ники, найдены ли все, сообщения]
+        self.cache = OrderedDict()
+        self._cond = threading.Condition()
+        self.worker = None
+    
+    def submit(self, username, query):
+        with self._cond:
+            self.generation += 1
+            self.pending = (self.generation, username, query)
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.run, name='shiligram-search', daemon=True)
+                self.worker.start()
+            self._cond.notify()
+            return self.generation
+    
+    def cancel(self):
+        # Выполняемый запрос увидит новый номер и не отдаст результат
+        with self._cond:
+            self.generation += 1
+            self.pending = None
+    
+    def is_current(self, generation):
+        return generation == self.generation
+    
+    def run(self):
+        while True:
+            with self._cond:
+                while self.pending is None:
+                    self._cond.wait()
+                # Между нажатиями клавиш сюда попадает только последний запрос
+                job, self.pending = self.pending, None
+            self.search(*job)
+    
+    def search(self, generation, username, query):
+        key = (username, query)
+        version = self.db.version
+        entry = self.cache.get(key)
+        if entry is None or entry[0] != version:
+            users, complete = self.refine(username, query, version)
+            if users is None:
+                users = self.db.search_users(query, username, self.limit)
+                complete = len(users) < self.limit
+            entry = [version, users, complete, None]
+        self.store(key, entry)
+        if not self.is_current(generation):
+            return
+        # Поиск по тексту сообщений доступен, когда индекс уже построен
+        if entry[3] is None and self.db.search_ready.is_set():
+            entry[3] = self.db.search_messages(username, query)
+        if self.is_current(generation):
+            self.deliver(generation, entry[1], entry[3] or [])
+    
+    def refine(self, username, query, version):
+        # Ник, содержащий запрос, содержит и любую его часть: если по части
+        # запроса найдены все ники, уточнение - это фильтр по ним
+        lower = query.lower()
+        for (owner, previous), entry in reversed(self.cache.items()):
+            if owner != username or entry[0] != version or not entry[2] \
+                    or previous.lower() not in lower:
+                continue
+            found = []
+            for name in entry[1]:
+                name_lower = name.lower()
+                position = name_lower.find(lower)
+                if position >= 0:
+                    found.append((-1 if name_lower == lower else position, len(name), name))
+            found.sort()
+            return [name for _, _, name in found[:self.limit]], True
+        return None, False
+    
+    def store(self, key, entry):
+        self.cache[key] = entry
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.CACHE_SIZE:
+            self.cache.popitem(last=False)
@@ -0,0 +1,301 @@
+# Сервер Шилиграм без интерфейса: несколько клиентов работают с одной базой.
+# Запуск: python server.py [--host 127.0.0.1] [--port 8765] [--backend json]
+# Протокол - JSON по строке на сообщение поверх TCP:
+#   запрос  {"id": 1, "op": "send_message", "args": [...]}
+#   ответ   {"id": 1, "result": ...} или {"id": 1, "error": "..."}
+#   событие {"event": "message", "details": {...}} - без id, сервер шлёт сам
+import argparse
+import asyncio
+import json
+import logging
+import signal
+
+from storage import open_database
+
+logger = logging.getLogger('shiligram.server')
+
+DEFAULT_PORT = 8765
+LINE_LIMIT = 1024 * 1024
+
+def message_to_wire(msg):
+    # Message и строки SQLite читаются одинаково по ключам
+    return {key: msg.get(key) for key in ('sender', 'content', 'timestamp', 'seq', 'attachment')}
+
+class Connection:
+    def __init__(self, writer):
+        self.writer = writer
+        self.username = None
+        self.pending = []
+        self.flush_scheduled = False
+    
+    def send(self, loop, data):
+        # Ответы и события за один проход цикла уходят одной записью в сокет
+        self.pending.append(json.dumps(data, ensure_ascii=False).encode('utf-8') + b'\n')
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            loop.call_soon(self.flush)
+    
+    def flush(self):
+        self.flush_scheduled = False
+        if self.pending and not self.writer.is_closing():
+            self.writer.write(b''.join(self.pending))
+        self.pending = []
+
+class ShiliGramServer:
+    # Операции, которые могут долго считать, уходят из цикла событий в потоки
+    READ_OPS = {'get_messages', 'get_messages_since', 'search_users', 'search_messages'}
+    
+    def __init__(self, db):
+        self.db = db
+        self.loop = None
+        self.connections = set()
+        # Ник -> открытые соединения этого пользователя
+        self.subscribers = {}
+        self.ops = {
+            'register_user': self.op_register_user,
+            'login_user': self.op_login_user,
+            'get_user': self.op_get_user,
+            'search_users': self.op_search_users,
+            'add_contact': self.op_add_contact,
+            'add_contacts': self.op_add_contacts,
+            'remove_contact': self.op_remove_contact,
+            'remove_contacts': self.op_remove_contacts,
+            'contacted_by': self.op_contacted_by,
+            'mutual_contacts': self.op_mutual_contacts,
+            'send_message': self.op_send_message,
+            'get_messages': self.op_get_messages,
+            'get_messages_since': self.op_get_messages_since,
+            'search_messages': self.op_search_messages,
+            'get_chat_list': self.op_get_chat_list,
+            'mark_read': self.op_mark_read,
+            'create_group': self.op_create_group,
+            'add_group_members': self.op_add_group_members,
+            'leave_group': self.op_leave_group,
+        }
+        db.subscribe(self.on_db_change)
+    
+    async def serve(self, host='127.0.0.1', port=DEFAULT_PORT):
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.handle_client, host, port,
+                                            limit=LINE_LIMIT, backlog=4096)
+        logger.info("Сервер слушает %s:%s", *server.sockets[0].getsockname()[:2])
+        return server
+    
+    async def handle_client(self, reader, writer):
+        conn = Connection(writer)
+        self.connections.add(conn)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                await self.handle_request(conn, line)
+                if writer.transport.get_write_buffer_size() > LINE_LIMIT:
+                    # Медленный клиент не должен раздувать память сервера
+                    await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            self.connections.discard(conn)
+            self.unbind(conn)
+            writer.close()
+    
+    async def handle_request(self, conn, line):
+        try:
+            request = json.loads(line)
+            op = self.ops[request['op']]
+        except (ValueError, KeyError, TypeError):
+            conn.send(self.loop, {'id': None, 'error': "Неверный запрос"})
+            return
+        
+        args = request.get('args', [])
+        try:
+            if request['op'] in self.READ_OPS:
+                result = await self.loop.run_in_executor(None, lambda: op(conn, *args))
+            else:
+                result = op(conn, *args)
+        except TypeError:
+            conn.send(self.loop, {'id': request.get('id'), 'error': "Неверные аргументы"})
+            return
+        except Exception:
+            # Ошибка одной операции не должна рвать соединение клиента
+            logger.exception("Ошибка операции %s", request['op'])
+            conn.send(self.loop, {'id': request.get('id'), 'error': "Ошибка сервера"})
+            return
+        conn.send(self.loop, {'id': request.get('id'), 'result': result})
+    
+    def bind(self, conn, username):
+        self.unbind(conn)
+        conn.username = username
+        self.subscribers.setdefault(username, set()).add(conn)
+    
+    def unbind(self, conn):
+        if conn.username is None:
+            return
+        connections = self.subscribers.get(conn.username)
+        if connections is not None:
+            connections.discard(conn)
+            if not connections:
+                del self.subscribers[conn.username]
+        conn.username = None
+    
+    def on_db_change(self, kind, details):
+        # Вызывается в потоке, изменившем данные; рассылка - в цикле событий
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.publish, kind, details)
+    
+    def publish(self, kind, details):
+        if kind == 'message' and 'group' in details:
+            # Рассылка участникам по составу группы: сообщение хранится один раз
+            targets = self.db.group_members(details['group'])
+        elif kind == 'message':
+            targets = {details['sender'], details['receiver']}
+        elif kind == 'group':
+            targets = details['members']
+        elif kind in ('contact', 'read'):
+            targets = {details['username']}
+        else:
+            return
+        event = {'event': kind, 'details': details}
+        for username in targets:
+            for conn in self.subscribers.get(username, ()):
+                conn.send(self.loop, event)
+    
+    def op_register_user(self, conn, username, password):
+        success, message = self.db.register_user(username, password)
+        if success:
+            self.bind(conn, username)
+        return [success, message]
+    
+    def op_login_user(self, conn, username, password):
+        success, message = self.db.login_user(username, password)
+        if success:
+            self.bind(conn, username)
+        return [success, message]
+    
+    def op_get_user(self, conn, username):
+        # контакты видны только самому пользователю
+        if username != conn.username:
+            return None
+        user = self.db.users.get(username)
+        if user is None:
+            return None
+        return {'username': user.username, 'contacts': list(user.contacts),
+                'contacts_version': self.db.contact_versions.get(username, 0)}
+    
+    def op_search_users(self, conn, query, current_user, limit=50):
+        return self.db.search_users(query, current_user, limit)
+    
+    def op_add_contact(self, conn, username, contact_username):
+        if username != conn.username:
+            return [False, "Войдите, чтобы добавлять контакты"]
+        return list(self.db.add_contact(username, contact_username))
+    
+    def op_add_contacts(self, conn, username, contact_usernames):
+        if username != conn.username:
+            return [False, "Войдите, чтобы добавлять контакты"]
+        return list(self.db.add_contacts(username, contact_usernames))
+    
+    def op_remove_contact(self, conn, username, contact_username):
+        if username != conn.username:
+            return [False, "Войдите, чтобы удалять контакты"]
+        return list(self.db.remove_contact(username, contact_username))
+    
+    def op_remove_contacts(self, conn, username, contact_usernames):
+        if username != conn.username:
+            return [False, "Войдите, чтобы удалять контакты"]
+        return list(self.db.remove_contacts(username, contact_usernames))
+    
+    def op_contacted_by(self, conn, username):
+        if username != conn.username:
+            return []
+        return self.db.contacted_by(username)
+    
+    def op_mutual_contacts(self, conn, user1, user2):
+        if conn.username not in (user1, user2):
+            return []
+        return self.db.mutual_contacts(user1, user2)
+    
+    def op_send_message(self, conn, sender, receiver, content):
+        # Отправлять можно только от своего имени
+        if sender != conn.username:
+            return [False, "Войдите, чтобы отправлять сообщения"]
+        return list(self.db.send_message(sender, receiver, content))
+    
+    def op_get_messages(self, conn, user1, user2, before=None, limit=None):
+        if conn.username not in (user1, user2):
+            return []
+        return [message_to_wire(msg) for msg in self.db.get_messages(user1, user2, before, limit)]
+    
+    def op_get_messages_since(self, conn, user1, user2, seq):
+        if conn.username not in (user1, user2):
+            return []
+        return [message_to_wire(msg) for msg in self.db.get_messages_since(user1, user2, seq)]
+    
+    def op_search_messages(self, conn, username, query, limit=20):
+        if username != conn.username:
+            return []
+        return [[peer, message_to_wire(msg)]
+                for peer, msg in self.db.search_messages(username, query, limit)]
+
+    def op_get_chat_list(self, conn, username):
+        if username != conn.username:
+            return []
+        return [[contact, summary.to_dict() if summary else None]
+                for contact, summary in self.db.get_chat_list(username)]
+    
+    def op_mark_read(self, conn, username, peer):
+        if username != conn.username:
+            return False
+        return self.db.mark_read(username, peer)
+    
+    def op_create_group(self, conn, owner, title, members):
+        if owner != conn.username:
+            return [False, "Войдите, чтобы создавать группы"]
+        return list(self.db.create_group(owner, title, members))
+    
+    def op_add_group_members(self, conn, group_key, username, members):
+        if username != conn.username:
+            return [False, "Войдите, чтобы приглашать в группу"]
+        return list(self.db.add_group_members(group_key, username, members))
+    
+    def op_leave_group(self, conn, group_key, username):
+        if username != conn.username:
+            return [False, "Войдите, чтобы выйти из группы"]
+        return list(self.db.leave_group(group_key, username))
+
+async def run(host, port, backend, durability):
+    # Пакетная запись: журнал сбрасывается на диск фоновым потоком группами
+    db = open_database(backend, durability)
+    app = ShiliGramServer(db)
+    server = await app.serve(host, port)
+    
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    async with server:
+        # Каталог данных могут менять и другие процессы, например скрипты администратора
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), 1)
+            except asyncio.TimeoutError:
+                db.refresh()
+    db.close()
+    logger.info("Запись на диск %s", db.writer.latency_report())
+
+def main():
+    parser = argparse.ArgumentParser(description='Сервер Шилиграм')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--backend', default='json', choices=['json', 'archive', 'sqlite', 'sharded'])
+    parser.add_argument('--durability', default='batch', choices=['write', 'batch', 'timer'])
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(message)s')
+    asyncio.run(run(args.host, args.port, args.backend, args.durability))
+
+if __name__ == '__main__':
+    main()
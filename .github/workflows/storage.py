@@ -0,0 +1,3516 @@
+import bisect
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import math
+import mmap
+import multiprocessing
+import os
+import queue
+import re
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:
+    # Нет на Windows: блокировка остаётся только между потоками
+    fcntl = None
+
+try:
+    import lzma
+except ImportError:
+    # Сборки Python без lzma (бывает на Android): остаётся zlib
+    lzma = None
+
+class User:
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+        self.contacts = ContactSet()
+        self.messages = {}
+
+class ContactSet:
+    # Упорядоченное множество на словаре: порядок добавления для списка чатов,
+    # проверка и удаление за O(1)
+    __slots__ = ('items',)
+    
+    def __init__(self, contacts=()):
+        self.items = dict.fromkeys(contacts)
+    
+    def __contains__(self, contact):
+        return contact in self.items
+    
+    def __iter__(self):
+        return iter(self.items)
+    
+    def __len__(self):
+        return len(self.items)
+    
+    def add(self, contact):
+        if contact in self.items:
+            return False
+        self.items[contact] = None
+        return True
+    
+    def discard(self, contact):
+        if contact not in self.items:
+            return False
+        del self.items[contact]
+        return True
+
+class Message:
+    __slots__ = ('sender_id', 'content', 'timestamp', 'seq', 'attachment')
+    
+    # Общая таблица ников: в сообщении хранится только номер отправителя
+    senders = []
+    sender_ids = {}
+    senders_lock = threading.Lock()
+    
+    def __init__(self, sender_id, content, timestamp, seq, attachment=None):
+        self.sender_id = sender_id
+        self.content = content
+        # Секунды от начала эпохи вместо ISO-строки
+        self.timestamp = timestamp
+        self.seq = seq
+        # Ссылка на вложение в AttachmentStore: {'hash', 'name', 'size'}
+        self.attachment = attachment
+    
+    @classmethod
+    def intern_sender(cls, sender):
+        sender_id = cls.sender_ids.get(sender)
+        if sender_id is None:
+            with cls.senders_lock:
+                sender_id = cls.sender_ids.get(sender)
+                if sender_id is None:
+                    sender_id = cls.sender_ids[sender] = len(cls.senders)
+                    cls.senders.append(sender)
+        return sender_id
+    
+    @classmethod
+    def create(cls, sender, content, seq, timestamp=None, attachment=None):
+        if timestamp is None:
+            timestamp = int(time.time())
+        return cls(cls.intern_sender(sender), content, timestamp, seq, attachment)
+    
+    @classmethod
+    def from_dict(cls, data, seq):
+        timestamp = data['timestamp']
+        if isinstance(timestamp, str):
+            timestamp = int(datetime.fromisoformat(timestamp).timestamp())
+        return cls.create(data['sender'], data['content'], seq, timestamp, data.get('attachment'))
+    
+    @property
+    def sender(self):
+        return Message.senders[self.sender_id]
+    
+    # Совместимость с прежним форматом сообщения-словаря
+    def __getitem__(self, key):
+        if key == 'timestamp':
+            return datetime.fromtimestamp(self.timestamp).isoformat()
+        if key in ('sender', 'content', 'seq', 'attachment'):
+            return getattr(self, key)
+        raise KeyError(key)
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def to_dict(self):
+        data = {
+            'sender': self.sender,
+            'content': self.content,
+            'timestamp': self['timestamp'],
+            'seq': self.seq
+        }
+        if self.attachment is not None:
+            data['attachment'] = self.attachment
+        return data
+
+class Conversation:
+    # Переписка хранится по столбцам, объекты Message создаются только при чтении.
+    # Начало переписки может лежать в архиве (archived), новые сообщения - в столбцах
+    __slots__ = ('archived', 'sender_ids', 'timestamps', 'contents', 'attachments')
+    
+    def __init__(self, archived=None):
+        self.archived = archived
+        self.sender_ids = array('I')
+        self.timestamps = array('q')
+        self.contents = []
+        # Вложения редки: позиция в столбцах -> ссылка, без столбца на все сообщения
+        self.attachments = None
+    
+    @classmethod
+    def from_dicts(cls, messages, archived=None):
+        conversation = cls(archived)
+        for msg in messages:
+            conversation.append(Message.from_dict(msg, len(conversation) + 1))
+        return conversation
+    
+    def append(self, message):
+        # Номер сообщения - его позиция, отдельно не хранится
+        self.sender_ids.append(message.sender_id)
+        self.timestamps.append(message.timestamp)
+        self.contents.append(message.content)
+        if message.attachment is not None:
+            if self.attachments is None:
+                self.attachments = {}
+            self.attachments[len(self.contents) - 1] = message.attachment
+    
+    def copy(self):
+        conversation = Conversation(self.archived)
+        conversation.sender_ids = self.sender_ids[:]
+        conversation.timestamps = self.timestamps[:]
+        conversation.contents = self.contents[:]
+        if self.attachments is not None:
+            conversation.attachments = dict(self.attachments)
+        return conversation
+    
+    def prefix(self, count):
+        # Копия первых count сообщений. Столбцы только дополняются, поэтому её можно
+        # снимать без блокировки, пока другой поток дописывает переписку
+        keep = count - self.archived_count()
+        conversation = Conversation(self.archived)
+        conversation.sender_ids = self.sender_ids[:keep]
+        conversation.timestamps = self.timestamps[:keep]
+        conversation.contents = self.contents[:keep]
+        attachments = self.attachments
+        if attachments is not None:
+            conversation.attachments = {j: ref for j, ref in dict(attachments).items()
+                                        if j < keep} or None
+        return conversation
+    
+    def with_archived(self, archived):
+        # Начало переписки уехало в archived: в столбцах остаётся только хвост
+        drop = len(archived) - self.archived_count()
+        conversation = Conversation(archived)
+        conversation.sender_ids = self.sender_ids[drop:]
+        conversation.timestamps = self.timestamps[drop:]
+        conversation.contents = self.contents[drop:]
+        if self.attachments is not None:
+            conversation.attachments = {j - drop: ref for j, ref in self.attachments.items()
+                                        if j >= drop} or None
+        return conversation
+    
+    def archived_count(self):
+        return len(self.archived) if self.archived is not None else 0
+    
+    def message_at(self, i):
+        archived = self.archived_count()
+        if i < archived:
+            return self.archived.message_at(i)
+        j = i - archived
+        attachment = self.attachments.get(j) if self.attachments is not None else None
+        return Message(self.sender_ids[j], self.contents[j], self.timestamps[j], i + 1, attachment)
+    
+    def __len__(self):
+        return self.archived_count() + len(self.contents)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.message_at(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.message_at(index)
+    
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.message_at(i)
+    
+    def to_dicts(self):
+        return [message.to_dict() for message in self]
+
+class ArchivedConversation:
+    __slots__ = ('archive', 'index_offset', 'count', 'attachments')
+    
+    def __init__(self, archive, index_offset, count, attachments=None):
+        self.archive = archive
+        self.index_offset = index_offset
+        self.count = count
+        self.attachments = attachments
+    
+    def __len__(self):
+        return self.count
+    
+    def message_at(self, i):
+        # Текст декодируется только для запрошенной строки
+        archive = self.archive
+        offset, = archive.OFFSET.unpack_from(archive.map, self.index_offset + archive.OFFSET.size * i)
+        length, sender, timestamp = archive.RECORD.unpack_from(archive.map, offset)
+        start = offset + archive.RECORD.size
+        content = archive.map[start:start + length].decode('utf-8')
+        attachment = self.attachments.get(str(i)) if self.attachments is not None else None
+        return Message(archive.sender_ids[sender], content, timestamp, i + 1, attachment)
+
+class MessageArchive:
+    # Заголовок | записи (длина текста, отправитель, время, текст) |
+    # массивы смещений по перепискам | JSON-каталог (ники, переписки, вложения)
+    MAGIC = b'SHLA'
+    VERSION = 1
+    HEADER = struct.Struct('<4sIQQ')
+    RECORD = struct.Struct('<IIq')
+    OFFSET = struct.Struct('<Q')
+    
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, directory_offset, directory_length = self.HEADER.unpack_from(self.map, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError(f"Неизвестный формат архива: {path}")
+        directory = json.loads(self.map[directory_offset:directory_offset + directory_length])
+        self.sender_ids = [Message.intern_sender(name) for name in directory['senders']]
+        self.conversations = directory['conversations']
+        self.attachments = directory.get('attachments', {})
+    
+    def keys(self):
+        return self.conversations.keys()
+    
+    def conversation(self, conv_key):
+        index_offset, count = self.conversations[conv_key]
+        return ArchivedConversation(self, index_offset, count, self.attachments.get(conv_key))
+    
+    def close(self):
+        self.map.close()
+        self.file.close()
+    
+    @classmethod
+    def write(cls, path, messages):
+        tmp_file = path + '.tmp'
+        senders = {}
+        offsets = {}
+        attachments = {}
+        with open(tmp_file, 'wb') as f:
+            f.write(bytes(cls.HEADER.size))
+            position = cls.HEADER.size
+            for conv_key, conversation in messages.items():
+                conv_offsets = array('Q')
+                for i, message in enumerate(conversation):
+                    if message.attachment is not None:
+                        attachments.setdefault(conv_key, {})[str(i)] = message.attachment
+                    sender = senders.setdefault(message.sender, len(senders))
+                    content = message.content.encode('utf-8')
+                    conv_offsets.append(position)
+                    f.write(cls.RECORD.pack(len(content), sender, message.timestamp))
+                    f.write(content)
+                    position += cls.RECORD.size + len(content)
+                offsets[conv_key] = conv_offsets
+            padding = -position % cls.OFFSET.size
+            f.write(bytes(padding))
+            position += padding
+            directory = {'senders': list(senders), 'conversations': {}, 'attachments': attachments}
+            for conv_key, conv_offsets in offsets.items():
+                directory['conversations'][conv_key] = [position, len(conv_offsets)]
+                if sys.byteorder != 'little':
+                    conv_offsets.byteswap()
+                f.write(conv_offsets.tobytes())
+                position += cls.OFFSET.size * len(conv_offsets)
+            directory = json.dumps(directory, ensure_ascii=False).encode('utf-8')
+            f.write(directory)
+            f.seek(0)
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, position, len(directory)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, path)
+
+class ColdConversation:
+    # Старая часть переписки: сжатые сегменты в ColdStore
+    __slots__ = ('store', 'segments', 'starts', 'count')
+    
+    def __init__(self, store, segments):
+        self.store = store
+        self.segments = segments
+        self.starts = []
+        self.count = 0
+        for segment in segments:
+            self.starts.append(self.count)
+            self.count += segment[2]
+    
+    def __len__(self):
+        return self.count
+    
+    def message_at(self, i):
+        k = bisect.bisect_right(self.starts, i) - 1
+        sender_id, timestamp, content, attachment = \
+            self.store.read_segment(self.segments[k])[i - self.starts[k]]
+        return Message(sender_id, content, timestamp, i + 1, attachment)
+    
+    def extend(self, segments):
+        return ColdConversation(self.store, self.segments + segments)
+
+class ColdStore:
+    # Файл сжатых сегментов истории. Сегмент описывается
+    # [смещение, длина, число сообщений, кодек] и после записи не меняется;
+    # ссылки на сегменты хранит снимок messages.json. Место, на которое снимок
+    # не ссылается (сегменты прерванного сжатия), занимают новые сегменты
+    CODECS = {'zlib': (lambda data: zlib.compress(data, 9), zlib.decompress)}
+    if lzma is not None:
+        CODECS['lzma'] = (lzma.compress, lzma.decompress)
+    
+    def __init__(self, path, cache_segments=16):
+        self.path = path
+        self.file = None
+        # Несколько недавно прочитанных сегментов держим распакованными
+        self.cache = OrderedDict()
+        self.cache_segments = cache_segments
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+    
+    def write_segments(self, chunks, live, codec='zlib'):
+        # Поток записи, под блокировкой каталога. live - все сегменты, на которые
+        # ссылается снимок: новые сегменты ложатся в промежутки между ними или
+        # после последнего, хвост без ссылок обрезается
+        compress = self.CODECS[codec][0]
+        gaps = []
+        end = 0
+        for segment in sorted(live):
+            if segment[0] > end:
+                gaps.append([end, segment[0]])
+            end = max(end, segment[0] + segment[1])
+        segments = []
+        with open(self.path, 'r+b' if os.path.exists(self.path) else 'w+b') as f:
+            for messages in chunks:
+                rows = [[message.sender, message.timestamp, message.content]
+                        + ([message.attachment] if message.attachment is not None else [])
+                        for message in messages]
+                data = compress(json.dumps(rows, ensure_ascii=False).encode('utf-8'))
+                for gap in gaps:
+                    if gap[1] - gap[0] >= len(data):
+                        offset = gap[0]
+                        gap[0] += len(data)
+                        break
+                else:
+                    offset = end
+                    end += len(data)
+                f.seek(offset)
+                f.write(data)
+                segments.append([offset, len(data), len(rows), codec])
+            f.truncate(end)
+            f.flush()
+            os.fsync(f.fileno())
+        with self._lock:
+            # Кэш мог держать прежнее содержимое этих смещений
+            for segment in segments:
+                self.cache.pop(segment[0], None)
+        return segments
+    
+    def read_segment(self, segment):
+        offset = segment[0]
+        with self._lock:
+            rows = self.cache.get(offset)
+            if rows is not None:
+                self.cache.move_to_end(offset)
+                self.hits += 1
+                return rows
+            self.misses += 1
+            if self.file is None:
+                self.file = open(self.path, 'rb')
+            self.file.seek(offset)
+            data = self.file.read(segment[1])
+        rows = [(Message.intern_sender(row[0]), row[1], row[2], row[3] if len(row) > 3 else None)
+                for row in json.loads(self.CODECS[segment[3]][1](data))]
+        with self._lock:
+            self.cache[offset] = rows
+            while len(self.cache) > self.cache_segments:
+                self.cache.popitem(last=False)
+        return rows
+    
+    def close(self):
+        with self._lock:
+            self.cache.clear()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+class AttachmentStore:
+    # Файлы вложений лежат под хэшем содержимого: одинаковые файлы из разных
+    # переписок хранятся один раз. Сообщение держит только ссылку
+    # {'hash', 'name', 'size'}, счётчики ссылок - журнал {"hash", "delta"}
+    CHUNK_SIZE = 1 << 16
+    # Файл без ссылок моложе этого срока не удаляется: сообщение с ним может
+    # быть ещё в пути
+    GC_GRACE = 3600
+    IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')
+    
+    def __init__(self, directory, writer):
+        self.directory = directory
+        self.refs_file = os.path.join(directory, "refs.journal")
+        self.writer = writer
+    
+    def blob_path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+    
+    def exists(self, digest):
+        return os.path.exists(self.blob_path(digest))
+    
+    @classmethod
+    def is_image(cls, attachment):
+        return attachment['name'].lower().endswith(cls.IMAGE_EXTENSIONS)
+    
+    def put(self, source, name=None):
+        # source - путь или открытый двоичный файл; копируется кусками с подсчётом хэша
+        if isinstance(source, str):
+            with open(source, 'rb') as f:
+                return self.put(f, name or os.path.basename(source))
+        os.makedirs(self.directory, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_file = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: source.read(self.CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            digest = digest.hexdigest()
+            path = self.blob_path(digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.exists(path):
+                # Такой файл уже есть: свежая дата защищает его от сборки мусора
+                os.remove(tmp_file)
+                os.utime(path)
+            else:
+                os.replace(tmp_file, path)
+        except BaseException:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+        return {'hash': digest, 'name': name or digest, 'size': size}
+    
+    def open(self, digest):
+        # Отображение файла в память: читаются только затронутые страницы.
+        # Пустой файл отобразить нельзя, для него - пустые байты
+        with open(self.blob_path(digest), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    def read(self, digest):
+        # Файл целиком одним чтением, без отображения и его копии;
+        # для чтения частями - open() и iter_chunks()
+        with open(self.blob_path(digest), 'rb') as f:
+            return f.read()
+    
+    def iter_chunks(self, digest, chunk_size=None):
+        chunk_size = chunk_size or self.CHUNK_SIZE
+        data = self.open(digest)
+        try:
+            for start in range(0, len(data), chunk_size):
+                yield data[start:start + chunk_size]
+        finally:
+            if not isinstance(data, bytes):
+                data.close()
+    
+    def retain(self, digest):
+        self.writer.append(self.refs_file, json.dumps({'hash': digest, 'delta': 1}) + '\n')
+    
+    def retain_all(self, digests):
+        # Пачка ссылок одной записью журнала
+        self.writer.append(self.refs_file, ''.join(
+            json.dumps({'hash': digest, 'delta': 1}) + '\n' for digest in digests))
+    
+    def load_counts(self):
+        counts = {}
+        lines = 0
+        if os.path.exists(self.refs_file):
+            with open(self.refs_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    counts[record['hash']] = counts.get(record['hash'], 0) + record['delta']
+                    lines += 1
+        return counts, lines
+    
+    def collect_garbage(self):
+        # Поток записи, под блокировкой каталога: журнал ссылок всех процессов уже на диске
+        if not os.path.isdir(self.directory):
+            return 0
+        counts, lines = self.load_counts()
+        deadline = time.time() - self.GC_GRACE
+        removed = 0
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith('.tmp') \
+                    and entry.stat().st_mtime < deadline:
+                # Недописанный файл после сбоя
+                os.remove(entry.path)
+            elif entry.is_dir():
+                for blob in os.scandir(entry.path):
+                    if counts.get(blob.name, 0) <= 0 and blob.stat().st_mtime < deadline:
+                        os.remove(blob.path)
+                        removed += 1
+        live = {digest: count for digest, count in counts.items() if count > 0}
+        if lines > len(live):
+            # Журнал сворачивается до одной записи на живой файл
+            self.writer.close_file(self.refs_file)
+            tmp_file = self.refs_file + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                for digest, count in live.items():
+                    f.write(json.dumps({'hash': digest, 'delta': count}) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.refs_file)
+        if removed:
+            logging.getLogger('shiligram').info("Удалено вложений без ссылок: %d", removed)
+        return removed
+
+class ContactGraph:
+    # Прямые связи - User.contacts, обратные - ник -> кто добавил его в контакты.
+    # Обе стороны меняются только через add и remove
+    def __init__(self, users=()):
+        self.reverse = {}
+        self.edges = 0
+        for user in users:
+            for contact in user.contacts:
+                self.reverse.setdefault(contact, set()).add(user.username)
+                self.edges += 1
+    
+    def add(self, user, contact):
+        if not user.contacts.add(contact):
+            return False
+        self.reverse.setdefault(contact, set()).add(user.username)
+        self.edges += 1
+        return True
+    
+    def remove(self, user, contact):
+        if not user.contacts.discard(contact):
+            return False
+        followers = self.reverse.get(contact)
+        if followers is not None:
+            followers.discard(user.username)
+            if not followers:
+                del self.reverse[contact]
+        self.edges -= 1
+        return True
+    
+    def contacted_by(self, username):
+        return self.reverse.get(username, ())
+    
+    @staticmethod
+    def mutual(contacts1, contacts2):
+        # Обход меньшего списка с проверкой в большем: O(меньшей степени)
+        if len(contacts2) < len(contacts1):
+            contacts1, contacts2 = contacts2, contacts1
+        return [contact for contact in contacts1 if contact in contacts2]
+
+class UsernameIndex:
+    NGRAM = 3
+    
+    def __init__(self, usernames=()):
+        self.lowered = {}
+        # Отсортированные пары (ник в нижнем регистре, ник) для поиска по префиксу
+        self.sorted_names = []
+        # Триграмма -> ники, содержащие её, для поиска по подстроке
+        self.ngrams = {}
+        self._lock = threading.Lock()
+        for username in usernames:
+            self.lowered[username] = username.lower()
+        self.sorted_names = sorted((lower, username) for username, lower in self.lowered.items())
+        for username, lower in self.lowered.items():
+            self.index_ngrams(username, lower)
+    
+    def add(self, username):
+        lower = username.lower()
+        with self._lock:
+            self.lowered[username] = lower
+            bisect.insort(self.sorted_names, (lower, username))
+            self.index_ngrams(username, lower)
+    
+    def index_ngrams(self, username, lower):
+        for i in range(len(lower) - self.NGRAM + 1):
+            self.ngrams.setdefault(lower[i:i + self.NGRAM], set()).add(username)
+    
+    def search(self, query, exclude=None, limit=50):
+        query = query.lower()
+        with self._lock:
+            found = self.prefix_matches(query, exclude, limit)
+            if len(found) < limit:
+                found.update(self.substring_matches(query, exclude, limit - len(found)))
+        # Точное совпадение, затем префикс, затем чем раньше вхождение и короче ник
+        ranked = sorted(found.items(), key=lambda item: (item[1], len(item[0]), item[0]))
+        return [username for username, _ in ranked]
+    
+    def prefix_matches(self, query, exclude, limit):
+        # Пары отсортированы, поэтому первые совпадения - самые короткие продолжения
+        found = {}
+        i = bisect.bisect_left(self.sorted_names, (query, ''))
+        while i < len(self.sorted_names) and len(found) < limit:
+            lower, username = self.sorted_names[i]
+            if not lower.startswith(query):
+                break
+            if username != exclude:
+                found[username] = -1 if lower == query else 0
+            i += 1
+        return found
+    
+    def substring_matches(self, query, exclude, limit):
+        if len(query) >= self.NGRAM:
+            # Кандидаты берём из самой редкой триграммы запроса
+            groups = [min((self.ngrams.get(query[i:i + self.NGRAM], ())
+                           for i in range(len(query) - self.NGRAM + 1)), key=len)]
+        else:
+            # Короткий запрос целиком входит в одну из триграмм ника
+            groups = (names for gram, names in self.ngrams.items() if query in gram)
+        found = {}
+        for candidates in groups:
+            for username in candidates:
+                position = self.lowered[username].find(query)
+                if position > 0 and username != exclude:
+                    found[username] = position
+                    if len(found) >= limit:
+                        return found
+        return found
+
+class ConversationSummary:
+    __slots__ = ('peer', 'title', 'snippet', 'timestamp', 'last_seq', 'read_seq', 'activity')
+    
+    SNIPPET_LENGTH = 60
+    # Время хранится с точностью до секунды, порядок внутри секунды - по счётчику
+    activity_counter = itertools.count(1)
+    
+    def __init__(self, peer, title=None):
+        self.peer = peer
+        # Название группы; у личной переписки - None
+        self.title = title
+        self.snippet = ''
+        self.timestamp = ''
+        self.last_seq = 0
+        self.read_seq = 0
+        self.activity = 0
+    
+    @property
+    def unread(self):
+        return max(self.last_seq - self.read_seq, 0)
+    
+    def update(self, msg):
+        # Хватает последнего сообщения: тела остальных не нужны
+        content = msg['content']
+        attachment = msg.get('attachment')
+        if attachment is not None:
+            content = f"📎 {attachment['name']} {content}".rstrip()
+        if len(content) > self.SNIPPET_LENGTH:
+            content = content[:self.SNIPPET_LENGTH] + '…'
+        self.snippet = content
+        self.timestamp = msg['timestamp']
+        self.last_seq = msg['seq']
+        self.activity = next(self.activity_counter)
+    
+    def copy(self):
+        summary = ConversationSummary(self.peer, self.title)
+        summary.snippet = self.snippet
+        summary.timestamp = self.timestamp
+        summary.last_seq = self.last_seq
+        summary.read_seq = self.read_seq
+        summary.activity = self.activity
+        return summary
+    
+    def to_dict(self):
+        data = {'peer': self.peer, 'snippet': self.snippet, 'timestamp': self.timestamp,
+                'last_seq': self.last_seq, 'read_seq': self.read_seq}
+        if self.title is not None:
+            data['title'] = self.title
+        return data
+    
+    @classmethod
+    def from_dict(cls, data):
+        summary = cls(data['peer'], data.get('title'))
+        summary.snippet = data['snippet']
+        summary.timestamp = data['timestamp']
+        summary.last_seq = data['last_seq']
+        summary.read_seq = data['read_seq']
+        return summary
+
+# Ключи групп не содержат "_", поэтому не совпадают с ключами личных переписок
+GROUP_PREFIX = 'group:'
+
+class Group:
+    # История группы хранится один раз под ключом группы; у участников -
+    # только курсоры прочтения, сводка для списка чатов тоже общая
+    __slots__ = ('key', 'title', 'owner', 'members', 'summary', 'read_seqs')
+    
+    def __init__(self, key, title, owner):
+        self.key = key
+        self.title = title
+        self.owner = owner
+        # Словарь как упорядоченное множество: порядок вступления и проверка за O(1)
+        self.members = {}
+        self.summary = ConversationSummary(key, title)
+        self.read_seqs = {}
+    
+    @staticmethod
+    def new_key():
+        return GROUP_PREFIX + os.urandom(6).hex()
+    
+    def summary_for(self, username):
+        summary = self.summary.copy()
+        summary.read_seq = self.read_seqs.get(username, 0)
+        return summary
+
+TOKEN_RE = re.compile(r'\w+')
+
+def tokenize(text):
+    return set(TOKEN_RE.findall(text.lower()))
+
+def index_conversation(contents):
+    # Выполняется в процессах пула при первичном построении индекса
+    postings = {}
+    for seq, content in enumerate(contents, 1):
+        for token in tokenize(content):
+            postings.setdefault(token, []).append(seq)
+    return postings
+
+class MessageIndex:
+    def __init__(self):
+        # Токен -> {переписка: номера сообщений по возрастанию}
+        self.postings = {}
+        # Время сообщений для сортировки результатов; длина - сколько проиндексировано
+        self.timestamps = {}
+        self.participants = {}
+        self.user_conversations = {}
+        self.total = 0
+        # Проиндексированное после последней записи на диск:
+        # переписка -> (первая несохранённая позиция, токен -> номера)
+        self.unsaved = {}
+        self.unsaved_count = 0
+        # Строк в журнале индекса при загрузке
+        self.records = 0
+        self._lock = threading.Lock()
+    
+    def indexed_count(self, conv_key):
+        return len(self.timestamps.get(conv_key, ()))
+    
+    def add_conversation(self, conv_key, participants):
+        with self._lock:
+            self.timestamps.setdefault(conv_key, array('q'))
+            if participants is not None and conv_key not in self.participants:
+                self.participants[conv_key] = participants
+                for user in participants:
+                    self.user_conversations.setdefault(user, set()).add(conv_key)
+    
+    def add(self, conv_key, message):
+        with self._lock:
+            timestamps = self.timestamps.setdefault(conv_key, array('q'))
+            if message.seq != len(timestamps) + 1:
+                return
+            timestamps.append(message.timestamp)
+            unsaved = self.unsaved.get(conv_key)
+            if unsaved is None:
+                unsaved = self.unsaved[conv_key] = (message.seq - 1, {})
+            for token in tokenize(message.content):
+                self.postings.setdefault(token, {}).setdefault(conv_key, array('I')).append(message.seq)
+                unsaved[1].setdefault(token, []).append(message.seq)
+            self.total += 1
+            self.unsaved_count += 1
+    
+    def merge(self, conv_key, postings, timestamps):
+        with self._lock:
+            self.timestamps[conv_key] = array('q', timestamps)
+            for token, seqs in postings.items():
+                self.postings.setdefault(token, {})[conv_key] = array('I', seqs)
+            self.total += len(timestamps)
+            self.unsaved[conv_key] = (0, postings)
+            self.unsaved_count += len(timestamps)
+    
+    def search(self, user, query, limit=20, groups=()):
+        # Участники групп здесь не хранятся: ключи групп пользователя передаются отдельно
+        tokens = tokenize(query)
+        scores = {}
+        with self._lock:
+            scope = self.user_conversations.get(user, ())
+            if groups:
+                scope = list(itertools.chain(scope, groups))
+            for token in tokens:
+                by_conversation = self.postings.get(token)
+                if not by_conversation:
+                    continue
+                # Редкие слова весят больше частых
+                weight = math.log(1 + self.total / sum(len(seqs) for seqs in by_conversation.values()))
+                for conv_key in scope:
+                    for seq in by_conversation.get(conv_key, ()):
+                        scores[conv_key, seq] = scores.get((conv_key, seq), 0) + weight
+            ranked = heapq.nlargest(limit, scores.items(), key=lambda item: (
+                item[1], self.timestamps[item[0][0]][item[0][1] - 1], item[0][1]))
+        return [(conv_key, seq, score) for (conv_key, seq), score in ranked]
+    
+    @staticmethod
+    def journal_line(conv_key, start, timestamps, postings):
+        return json.dumps({'conv': conv_key, 'start': start, 'timestamps': timestamps,
+                           'postings': postings}, ensure_ascii=False) + '\n'
+    
+    def take_unsaved(self):
+        # Строки журнала только с тем, что проиндексировано с прошлой записи
+        with self._lock:
+            unsaved, self.unsaved = self.unsaved, {}
+            self.unsaved_count = 0
+            return ''.join(self.journal_line(conv_key, start, self.timestamps[conv_key][start:].tolist(),
+                                             postings)
+                           for conv_key, (start, postings) in unsaved.items())
+    
+    def write(self, path):
+        # Сжатие журнала: одна строка на переписку вместо накопленных кусков
+        with self._lock:
+            by_conversation = {}
+            for token, convs in self.postings.items():
+                for conv_key, seqs in convs.items():
+                    by_conversation.setdefault(conv_key, {})[token] = seqs.tolist()
+            text = ''.join(self.journal_line(conv_key, 0, timestamps.tolist(),
+                                             by_conversation.get(conv_key, {}))
+                           for conv_key, timestamps in self.timestamps.items() if timestamps)
+            self.unsaved = {}
+            self.unsaved_count = 0
+        tmp_file = path + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, path)
+        self.records = len(self.timestamps)
+    
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Недописанная строка: её диапазон досчитается из истории
+                    continue
+                index.records += 1
+                conv_key = record['conv']
+                timestamps = index.timestamps.setdefault(conv_key, array('q'))
+                if record['start'] != len(timestamps):
+                    # Диапазон уже записал другой процесс или перед ним пропуск
+                    continue
+                timestamps.extend(record['timestamps'])
+                index.total += len(record['timestamps'])
+                for token, seqs in record['postings'].items():
+                    index.postings.setdefault(token, {}).setdefault(conv_key, array('I')).extend(seqs)
+        return index
+
+class FullTextIndex:
+    # Поиск SQLiteDatabase по таблице FTS5: строки индексирует триггер при вставке,
+    # в памяти ничего не хранится
+    SEARCH = ("SELECT messages.conversation, messages.seq, -bm25(messages_fts) AS score "
+              "FROM messages_fts JOIN messages ON messages.id = messages_fts.rowid "
+              "WHERE messages_fts MATCH ? AND messages.conversation IN "
+              "(SELECT value FROM json_each(?)) "
+              "ORDER BY score DESC, messages.timestamp DESC, messages.seq DESC LIMIT ?")
+    
+    def __init__(self, db):
+        self.db = db
+        self.unsaved_count = 0
+    
+    def add_conversation(self, conv_key, participants):
+        pass
+    
+    def add(self, conv_key, message):
+        pass
+    
+    def take_unsaved(self):
+        return ''
+    
+    def search(self, user, query, limit=20, groups=()):
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        # Слова в кавычках: синтаксис FTS5 в запросе пользователя не разбирается
+        match = ' OR '.join('"' + token.replace('"', '""') + '"' for token in tokens)
+        scope = [self.db.get_conversation_key(user, peer)
+                 for peer in list(self.db.summaries.get(user, {}))] + list(groups)
+        with self.db._lock:
+            rows = self.db.conn.execute(self.SEARCH, (match, json.dumps(scope), limit)).fetchall()
+            # Сообщения, ещё не записанные потоком записи, FTS5 не видит: у них
+            # вес - число совпавших слов
+            scope = set(scope)
+            pending = [(conv_key, message.seq, float(len(tokens & tokenize(message.content))))
+                       for conv_key, messages in self.db.unflushed.items() if conv_key in scope
+                       for message in messages]
+        found = {(conv_key, seq) for conv_key, seq, score in rows}
+        pending = [row for row in pending if row[2] and row[:2] not in found]
+        if not pending:
+            return rows
+        return sorted(rows + pending, key=lambda row: row[2], reverse=True)[:limit]
+
+class FileLock:
+    # Рекомендательная блокировка каталога данных между процессами;
+    # внутри процесса повторный захват из того же потока разрешён
+    def __init__(self, path):
+        self.path = path
+        self.depth = 0
+        self.fd = None
+        self._lock = threading.RLock()
+    
+    def __enter__(self):
+        self._lock.acquire()
+        try:
+            if self.depth == 0 and fcntl is not None:
+                if self.fd is None:
+                    self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+        except BaseException:
+            # Не захваченная блокировка каталога не должна держать потоки процесса
+            self._lock.release()
+            raise
+        self.depth += 1
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if self.depth == 0 and self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self._lock.release()
+    
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+def file_signature(path):
+    # Признак изменения файла без чтения содержимого
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+class PersistenceWriter:
+    # write - fsync после каждой записи, batch - один fsync на пачку,
+    # timer - fsync дописываемых файлов не чаще раза в fsync_interval секунд
+    DURABILITY_MODES = ('write', 'batch', 'timer')
+    
+    def __init__(self, durability='batch', fsync_interval=1.0, lock=None):
+        if durability not in self.DURABILITY_MODES:
+            raise ValueError(f"Неизвестный режим надёжности: {durability}")
+        self.durability = durability
+        self.fsync_interval = fsync_interval
+        # Каждый коммит целиком выполняется под блокировкой каталога
+        self.lock = lock if lock is not None else threading.RLock()
+        self.queue = queue.Queue()
+        self.files = {}
+        # Размер файла после своей последней дописки
+        self.sizes = {}
+        self.dirty = set()
+        self.last_fsync = time.monotonic()
+        self.commit_latencies = deque(maxlen=1000)
+        self.logger = logging.getLogger('shiligram.writer')
+        self.thread = threading.Thread(target=self.run, name='shiligram-writer', daemon=True)
+        self.thread.start()
+    
+    def append(self, path, text):
+        self.queue.put(('append', path, text))
+    
+    def replace(self, path, data, indent=None):
+        # data сериализуется уже в потоке записи
+        self.queue.put(('replace', path, (data, indent)))
+    
+    def call(self, func):
+        # Выполняется в потоке записи строго после ранее поставленных записей
+        self.queue.put(('call', None, func))
+    
+    def flush(self):
+        done = threading.Event()
+        self.queue.put(('flush', None, done))
+        done.wait()
+    
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(('stop', None, None))
+            self.thread.join()
+    
+    def run(self):
+        timeout = self.fsync_interval if self.durability == 'timer' else None
+        while True:
+            try:
+                batch = [self.queue.get(timeout=timeout)]
+            except queue.Empty:
+                try:
+                    self.sync_dirty()
+                except Exception:
+                    self.logger.exception("Ошибка сброса на диск")
+                continue
+            # Всё, что накопилось за время прошлой записи, уходит одним коммитом
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not self.commit(batch):
+                break
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+    
+    def commit(self, batch):
+        # Ошибка коммита не должна останавливать поток: иначе flush() ждёт вечно
+        try:
+            with self.lock:
+                return self.commit_locked(batch)
+        except Exception:
+            self.logger.exception("Ошибка коммита %d операций", len(batch))
+            return all(kind != 'stop' for kind, path, payload in batch)
+        finally:
+            for kind, path, payload in batch:
+                if kind == 'flush':
+                    payload.set()
+    
+    def commit_locked(self, batch):
+        start = time.perf_counter()
+        running = True
+        pending = OrderedDict()
+        for kind, path, payload in batch:
+            if kind == 'append':
+                pending.setdefault(('append', path), []).append(payload)
+                if self.durability == 'write':
+                    self.write_pending(pending)
+            elif kind == 'replace':
+                # Повторные перезаписи одного файла схлопываются в последнюю
+                pending.pop(('replace', path), None)
+                pending[('replace', path)] = payload
+            else:
+                self.write_pending(pending)
+                if kind == 'call':
+                    try:
+                        payload()
+                    except Exception:
+                        self.logger.exception("Ошибка фоновой задачи записи")
+                elif kind == 'stop':
+                    running = False
+        self.write_pending(pending)
+        if self.durability == 'batch' or not running:
+            self.sync_dirty()
+        elif self.durability == 'timer' and time.monotonic() - self.last_fsync >= self.fsync_interval:
+            # При непрерывной записи очередь не пустеет и таймаут run() не срабатывает
+            self.sync_dirty()
+        latency = (time.perf_counter() - start) * 1000
+        self.commit_latencies.append(latency)
+        self.logger.debug("Коммит %d операций за %.2f мс", len(batch), latency)
+        return running
+    
+    def write_pending(self, pending):
+        for (kind, path), payload in pending.items():
+            try:
+                if kind == 'append':
+                    self.write_append(path, ''.join(payload))
+                else:
+                    self.write_replace(path, *payload)
+            except Exception:
+                self.logger.exception("Не удалось записать %s", path)
+        pending.clear()
+    
+    def write_append(self, path, text):
+        f = self.files.get(path)
+        if f is not None and file_signature(path) is None \
+                or f is not None and os.fstat(f.fileno()).st_ino != os.stat(path).st_ino:
+            # Файл переименовал другой процесс при сжатии: пишем в новый
+            self.close_file(path)
+            f = None
+        if f is None:
+            f = self.files[path] = open(path, 'a', encoding='utf-8')
+        size = os.fstat(f.fileno()).st_size
+        if size != self.sizes.get(path):
+            # Файл менял кто-то ещё: строку, оборванную сбоем процесса, отрезаем,
+            # иначе новая запись склеится с ней. Под блокировкой каталога чужих
+            # недописанных строк быть не может
+            self.cut_torn_tail(path, f, size)
+        f.write(text)
+        f.flush()
+        self.sizes[path] = os.fstat(f.fileno()).st_size
+        if self.durability == 'write':
+            os.fsync(f.fileno())
+        else:
+            self.dirty.add(path)
+    
+    def cut_torn_tail(self, path, f, size):
+        end = 0
+        with open(path, 'rb') as src:
+            pos = size
+            while pos > 0:
+                start = max(pos - 65536, 0)
+                src.seek(start)
+                i = src.read(pos - start).rfind(b'\n')
+                if i >= 0:
+                    end = start + i + 1
+                    break
+                pos = start
+        if end < size:
+            os.ftruncate(f.fileno(), end)
+            self.logger.warning("Отрезана недописанная запись в %s: %d байт", path, size - end)
+    
+    def write_replace(self, path, data, indent):
+        # Временный файл + fsync + атомарное переименование
+        tmp_file = path + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=indent)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, path)
+    
+    def sync_dirty(self):
+        for path in self.dirty:
+            if path in self.files:
+                try:
+                    os.fsync(self.files[path].fileno())
+                except OSError:
+                    self.logger.exception("Не удалось сбросить на диск %s", path)
+        self.dirty.clear()
+        self.last_fsync = time.monotonic()
+    
+    def close_file(self, path):
+        # Вызывается из задач call перед переименованием файла
+        f = self.files.pop(path, None)
+        self.sizes.pop(path, None)
+        if f is not None:
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+        self.dirty.discard(path)
+    
+    def latency_report(self):
+        samples = sorted(self.commit_latencies)
+        if not samples:
+            return {'commits': 0}
+        return {
+            'commits': len(samples),
+            'p50_ms': samples[len(samples) // 2],
+            'p95_ms': samples[int(len(samples) * 0.95)],
+            'max_ms': samples[-1]
+        }
+
+class Database:
+    def __init__(self, durability='batch', background=False):
+        self.users_file = "users.json"
+        # Журнал контактов: строка на добавление или удаление, users.json не переписывается
+        self.contacts_file = "contacts.journal"
+        self.contacts_position = (None, 0)
+        self.contact_graph = ContactGraph()
+        self._contact_records = 0
+        self._contacts_compaction_pending = False
+        self._contacts_reload_pending = False
+        self._own_contact_ops = deque()
+        self._own_contact_count = 0
+        self.messages_file = "messages.json"
+        # Журнал новых сообщений: одна JSON-строка на сообщение
+        self.journal_file = "messages.journal"
+        # Бинарный архив истории; если он есть, используется вместо messages.json
+        self.archive_file = "messages.bin"
+        self.archive = None
+        # Сообщения старше cold_after секунд при сжатии журнала уходят целыми
+        # сегментами в messages.cold; None - не переносить
+        self.cold_file = "messages.cold"
+        self.cold_store = ColdStore(self.cold_file)
+        self.cold_after = 90 * 24 * 3600
+        self.cold_segment_size = 100
+        self.cold_codec = 'zlib'
+        # Полнотекстовый индекс сообщений, строится после загрузки истории
+        self.index_file = "message_index.journal"
+        self.legacy_index_file = "message_index.json"
+        self.message_index = MessageIndex()
+        # Журнал индекса дописывается после стольких новых сообщений
+        self.index_save_threshold = 1000
+        self._index_save_pending = False
+        self.search_ready = threading.Event()
+        self.parallel_index_threshold = 50000
+        # Сводки переписок для списка чатов и курсоры прочтения; последние сообщения
+        # переписок - в журнале-таблице, чтобы не читать их из истории при запуске
+        self.cursors_file = "read_cursors.journal"
+        self.summaries_file = "summaries.journal"
+        self.summaries = {}
+        self.summary_versions = {}
+        # Группы: состав и обратный индекс ник -> ключи групп; журнал изменений состава
+        self.groups_file = "groups.journal"
+        self.groups = {}
+        self.member_groups = {}
+        self.groups_position = 0
+        # Совместная работа нескольких процессов с одним каталогом данных
+        self.lock_file = "shiligram.lock"
+        self.file_lock = FileLock(self.lock_file)
+        self.origin = os.urandom(4).hex()
+        self.users_signature = None
+        self.journal_position = (None, 0)
+        self._users_save_pending = False
+        self.compact_threshold = 1000
+        self._lock = threading.RLock()
+        self._journal_records = 0
+        self._compaction_pending = False
+        self._foreign_records = []
+        # Свои записи журнала, ещё не замеченные при чтении хвоста
+        self._own_records = deque()
+        self._own_count = 0
+        self._reload_pending = False
+        self.snapshot_signature = None
+        # Все записи на диск идут через отдельный поток
+        self.writer = PersistenceWriter(durability, lock=self.file_lock)
+        # Файлы вложений, в сообщениях - только ссылки на них
+        self.attachments = AttachmentStore("attachments", self.writer)
+        # Лента изменений: общий счётчик, счётчики контактов и подписчики
+        self.version = 0
+        self.contact_versions = {}
+        self._listeners = []
+        # Готовность частей данных: для входа нужны только пользователи
+        self.users = {}
+        self.username_index = UsernameIndex()
+        self.messages = {}
+        self.users_ready = threading.Event()
+        self.messages_ready = threading.Event()
+        self.loader = None
+        if background:
+            self.loader = threading.Thread(target=self.load, name='shiligram-loader', daemon=True)
+            self.loader.start()
+        else:
+            self.load()
+    
+    def load(self):
+        self.users = self.load_users()
+        self.username_index = UsernameIndex(self.users)
+        self.contact_graph = ContactGraph(self.users.values())
+        self.users_ready.set()
+        self.messages = self.load_messages()
+        self.load_groups()
+        self.build_summaries()
+        self.messages_ready.set()
+        # Экраны, открытые до конца загрузки, перерисовываются со сводками
+        self.notify('reload')
+        try:
+            self.build_message_index()
+        finally:
+            # Даже без индекса поиск не должен ждать вечно
+            self.search_ready.set()
+        self.writer.call(self.attachments.collect_garbage)
+    
+    def build_summaries(self):
+        # Последние сообщения - из таблицы; проход по всем перепискам, только если
+        # её ещё нет (данные прежней версии)
+        table = self.load_last_messages()
+        if table is None:
+            table = {}
+            for conv_key in list(self.conversation_keys()):
+                msg = self.last_message(conv_key)
+                if msg is not None:
+                    table[conv_key] = self.summary_row(msg)
+            self.writer.call(lambda: self.write_last_messages(table))
+        summaries = {}
+        for group in self.groups.values():
+            group.summary = ConversationSummary(group.key, group.title)
+            group.read_seqs = {}
+        for conv_key, msg in table.items():
+            group = self.groups.get(conv_key)
+            participants = self.conversation_participants(conv_key)
+            if group is None and participants is None:
+                continue
+            if group is not None:
+                group.summary.update(msg)
+                group.read_seqs[msg['sender']] = msg['seq']
+                continue
+            user1, user2 = participants
+            summaries.setdefault(user1, {}).setdefault(user2, ConversationSummary(user2)).update(msg)
+            summaries.setdefault(user2, {}).setdefault(user1, ConversationSummary(user1)).update(msg)
+            # Если последним писал сам пользователь, переписка им прочитана
+            sender_peer = user2 if msg['sender'] == user1 else user1
+            summaries[msg['sender']][sender_peer].read_seq = msg['seq']
+        for username, peer, seq in self.load_read_cursors():
+            group = self.groups.get(peer)
+            if group is not None:
+                group.read_seqs[username] = max(group.read_seqs.get(username, 0), seq)
+                continue
+            summary = summaries.get(username, {}).get(peer)
+            if summary is not None:
+                summary.read_seq = max(summary.read_seq, seq)
+        self.summaries = summaries
+    
+    def build_message_index(self):
+        index = MessageIndex()
+        if os.path.exists(self.index_file):
+            try:
+                index = MessageIndex.load(self.index_file)
+            except (OSError, ValueError, KeyError):
+                index = MessageIndex()
+        if os.path.exists(self.legacy_index_file):
+            # Индекс прежней версии одним файлом: строится заново в журнал
+            os.remove(self.legacy_index_file)
+        
+        # Досчитываем только то, что появилось после сохранения индекса
+        todo = []
+        for conv_key in list(self.conversation_keys()):
+            index.add_conversation(conv_key, self.conversation_participants(conv_key))
+            if index.indexed_count(conv_key) < self.last_seq(conv_key):
+                todo.append(conv_key)
+        fresh = [conv_key for conv_key in todo if index.indexed_count(conv_key) == 0]
+        fresh_total = sum(self.last_seq(conv_key) for conv_key in fresh)
+        if fresh_total >= self.parallel_index_threshold:
+            self.build_index_parallel(index, fresh)
+        for conv_key in todo:
+            conversation = self.read_conversation(conv_key)
+            for message in conversation[index.indexed_count(conv_key):]:
+                index.add(conv_key, message)
+        self.message_index = index
+        if index.records > 2 * len(index.timestamps) + self.index_save_threshold:
+            self.writer.call(self.compact_index)
+        elif todo:
+            self.writer.call(self.save_index)
+    
+    def save_index(self):
+        # Поток записи: в журнал дописываются только новые диапазоны переписок
+        self._index_save_pending = False
+        text = self.message_index.take_unsaved()
+        if text:
+            self.writer.write_append(self.index_file, text)
+    
+    def compact_index(self):
+        self.writer.close_file(self.index_file)
+        self.message_index.write(self.index_file)
+    
+    def schedule_index_save(self):
+        if self.message_index.unsaved_count >= self.index_save_threshold \
+                and not self._index_save_pending:
+            self._index_save_pending = True
+            self.writer.call(self.save_index)
+    
+    def build_index_parallel(self, index, conv_keys):
+        # Одна переписка - одна задача пула процессов. spawn вместо fork: в процессе
+        # уже работают потоки записи и загрузки, их блокировки не копируются
+        try:
+            context = multiprocessing.get_context('spawn')
+            workers = os.cpu_count() or 1
+            with ProcessPoolExecutor(workers, mp_context=context) as pool:
+                # Переписки читаются по мере готовности пула: в памяти их не больше
+                # двух на процесс, а не вся история
+                in_flight = deque()
+                for conv_key in conv_keys:
+                    conversation = self.read_conversation(conv_key)
+                    future = pool.submit(index_conversation,
+                                         [message.content for message in conversation])
+                    in_flight.append((conv_key, future,
+                                      [message.timestamp for message in conversation]))
+                    del conversation
+                    if len(in_flight) >= 2 * workers:
+                        self.merge_indexed(index, in_flight.popleft())
+                while in_flight:
+                    self.merge_indexed(index, in_flight.popleft())
+        except (OSError, ImportError, NotImplementedError, BrokenProcessPool):
+            # Без поддержки процессов (например, на Android) индексируем в этом потоке
+            logging.getLogger('shiligram').info("Пул процессов недоступен, индекс строится последовательно")
+    
+    @staticmethod
+    def merge_indexed(index, task):
+        conv_key, future, timestamps = task
+        index.merge(conv_key, future.result(), timestamps)
+    
+    def load_users(self):
+        self.users_signature = file_signature(self.users_file)
+        users = {}
+        if os.path.exists(self.users_file):
+            try:
+                with open(self.users_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                    for username, user_data in data.items():
+                        user = User(username, user_data['password'])
+                        user.contacts = ContactSet(user_data.get('contacts', ()))
+                        users[username] = user
+            except:
+                users = {}
+        if not os.path.exists(self.contacts_file) and any(user.contacts for user in users.values()):
+            # Контакты из users.json прежних версий переносятся в журнал
+            self.writer.call(lambda: self.compact_contacts(0, users))
+        self.replay_contacts(users)
+        return users
+    
+    def replay_contacts(self, users):
+        if not os.path.exists(self.contacts_file):
+            return
+        inode = os.stat(self.contacts_file).st_ino
+        offset = 0
+        for record, offset in self.read_journal(self.contacts_file):
+            self._contact_records += 1
+            user = users.get(record['user'])
+            if user is None:
+                continue
+            if record['op'] == 'remove':
+                user.contacts.discard(record['contact'])
+            else:
+                user.contacts.add(record['contact'])
+        self.contacts_position = (inode, offset)
+    
+    def load_messages(self):
+        messages = {}
+        if os.path.exists(self.archive_file):
+            # Переписки читаются из отображённого файла по запросу
+            self.archive = MessageArchive(self.archive_file)
+            messages = {conv_key: Conversation(self.archive.conversation(conv_key))
+                        for conv_key in self.archive.keys()}
+        elif os.path.exists(self.messages_file):
+            try:
+                with open(self.messages_file, 'r', encoding='utf-8') as f:
+                    messages = json.load(f)
+            except:
+                messages = {}
+        # Словари переводятся в столбцы по одной переписке, чтобы не держать обе копии
+        for conv_key in list(messages):
+            value = messages[conv_key]
+            if isinstance(value, dict):
+                # Начало переписки - ссылки на сжатые сегменты, распаковка при чтении
+                messages[conv_key] = Conversation.from_dicts(
+                    value['messages'], ColdConversation(self.cold_store, value['cold']))
+            elif not isinstance(value, Conversation):
+                messages[conv_key] = Conversation.from_dicts(value)
+        self.snapshot_signature = file_signature(self.snapshot_file())
+        # Снимок + журнал прерванного сжатия + текущий журнал
+        for path in (self.journal_file + '.old', self.journal_file):
+            self._journal_records += self.replay_journal(path, messages)
+        return messages
+    
+    def read_journal(self, path, offset=0):
+        # Полные записи журнала начиная с offset вместе с позицией после каждой
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Строку ещё дописывают или запись оборвалась: не сдвигаем позицию
+                    break
+                offset += len(line)
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                yield record, offset
+    
+    def replay_journal(self, path, messages):
+        if not os.path.exists(path):
+            return 0
+        count = 0
+        offset = 0
+        inode = os.stat(path).st_ino
+        for record, offset in self.read_journal(path):
+            conversation = messages.setdefault(record['conv'], Conversation())
+            conversation.append(Message.from_dict(record['message'], len(conversation) + 1))
+            count += 1
+        if path == self.journal_file:
+            self.journal_position = (inode, offset)
+        return count
+    
+    def save_users(self):
+        # Повторные сохранения до записи схлопываются в одно
+        with self._lock:
+            if self._users_save_pending:
+                return
+            self._users_save_pending = True
+        self.writer.call(self.write_users)
+    
+    def write_users(self):
+        # Поток записи, под блокировкой каталога: сначала чужие изменения, потом свои
+        self._users_save_pending = False
+        self.merge_users()
+        with self._lock:
+            data = {}
+            for username, user in self.users.items():
+                data[username] = {
+                    'password': user.password
+                }
+        self.writer.write_replace(self.users_file, data, 2)
+        self.users_signature = file_signature(self.users_file)
+    
+    def merge_users(self):
+        signature = file_signature(self.users_file)
+        if signature is None or signature == self.users_signature:
+            return
+        try:
+            with open(self.users_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except ValueError:
+            return
+        self.users_signature = signature
+        # Пользователи только добавляются, поэтому слияние - объединение;
+        # контакты приходят через журнал контактов
+        changes = []
+        with self._lock:
+            for username, user_data in data.items():
+                if username not in self.users:
+                    self.users[username] = User(username, user_data['password'])
+                    self.username_index.add(username)
+                    changes.append(('user', {'username': username}))
+        for kind, details in changes:
+            self.notify(kind, **details)
+    
+    def refresh(self):
+        # Подхватывает изменения других процессов; без изменений - только stat
+        if not self.messages_ready.is_set():
+            return
+        self.merge_users()
+        self.refresh_contacts()
+        self.refresh_groups()
+        self.refresh_messages()
+        self.schedule_index_save()
+    
+    def refresh_contacts(self):
+        if self._contacts_reload_pending:
+            return
+        inode, offset = self.contacts_position
+        try:
+            st = os.stat(self.contacts_file)
+        except OSError:
+            return
+        if inode is not None and st.st_ino != inode:
+            # Другой процесс сжал журнал: перечитываем его целиком в потоке записи
+            with self._lock:
+                if not self._contacts_reload_pending:
+                    self._contacts_reload_pending = True
+                    written = self._own_contact_count
+                    self.writer.call(lambda: self.reload_contacts(written))
+            return
+        if st.st_size > offset:
+            self.apply_contacts_tail()
+    
+    def apply_contacts_tail(self):
+        changes = []
+        with self._lock:
+            inode, offset = self.contacts_position
+            if not os.path.exists(self.contacts_file):
+                return
+            inode = os.stat(self.contacts_file).st_ino
+            for record, offset in self.read_journal(self.contacts_file, offset):
+                if record.get('origin') == self.origin:
+                    # Своя запись уже посчитана при постановке в очередь
+                    if self._own_contact_ops:
+                        self._own_contact_ops.popleft()
+                    continue
+                self._contact_records += 1
+                details = self.apply_contact_record(record)
+                if details is not None:
+                    changes.append(details)
+            self.contacts_position = (inode, offset)
+        for details in changes:
+            self.notify('contact', **details)
+    
+    def apply_contact_record(self, record):
+        # Чужое изменение контакта; возвращает данные события или None
+        user = self.users.get(record['user'])
+        if user is None:
+            return None
+        contact = record['contact']
+        if record['op'] == 'remove':
+            if not self.contact_graph.remove(user, contact):
+                return None
+            details = {'username': user.username, 'contact': contact, 'removed': True}
+        else:
+            if not self.contact_graph.add(user, contact):
+                return None
+            details = {'username': user.username, 'contact': contact}
+        self.contact_versions[user.username] = self.contact_versions.get(user.username, 0) + 1
+        return details
+    
+    def reload_contacts(self, written):
+        # Поток записи, под блокировкой каталога: свои записи до written уже в файле
+        self.merge_users()
+        changes = []
+        with self._lock:
+            self._contacts_reload_pending = False
+            self._own_contact_ops = deque(op for op in self._own_contact_ops if op[0] > written)
+            fresh = {username: User(username, user.password) for username, user in self.users.items()}
+            self._contact_records = 0
+            self.contacts_position = (None, 0)
+            self.replay_contacts(fresh)
+            # Свои изменения, которые ещё ждут записи, возвращаем поверх прочитанного
+            for number, username, contact, op in self._own_contact_ops:
+                if op == 'remove':
+                    fresh[username].contacts.discard(contact)
+                else:
+                    fresh[username].contacts.add(contact)
+            for username, user in self.users.items():
+                contacts = fresh[username].contacts
+                if list(contacts) == list(user.contacts):
+                    continue
+                for contact in user.contacts:
+                    if contact not in contacts:
+                        changes.append({'username': username, 'contact': contact, 'removed': True})
+                for contact in contacts:
+                    if contact not in user.contacts:
+                        changes.append({'username': username, 'contact': contact})
+                user.contacts = contacts
+                self.contact_versions[username] = self.contact_versions.get(username, 0) + 1
+            self.contact_graph = ContactGraph(self.users.values())
+        for details in changes:
+            self.notify('contact', **details)
+    
+    def compact_contacts(self, written, users=None):
+        # Поток записи: журнал заменяется текущими связями без истории изменений
+        if users is None:
+            # Сначала чужие изменения, иначе они пропадут при замене файла
+            signature = file_signature(self.contacts_file)
+            inode = self.contacts_position[0]
+            if inode is not None and (signature is None or signature[0] != inode):
+                self.reload_contacts(written)
+            else:
+                self.apply_contacts_tail()
+        with self._lock:
+            self._contacts_compaction_pending = False
+            if users is None:
+                users = self.users
+            self.writer.close_file(self.contacts_file)
+            tmp_file = self.contacts_file + '.tmp'
+            count = 0
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                for username, user in users.items():
+                    for contact in user.contacts:
+                        f.write(json.dumps({'user': username, 'contact': contact, 'op': 'add'},
+                                           ensure_ascii=False) + '\n')
+                        count += 1
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.contacts_file)
+            st = os.stat(self.contacts_file)
+            self.contacts_position = (st.st_ino, st.st_size)
+            self._contact_records = count
+    
+    def refresh_messages(self):
+        if self._compaction_pending or self._reload_pending:
+            return
+        inode, offset = self.journal_position
+        try:
+            st = os.stat(self.journal_file)
+        except OSError:
+            st = None
+        if file_signature(self.snapshot_file()) != self.snapshot_signature \
+                or inode is not None and (st is None or st.st_ino != inode):
+            # Другой процесс свернул журнал в снимок: перечитываем историю целиком
+            self.schedule_reload()
+            return
+        if st is not None and st.st_size > offset:
+            self.apply_journal_tail()
+    
+    def snapshot_file(self):
+        return self.archive_file if self.archive is not None else self.messages_file
+    
+    def apply_journal_tail(self):
+        # Применяет чужие записи журнала после запомненной позиции
+        applied = []
+        with self._lock:
+            inode, offset = self.journal_position
+            if not os.path.exists(self.journal_file):
+                return applied
+            inode = os.stat(self.journal_file).st_ino
+            for record, offset in self.read_journal(self.journal_file, offset):
+                if record.get('origin') == self.origin:
+                    # Своя запись уже на диске
+                    if self._own_records:
+                        self._own_records.popleft()
+                    continue
+                conv_key = record['conv']
+                if conv_key not in self.messages:
+                    self.messages[conv_key] = Conversation()
+                conversation = self.messages[conv_key]
+                message = Message.from_dict(record['message'], len(conversation) + 1)
+                conversation.append(message)
+                self._journal_records += 1
+                if self._compaction_pending:
+                    self._foreign_records.append((conv_key, message))
+                details = self.summarize_message(conv_key, message)
+                if details is not None:
+                    applied.append((conv_key, message, details))
+            self.journal_position = (inode, offset)
+        for conv_key, message, details in applied:
+            if self.search_ready.is_set():
+                self.message_index.add(conv_key, message)
+            self.notify('message', **details)
+        return applied
+    
+    def schedule_reload(self):
+        with self._lock:
+            if self._reload_pending:
+                return
+            self._reload_pending = True
+            # Всё, что поставлено в очередь до задачи, к её запуску уже на диске
+            written = self._own_count
+            self.writer.call(lambda: self.reload_messages(written))
+    
+    def reload_messages(self, written, snapshot=False):
+        # Поток записи, под блокировкой каталога
+        with self._lock:
+            self._journal_records = 0
+            old_archive = self.archive
+            messages = self.load_messages()
+            disk_copy = {key: msgs.copy() for key, msgs in messages.items()} if snapshot else None
+            # Свои сообщения, которые ещё ждут записи, возвращаем поверх прочитанного
+            self._own_records = deque(record for record in self._own_records
+                                      if record[0] > written)
+            self._foreign_records = []
+            for number, conv_key, message in self._own_records:
+                messages.setdefault(conv_key, Conversation()).append(message)
+            self.messages = messages
+            if old_archive is not None and old_archive is not self.archive:
+                old_archive.close()
+            self.build_summaries()
+            self.summary_versions = {username: self.summary_versions.get(username, 0) + 1
+                                     for username in self.summaries}
+            self._reload_pending = False
+        self.notify('reload')
+        return disk_copy
+    
+    def save_messages(self, messages=None):
+        if messages is None:
+            messages = self.messages
+        if self.archive is not None:
+            MessageArchive.write(self.archive_file, messages)
+            # Старое отображение держит удалённый файл: переписки переводятся на новый
+            # архив, в столбцах остаются только сообщения, пришедшие после снимка
+            archive = MessageArchive(self.archive_file)
+            with self._lock:
+                for conv_key in archive.keys():
+                    archived = archive.conversation(conv_key)
+                    live = self.messages.get(conv_key)
+                    if live is not None and len(archived) <= len(live):
+                        self.messages[conv_key] = live.with_archived(archived)
+                self.archive.close()
+                self.archive = archive
+            return
+        frozen = self.freeze_cold(messages) if self.cold_after is not None else {}
+        # Снимок пишется по одной переписке, без словарей для всей истории сразу
+        tmp_file = self.messages_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write('{')
+            for i, (conv_key, conversation) in enumerate(messages.items()):
+                if i:
+                    f.write(',')
+                f.write(json.dumps(conv_key, ensure_ascii=False) + ':')
+                if conv_key in frozen:
+                    conversation = conversation.with_archived(frozen[conv_key])
+                if isinstance(conversation.archived, ColdConversation):
+                    hot = conversation[conversation.archived_count():]
+                    json.dump({'cold': conversation.archived.segments,
+                               'messages': [message.to_dict() for message in hot]},
+                              f, ensure_ascii=False)
+                else:
+                    json.dump(conversation.to_dicts(), f, ensure_ascii=False)
+            f.write('}')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.messages_file)
+        # Снимок на диске ссылается на сегменты: столбцы в памяти больше не нужны
+        with self._lock:
+            for conv_key, archived in frozen.items():
+                live = self.messages.get(conv_key)
+                if live is not None and live.archived_count() < len(archived) <= len(live):
+                    self.messages[conv_key] = live.with_archived(archived)
+    
+    def freeze_cold(self, messages):
+        # Поток записи: целые сегменты старше cold_after сжимаются в messages.cold.
+        # Уже холодные сегменты не переписываются, сегменты без ссылок из снимка
+        # освобождают место для новых
+        cutoff = time.time() - self.cold_after
+        size = self.cold_segment_size
+        planned = []
+        for conv_key, conversation in messages.items():
+            start = end = conversation.archived_count()
+            while end + size <= len(conversation) \
+                    and conversation.message_at(end + size - 1).timestamp < cutoff:
+                end += size
+            if end > start:
+                planned.append((conv_key, conversation, start, end))
+        if not planned:
+            return {}
+        chunks = [conversation[i:i + size] for conv_key, conversation, start, end in planned
+                  for i in range(start, end, size)]
+        live = [segment for conversation in messages.values()
+                if isinstance(conversation.archived, ColdConversation)
+                for segment in conversation.archived.segments]
+        segments = iter(self.cold_store.write_segments(chunks, live, self.cold_codec))
+        frozen = {}
+        for conv_key, conversation, start, end in planned:
+            archived = conversation.archived
+            if archived is None:
+                archived = ColdConversation(self.cold_store, [])
+            frozen[conv_key] = archived.extend([next(segments) for i in range(start, end, size)])
+        return frozen
+    
+    def append_to_journal(self, conv_key, message):
+        line = json.dumps({'conv': conv_key, 'message': message.to_dict(), 'origin': self.origin},
+                          ensure_ascii=False)
+        with self._lock:
+            self.writer.append(self.journal_file, line + '\n')
+            self._journal_records += 1
+            self._own_count += 1
+            self._own_records.append((self._own_count, conv_key, message))
+        if self._journal_records >= self.compact_threshold:
+            self.compact_messages()
+    
+    def rotate_journal(self):
+        self.writer.close_file(self.journal_file)
+        if not os.path.exists(self.journal_file):
+            return
+        old_file = self.journal_file + '.old'
+        if os.path.exists(old_file):
+            # Предыдущее сжатие не завершилось: дописываем, а не затираем
+            with open(old_file, 'a', encoding='utf-8') as dst, \
+                    open(self.journal_file, 'r', encoding='utf-8') as src:
+                dst.write(src.read())
+            os.remove(self.journal_file)
+        else:
+            os.replace(self.journal_file, old_file)
+    
+    def compact_messages(self, background=True):
+        with self._lock:
+            if self._compaction_pending:
+                return
+            self._compaction_pending = True
+            self._journal_records = 0
+            self._foreign_records = []
+            written = self._own_count
+            # Под блокировкой запоминаются только длины переписок: они только
+            # дополняются, и столбцы копируются уже в потоке записи
+            lengths = [(key, msgs, len(msgs)) for key, msgs in self.messages.items()]
+            base_signature = self.snapshot_signature
+            
+            # Задача встаёт в очередь после всех уже принятых записей журнала,
+            # поэтому в ротированный журнал попадает ровно то, что есть в снимке
+            def write_snapshot():
+                try:
+                    # Под блокировкой каталога: записи других процессов не должны
+                    # потеряться при ротации журнала
+                    if file_signature(self.snapshot_file()) != base_signature:
+                        # Снимок уже переписал другой процесс: наша копия устарела
+                        snapshot = self.reload_messages(written, snapshot=True)
+                    else:
+                        snapshot = {key: msgs.prefix(count) for key, msgs, count in lengths}
+                        self.apply_journal_tail()
+                    with self._lock:
+                        for conv_key, message in self._foreign_records:
+                            snapshot.setdefault(conv_key, Conversation()).append(message)
+                        self._foreign_records = []
+                        self.rotate_journal()
+                        self.journal_position = (None, 0)
+                        self._own_records = deque(record for record in self._own_records
+                                                  if record[0] > written)
+                    self.save_messages(snapshot)
+                    self.snapshot_signature = file_signature(self.snapshot_file())
+                    old_file = self.journal_file + '.old'
+                    if os.path.exists(old_file):
+                        os.remove(old_file)
+                finally:
+                    self._compaction_pending = False
+            
+            self.writer.call(write_snapshot)
+        if not background:
+            self.writer.flush()
+    
+    def flush(self):
+        self.writer.flush()
+    
+    def close(self):
+        if self.loader is not None:
+            self.loader.join()
+        if self.search_ready.is_set():
+            self.writer.call(self.save_index)
+        self.writer.close()
+        self.file_lock.close()
+        self.cold_store.close()
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+    
+    def register_user(self, username, password):
+        self.users_ready.wait()
+        if username in self.users:
+            return False, "Пользователь с таким ником уже существует"
+        
+        if len(username) < 3:
+            return False, "Ник должен быть не менее 3 символов"
+        
+        if username.startswith(GROUP_PREFIX):
+            return False, f"Ник не может начинаться с {GROUP_PREFIX}"
+        
+        if len(password) < 4:
+            return False, "Пароль должен быть не менее 4 символов"
+        
+        self.users[username] = User(username, password)
+        self.username_index.add(username)
+        self.store_user(self.users[username])
+        self.notify('user', username=username)
+        return True, "Регистрация успешна!"
+    
+    def login_user(self, username, password):
+        self.users_ready.wait()
+        if username in self.users and self.users[username].password == password:
+            return True, "Вход выполнен!"
+        return False, "Неверный ник или пароль"
+    
+    def search_users(self, query, current_user, limit=50):
+        self.users_ready.wait()
+        return self.username_index.search(query, exclude=current_user, limit=limit)
+    
+    def add_contact(self, username, contact_username):
+        self.users_ready.wait()
+        if contact_username in self.users and contact_username != username:
+            if self.change_contacts(username, [contact_username], 'add'):
+                return True, f"{contact_username} добавлен в контакты!"
+        return False, "Пользователь не найден"
+    
+    def add_contacts(self, username, contact_usernames):
+        # Пачка контактов - одна запись на диск
+        self.users_ready.wait()
+        if username not in self.users:
+            return False, "Пользователь не найден"
+        contacts = [contact for contact in contact_usernames
+                    if contact in self.users and contact != username]
+        added = self.change_contacts(username, contacts, 'add')
+        return bool(added), f"Добавлено контактов: {len(added)}"
+    
+    def remove_contact(self, username, contact_username):
+        self.users_ready.wait()
+        if self.change_contacts(username, [contact_username], 'remove'):
+            return True, f"{contact_username} удалён из контактов"
+        return False, "Контакт не найден"
+    
+    def remove_contacts(self, username, contact_usernames):
+        self.users_ready.wait()
+        removed = self.change_contacts(username, contact_usernames, 'remove')
+        return bool(removed), f"Удалено контактов: {len(removed)}"
+    
+    def contacted_by(self, username):
+        # Кто добавил пользователя в контакты: по обратному индексу, без обхода всех
+        self.users_ready.wait()
+        with self._lock:
+            return list(self.contact_graph.contacted_by(username))
+    
+    def mutual_contacts(self, user1, user2):
+        self.users_ready.wait()
+        if user1 not in self.users or user2 not in self.users:
+            return []
+        with self._lock:
+            return ContactGraph.mutual(self.users[user1].contacts, self.users[user2].contacts)
+    
+    def change_contacts(self, username, contacts, op):
+        # Возвращает контакты, которые действительно добавились или удалились
+        user = self.users.get(username)
+        if user is None:
+            return []
+        changed = []
+        with self._lock:
+            for contact in contacts:
+                if op == 'remove':
+                    if self.contact_graph.remove(user, contact):
+                        changed.append(contact)
+                elif self.contact_graph.add(user, contact):
+                    changed.append(contact)
+            if changed:
+                self.contact_versions[username] = self.contact_versions.get(username, 0) + 1
+                self.store_contact_changes([(username, contact, op) for contact in changed])
+        for contact in changed:
+            if op == 'remove':
+                self.notify('contact', username=username, contact=contact, removed=True)
+            else:
+                self.notify('contact', username=username, contact=contact)
+        return changed
+    
+    def get_conversation_key(self, user1, user2):
+        # Переписка группы одна на всех участников
+        if user2 in self.groups:
+            return user2
+        return f"{min(user1, user2)}_{max(user1, user2)}"
+    
+    def send_message(self, sender, receiver, content, attachment=None):
+        # attachment - ссылка, которую вернул attachments.put
+        self.messages_ready.wait()
+        group = self.groups.get(receiver)
+        if group is not None:
+            if sender not in group.members:
+                return False, "Вы не состоите в этой группе"
+        elif receiver not in self.users:
+            return False, "Пользователь не найден"
+        if attachment is not None and not self.attachments.exists(attachment['hash']):
+            return False, "Вложение не найдено"
+        
+        conv_key = self.get_conversation_key(sender, receiver)
+        with self._lock:
+            message = Message.create(sender, content, self.last_seq(conv_key) + 1,
+                                     attachment=attachment)
+            if attachment is not None:
+                self.attachments.retain(attachment['hash'])
+            
+            self.store_message(conv_key, message)
+            self.store_last_message(conv_key, message)
+            if group is not None:
+                self.update_group_summary(group, message)
+            else:
+                self.update_summaries(sender, receiver, message)
+        if self.search_ready.is_set():
+            self.message_index.add_conversation(conv_key, None if group is not None else (
+                min(sender, receiver), max(sender, receiver)))
+            self.message_index.add(conv_key, message)
+        if group is not None:
+            self.notify('message', sender=sender, receiver=receiver, seq=message.seq, group=receiver)
+        else:
+            self.notify('message', sender=sender, receiver=receiver, seq=message.seq)
+        return True, "Сообщение отправлено!"
+    
+    def update_summaries(self, sender, receiver, message):
+        with self._lock:
+            for username, peer in ((sender, receiver), (receiver, sender)):
+                peers = self.summaries.setdefault(username, {})
+                if peer not in peers:
+                    peers[peer] = ConversationSummary(peer)
+                peers[peer].update(message)
+                self.summary_versions[username] = self.summary_versions.get(username, 0) + 1
+            # Своё сообщение отправитель уже прочитал
+            peers = self.summaries[sender]
+            peers[receiver].read_seq = message.seq
+    
+    def update_group_summary(self, group, message):
+        with self._lock:
+            group.summary.update(message)
+            group.read_seqs[message['sender']] = message['seq']
+            # Сводка одна на группу: участникам достаётся только новая версия списка чатов
+            for member in group.members:
+                self.summary_versions[member] = self.summary_versions.get(member, 0) + 1
+    
+    def summarize_message(self, conv_key, message):
+        # Сводки для сообщения другого процесса; возвращает данные события или None
+        group = self.groups.get(conv_key)
+        if group is not None:
+            self.update_group_summary(group, message)
+            return {'sender': message.sender, 'receiver': conv_key, 'seq': message.seq,
+                    'group': conv_key}
+        participants = self.conversation_participants(conv_key)
+        if participants is None:
+            return None
+        receiver = participants[1] if participants[0] == message.sender else participants[0]
+        self.update_summaries(message.sender, receiver, message)
+        return {'sender': message.sender, 'receiver': receiver, 'seq': message.seq}
+    
+    def get_chat_list(self, username):
+        # Контакты по времени последнего сообщения, без чтения истории
+        self.messages_ready.wait()
+        user = self.users.get(username)
+        if user is None:
+            return []
+        peers = self.summaries.get(username, {})
+        chats = [(contact, peers.get(contact)) for contact in list(user.contacts)]
+        with self._lock:
+            for key in self.member_groups.get(username, ()):
+                chats.append((key, self.groups[key].summary_for(username)))
+        chats.sort(key=lambda chat: (chat[1].timestamp, chat[1].activity) if chat[1] else ('', 0),
+                   reverse=True)
+        return chats
+    
+    def mark_read(self, username, peer):
+        self.messages_ready.wait()
+        with self._lock:
+            group = self.groups.get(peer)
+            if group is not None:
+                summary = group.summary_for(username) if username in group.members else None
+            else:
+                summary = self.summaries.get(username, {}).get(peer)
+            if summary is None or summary.read_seq >= summary.last_seq:
+                return False
+            summary.read_seq = summary.last_seq
+            if group is not None:
+                group.read_seqs[username] = summary.read_seq
+            self.summary_versions[username] = self.summary_versions.get(username, 0) + 1
+            self.store_read_cursor(username, peer, summary.read_seq)
+        self.notify('read', username=username, peer=peer, seq=summary.read_seq)
+        return True
+    
+    def search_messages(self, username, query, limit=20):
+        self.search_ready.wait()
+        results = []
+        with self._lock:
+            groups = list(self.member_groups.get(username, ()))
+        for conv_key, seq, score in self.message_index.search(username, query, limit, groups):
+            participants = None if conv_key in self.groups else \
+                self.conversation_participants(conv_key)
+            if participants is None:
+                # Сообщение группы: собеседник - сама группа
+                peer = conv_key
+            else:
+                peer = participants[1] if participants[0] == username else participants[0]
+            page = self.load_page(conv_key, seq + 1, 1)
+            if page:
+                results.append((peer, page[0]))
+        return results
+    
+    def conversation_participants(self, conv_key):
+        # Ключ "ник1_ник2" неоднозначен, если в нике есть "_": проверяем по пользователям
+        for i, char in enumerate(conv_key):
+            if char == '_':
+                user1, user2 = conv_key[:i], conv_key[i + 1:]
+                if user1 in self.users and user2 in self.users \
+                        and self.get_conversation_key(user1, user2) == conv_key:
+                    return user1, user2
+        return None
+    
+    def submit(self, func, callback=None):
+        # Тот же интерфейс, что у RemoteDatabase; локальная база отвечает сразу
+        result = func()
+        if callback is not None:
+            callback(result)
+    
+    def subscribe(self, callback):
+        self._listeners.append(callback)
+    
+    def unsubscribe(self, callback):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+    
+    def notify(self, kind, **details):
+        # Подписчики вызываются в потоке, изменившем данные
+        self.version += 1
+        for callback in list(self._listeners):
+            callback(kind, details)
+    
+    def get_messages(self, user1, user2, before=None, limit=None):
+        self.messages_ready.wait()
+        conv_key = self.get_conversation_key(user1, user2)
+        if not self.can_read(user1, conv_key):
+            return []
+        if before is None and limit is None:
+            return self.load_conversation(conv_key)
+        # Страница из limit сообщений с номером меньше before, от старых к новым
+        return self.load_page(conv_key, before, limit)
+    
+    def get_messages_since(self, user1, user2, seq):
+        self.messages_ready.wait()
+        conv_key = self.get_conversation_key(user1, user2)
+        if not self.can_read(user1, conv_key):
+            return []
+        return self.load_conversation_since(conv_key, seq)
+    
+    def can_read(self, username, conv_key):
+        group = self.groups.get(conv_key)
+        return group is None or username in group.members
+    
+    # Группы: состав меняется записями create / add / leave, свои записи
+    # применяются сразу, чужие - при refresh
+    def create_group(self, owner, title, members):
+        self.messages_ready.wait()
+        title = title.strip()
+        if not title:
+            return False, "Введите название группы"
+        if owner not in self.users:
+            return False, "Пользователь не найден"
+        unknown = [member for member in members if member not in self.users]
+        if unknown:
+            return False, f"Пользователи не найдены: {', '.join(unknown)}"
+        key = Group.new_key()
+        self.change_group({'op': 'create', 'group': key, 'title': title, 'owner': owner,
+                           'members': list(dict.fromkeys([owner] + list(members)))})
+        return True, key
+    
+    def add_group_members(self, group_key, username, members):
+        self.messages_ready.wait()
+        group = self.groups.get(group_key)
+        if group is None or username not in group.members:
+            return False, "Вы не состоите в этой группе"
+        unknown = [member for member in members if member not in self.users]
+        if unknown:
+            return False, f"Пользователи не найдены: {', '.join(unknown)}"
+        if not self.change_group({'op': 'add', 'group': group_key, 'members': list(members)}):
+            return False, "Все уже состоят в группе"
+        return True, "Участники добавлены"
+    
+    def leave_group(self, group_key, username):
+        self.messages_ready.wait()
+        if not self.change_group({'op': 'leave', 'group': group_key, 'members': [username]}):
+            return False, "Вы не состоите в этой группе"
+        return True, "Вы вышли из группы"
+    
+    def group_members(self, group_key):
+        with self._lock:
+            group = self.groups.get(group_key)
+            return list(group.members) if group is not None else []
+    
+    def change_group(self, record):
+        with self._lock:
+            changed = self.apply_group_record(record)
+            if changed:
+                # В журнал попадают только действительно изменившиеся участники
+                record['members'] = changed
+                record['origin'] = self.origin
+                self.store_group_record(record)
+        if changed:
+            self.notify('group', group=record['group'], members=changed)
+        return changed
+    
+    def apply_group_record(self, record):
+        # Возвращает участников, чьё членство изменилось
+        key = record['group']
+        group = self.groups.get(key)
+        if record['op'] == 'create' and group is None:
+            group = self.groups[key] = Group(key, record['title'], record['owner'])
+            if self.messages_ready.is_set():
+                # Группу другого процесса могли успеть заполнить сообщениями
+                msg = self.last_message(key)
+                if msg is not None:
+                    group.summary.update(msg)
+        if group is None:
+            return []
+        changed = []
+        for member in record['members']:
+            if record['op'] == 'leave':
+                if member not in group.members:
+                    continue
+                del group.members[member]
+                self.member_groups.get(member, set()).discard(key)
+                group.read_seqs.pop(member, None)
+            else:
+                if member in group.members:
+                    continue
+                group.members[member] = None
+                self.member_groups.setdefault(member, set()).add(key)
+            self.summary_versions[member] = self.summary_versions.get(member, 0) + 1
+            changed.append(member)
+        return changed
+    
+    def load_groups(self):
+        with self._lock:
+            self.groups = {}
+            self.member_groups = {}
+            for record in self.load_group_records():
+                self.apply_group_record(record)
+    
+    def refresh_groups(self):
+        try:
+            size = os.path.getsize(self.groups_file)
+        except OSError:
+            return
+        if size <= self.groups_position:
+            return
+        changes = []
+        with self._lock:
+            for record, offset in self.read_journal(self.groups_file, self.groups_position):
+                self.groups_position = offset
+                if record.get('origin') == self.origin:
+                    continue
+                changed = self.apply_group_record(record)
+                if changed:
+                    changes.append({'group': record['group'], 'members': changed})
+        for details in changes:
+            self.notify('group', **details)
+    
+    # Пакетный импорт и экспорт (см. bulk.py): на диск пишется пачка, а не сообщение
+    def import_users(self, users):
+        # Существующие пользователи не перезаписываются, контакты объединяются;
+        # контакты на себя, на неизвестных пользователей и на группы отбрасываются
+        users = list(users)
+        added = []
+        changes = []
+        with self._lock:
+            # Сначала вся пачка: контакты могут ссылаться на ники дальше в ней
+            for user in users:
+                if user.username not in self.users:
+                    self.users[user.username] = User(user.username, user.password)
+                    self.username_index.add(user.username)
+                    added.append(self.users[user.username])
+            for user in users:
+                existing = self.users[user.username]
+                for contact in user.contacts:
+                    if contact == user.username or contact not in self.users:
+                        continue
+                    if self.contact_graph.add(existing, contact):
+                        changes.append((user.username, contact, 'add'))
+                        self.contact_versions[user.username] = \
+                            self.contact_versions.get(user.username, 0) + 1
+            if added:
+                self.store_users(added)
+            if changes:
+                self.store_contact_changes(changes)
+    
+    def import_messages(self, records, batch_size=10000, progress=None):
+        # records - пары (ключ переписки, словарь сообщения); номера выдаются заново
+        self.messages_ready.wait()
+        count = 0
+        batch = []
+        for conv_key, msg in records:
+            batch.append((conv_key, msg))
+            if len(batch) >= batch_size:
+                count += self.import_indexed(batch)
+                batch = []
+                if progress is not None:
+                    progress(count)
+        if batch:
+            count += self.import_indexed(batch)
+            if progress is not None:
+                progress(count)
+        self.finish_import()
+        return count
+    
+    def import_indexed(self, batch):
+        imported = self.import_batch(batch)
+        # В таблицу последних сообщений - по строке на переписку пачки
+        last = {}
+        for conv_key, message in imported:
+            last[conv_key] = message
+        with self._lock:
+            for conv_key, message in last.items():
+                self.store_last_message(conv_key, message)
+        if self.search_ready.is_set():
+            for conv_key, message in imported:
+                self.message_index.add_conversation(conv_key, self.conversation_participants(conv_key))
+                self.message_index.add(conv_key, message)
+        return len(imported)
+    
+    def import_batch(self, batch):
+        # Пачка уходит в журнал одной записью; снимок пишется один раз в finish_import
+        lines = []
+        imported = []
+        with self._lock:
+            for conv_key, msg in batch:
+                conversation = self.messages.get(conv_key)
+                if conversation is None:
+                    conversation = self.messages[conv_key] = Conversation()
+                message = Message.from_dict(msg, len(conversation) + 1)
+                conversation.append(message)
+                imported.append((conv_key, message))
+                lines.append(json.dumps({'conv': conv_key, 'message': message.to_dict(),
+                                         'origin': self.origin}, ensure_ascii=False) + '\n')
+                self._own_count += 1
+                self._own_records.append((self._own_count, conv_key, message))
+            self._journal_records += len(batch)
+            self.writer.append(self.journal_file, ''.join(lines))
+            self.retain_imported(imported)
+        self.writer.flush()
+        # Пачка на диске: проходим её в журнале, чтобы очередь своих записей не росла
+        self.apply_journal_tail()
+        return imported
+    
+    def retain_imported(self, imported):
+        # Импортированные сообщения держат вложения так же, как отправленные
+        digests = [message.attachment['hash'] for conv_key, message in imported
+                   if message.attachment is not None]
+        if digests:
+            self.attachments.retain_all(digests)
+    
+    def finish_import(self):
+        if self._journal_records >= self.compact_threshold:
+            self.compact_messages(background=False)
+        self.flush()
+        with self._lock:
+            self.build_summaries()
+            self.summary_versions = {username: self.summary_versions.get(username, 0) + 1
+                                     for username in self.summaries}
+        self.notify('reload')
+    
+    def export_groups(self):
+        # Текущий состав групп записями create, как в сжатом журнале
+        self.messages_ready.wait()
+        with self._lock:
+            return [{'op': 'create', 'group': group.key, 'title': group.title,
+                     'owner': group.owner, 'members': list(group.members)}
+                    for group in self.groups.values()]
+    
+    def import_groups(self, records):
+        # Группы создаются через журнал состава, как при обычной работе;
+        # в уже существующую группу только добавляются участники
+        self.messages_ready.wait()
+        for record in records:
+            members = [member for member in record['members'] if member in self.users]
+            self.change_group({'op': 'create', 'group': record['group'], 'title': record['title'],
+                               'owner': record['owner'], 'members': members})
+    
+    def export_read_cursors(self):
+        # Тройки (ник, собеседник или ключ группы, номер прочитанного сообщения)
+        self.messages_ready.wait()
+        with self._lock:
+            cursors = [(username, peer, summary.read_seq)
+                       for username, peers in self.summaries.items()
+                       for peer, summary in peers.items() if summary.read_seq]
+            cursors.extend((username, group.key, seq) for group in self.groups.values()
+                           for username, seq in group.read_seqs.items() if seq)
+        return cursors
+    
+    def import_read_cursors(self, cursors):
+        # Вызывается до импорта сообщений переписки: номера сдвигаются на число
+        # уже бывших в ней сообщений; сводки пересчитываются в finish_import
+        self.messages_ready.wait()
+        with self._lock:
+            for username, peer, seq in cursors:
+                conv_key = self.get_conversation_key(username, peer)
+                self.store_read_cursor(username, peer, self.last_seq(conv_key) + seq)
+    
+    def export_messages(self):
+        # По одной переписке за раз, от старых сообщений к новым
+        self.messages_ready.wait()
+        for conv_key in list(self.conversation_keys()):
+            for message in self.read_conversation(conv_key):
+                yield conv_key, message
+    
+    # Точки расширения для других хранилищ (см. SQLiteDatabase)
+    def store_user(self, user):
+        self.save_users()
+    
+    def store_users(self, users):
+        self.save_users()
+    
+    def store_contact_changes(self, changes):
+        # changes - тройки (ник, контакт, 'add' или 'remove'); вызывается под self._lock
+        lines = []
+        for username, contact, op in changes:
+            self._own_contact_count += 1
+            self._own_contact_ops.append((self._own_contact_count, username, contact, op))
+            lines.append(json.dumps({'user': username, 'contact': contact, 'op': op,
+                                     'origin': self.origin}, ensure_ascii=False) + '\n')
+        self._contact_records += len(lines)
+        self.writer.append(self.contacts_file, ''.join(lines))
+        if self._contact_records >= self.contact_graph.edges + self.compact_threshold \
+                and not self._contacts_compaction_pending:
+            # Записей о давно удалённых и повторных связях стало много
+            self._contacts_compaction_pending = True
+            written = self._own_contact_count
+            self.writer.call(lambda: self.compact_contacts(written))
+    
+    def store_message(self, conv_key, message):
+        if conv_key not in self.messages:
+            self.messages[conv_key] = Conversation()
+        
+        self.messages[conv_key].append(message)
+        self.append_to_journal(conv_key, message)
+    
+    def load_conversation(self, conv_key):
+        if conv_key in self.messages:
+            return self.messages[conv_key]
+        return []
+    
+    def conversation_keys(self):
+        return self.messages.keys()
+    
+    def last_message(self, conv_key):
+        page = self.load_page(conv_key, None, 1)
+        return page[0] if page else None
+    
+    def store_group_record(self, record):
+        self.writer.append(self.groups_file, json.dumps(record, ensure_ascii=False) + '\n')
+    
+    def load_group_records(self):
+        records = []
+        self.groups_position = 0
+        if os.path.exists(self.groups_file):
+            for record, offset in self.read_journal(self.groups_file):
+                records.append(record)
+                self.groups_position = offset
+        return records
+    
+    @staticmethod
+    def summary_row(msg):
+        # Из сообщения - только то, что нужно сводке: текст не длиннее сниппета
+        row = msg.to_dict() if isinstance(msg, Message) else dict(msg)
+        row['content'] = row['content'][:ConversationSummary.SNIPPET_LENGTH + 1]
+        return row
+    
+    @staticmethod
+    def merge_last_message(table, conv_key, msg):
+        current = table.get(conv_key)
+        if current is None or msg['seq'] >= current['seq']:
+            table[conv_key] = msg
+    
+    def store_last_message(self, conv_key, message):
+        self.writer.append(self.summaries_file, json.dumps(
+            {'conv': conv_key, 'message': self.summary_row(message)}, ensure_ascii=False) + '\n')
+    
+    def load_last_messages(self):
+        # Журнал-таблица: по переписке побеждает запись с большим номером;
+        # None - таблицы ещё нет
+        if not os.path.exists(self.summaries_file):
+            return None
+        table = {}
+        lines = 0
+        for record, offset in self.read_journal(self.summaries_file):
+            self.merge_last_message(table, record['conv'], record['message'])
+            lines += 1
+        if lines > 2 * len(table) + self.compact_threshold:
+            self.writer.call(lambda: self.write_last_messages(table))
+        return table
+    
+    def write_last_messages(self, table):
+        # Поток записи, под блокировкой каталога: строки, дописанные после чтения
+        # таблицы этим или другим процессом, не теряются
+        self.writer.close_file(self.summaries_file)
+        table = dict(table)
+        if os.path.exists(self.summaries_file):
+            for record, offset in self.read_journal(self.summaries_file):
+                self.merge_last_message(table, record['conv'], record['message'])
+        tmp_file = self.summaries_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            for conv_key, msg in table.items():
+                f.write(json.dumps({'conv': conv_key, 'message': msg}, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.summaries_file)
+    
+    def store_read_cursor(self, username, peer, seq):
+        self.writer.append(self.cursors_file, json.dumps(
+            {'user': username, 'peer': peer, 'seq': seq}, ensure_ascii=False) + '\n')
+    
+    def compact_read_cursors(self, cursors):
+        # Выполняется в потоке записи: старые записи курсоров отбрасываются
+        self.writer.close_file(self.cursors_file)
+        tmp_file = self.cursors_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            for (username, peer), seq in cursors.items():
+                f.write(json.dumps({'user': username, 'peer': peer, 'seq': seq},
+                                   ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.cursors_file)
+    
+    def load_read_cursors(self):
+        # Журнал курсоров: последняя запись для пары побеждает
+        cursors = {}
+        lines = 0
+        if os.path.exists(self.cursors_file):
+            with open(self.cursors_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    cursors[record['user'], record['peer']] = record['seq']
+                    lines += 1
+        if lines > 2 * len(cursors) + self.compact_threshold:
+            self.writer.call(lambda: self.compact_read_cursors(cursors))
+        return [(username, peer, seq) for (username, peer), seq in cursors.items()]
+    
+    def read_conversation(self, conv_key):
+        # Полное чтение для фоновых задач; хранилища с кэшем читают мимо него
+        return self.load_conversation(conv_key)
+    
+    def load_conversation_since(self, conv_key, seq):
+        # Номера идут подряд с единицы, поэтому seq - это и позиция в списке
+        return self.load_conversation(conv_key)[seq:]
+    
+    def load_page(self, conv_key, before, limit):
+        messages = self.load_conversation(conv_key)
+        end = len(messages) if before is None else max(min(before - 1, len(messages)), 0)
+        start = 0 if limit is None else max(end - limit, 0)
+        return messages[start:end]
+    
+    def last_seq(self, conv_key):
+        return len(self.load_conversation(conv_key))
+
+class SQLiteDatabase(Database):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS contacts (
+            id INTEGER PRIMARY KEY,
+            username TEXT NOT NULL,
+            contact TEXT NOT NULL,
+            UNIQUE (username, contact)
+        );
+        CREATE INDEX IF NOT EXISTS contacts_contact ON contacts (contact);
+        CREATE TABLE IF NOT EXISTS removed_contacts (
+            id INTEGER PRIMARY KEY,
+            username TEXT NOT NULL,
+            contact TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            conversation TEXT NOT NULL,
+            sender TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            seq INTEGER NOT NULL DEFAULT 0,
+            attachment TEXT
+        );
+        CREATE INDEX IF NOT EXISTS messages_conversation
+            ON messages (conversation, timestamp);
+        CREATE TABLE IF NOT EXISTS read_cursors (
+            username TEXT NOT NULL,
+            peer TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            PRIMARY KEY (username, peer)
+        );
+        CREATE TABLE IF NOT EXISTS groups (
+            id TEXT PRIMARY KEY,
+            title TEXT NOT NULL,
+            owner TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS group_members (
+            id INTEGER PRIMARY KEY,
+            group_id TEXT NOT NULL,
+            username TEXT NOT NULL,
+            UNIQUE (group_id, username)
+        );
+        CREATE INDEX IF NOT EXISTS group_members_username
+            ON group_members (username);
+        CREATE TABLE IF NOT EXISTS group_changes (
+            id INTEGER PRIMARY KEY,
+            record TEXT NOT NULL
+        );
+    """
+    INSERT_USER = "INSERT INTO users (username, password) VALUES (?, ?)"
+    INSERT_CONTACT = "INSERT OR IGNORE INTO contacts (username, contact) VALUES (?, ?)"
+    DELETE_CONTACT = "DELETE FROM contacts WHERE username = ? AND contact = ?"
+    INSERT_REMOVED_CONTACT = "INSERT INTO removed_contacts (username, contact) VALUES (?, ?)"
+    INSERT_MESSAGE = ("INSERT INTO messages (conversation, sender, content, timestamp, seq, "
+                      "attachment) VALUES (?, ?, ?, ?, ?, ?)")
+    SELECT_MESSAGES = ("SELECT sender, content, timestamp, seq, attachment FROM messages "
+                       "WHERE conversation = ? AND seq > ? ORDER BY seq")
+    SELECT_PAGE = ("SELECT sender, content, timestamp, seq, attachment FROM messages "
+                   "WHERE conversation = ? AND seq < ? ORDER BY seq DESC LIMIT ?")
+    SELECT_LAST_SEQ = "SELECT MAX(seq) FROM messages WHERE conversation = ?"
+    SELECT_LAST_MESSAGES = ("SELECT messages.conversation, sender, content, timestamp, messages.seq, "
+                            "attachment FROM messages JOIN (SELECT conversation, MAX(seq) AS seq "
+                            "FROM messages GROUP BY conversation) AS last "
+                            "ON messages.conversation = last.conversation AND messages.seq = last.seq")
+    REPLACE_READ_CURSOR = "INSERT OR REPLACE INTO read_cursors (username, peer, seq) VALUES (?, ?, ?)"
+    INSERT_GROUP = "INSERT OR IGNORE INTO groups (id, title, owner) VALUES (?, ?, ?)"
+    INSERT_GROUP_MEMBER = "INSERT OR IGNORE INTO group_members (group_id, username) VALUES (?, ?)"
+    DELETE_GROUP_MEMBER = "DELETE FROM group_members WHERE group_id = ? AND username = ?"
+    
+    SYNCHRONOUS = {'write': 'FULL', 'batch': 'NORMAL', 'timer': 'OFF'}
+    
+    def __init__(self, db_file="shiligram.db", durability='batch', background=False):
+        self.db_file = db_file
+        # Последние увиденные строки: другие процессы пишут в ту же базу
+        self.data_version = None
+        self.last_rows = {'users': 0, 'contacts': 0, 'removed_contacts': 0, 'messages': 0,
+                          'group_changes': 0}
+        self._own_messages = set()
+        # Записи уходят в поток записи; сообщения до записи читаются из памяти
+        self.pending_writes = []
+        self.unflushed = {}
+        # Запросы - константные строки, sqlite3 кэширует их подготовленные версии
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(f"PRAGMA synchronous={self.SYNCHRONOUS[durability]}")
+        self.conn.executescript(self.SCHEMA)
+        self.upgrade_schema()
+        # Отдельное соединение потока записи: коммит и fsync идут без self._lock,
+        # чтение с основного соединения видит снимок WAL и не ждёт их
+        self.write_conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.write_conn.execute(f"PRAGMA synchronous={self.SYNCHRONOUS[durability]}")
+        super().__init__(durability, background)
+    
+    def upgrade_schema(self):
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(messages)")]
+        if 'seq' not in columns:
+            # База из версии без номеров: нумеруем сообщения в порядке вставки
+            with self.conn:
+                self.conn.execute(
+                    "ALTER TABLE messages ADD COLUMN seq INTEGER NOT NULL DEFAULT 0")
+                self.conn.execute("""
+                    UPDATE messages SET seq = numbered.seq FROM (
+                        SELECT id, ROW_NUMBER() OVER (
+                            PARTITION BY conversation ORDER BY id) AS seq
+                        FROM messages
+                    ) AS numbered
+                    WHERE messages.id = numbered.id
+                """)
+        if 'attachment' not in columns:
+            with self.conn:
+                self.conn.execute("ALTER TABLE messages ADD COLUMN attachment TEXT")
+        self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS messages_seq "
+                          "ON messages (conversation, seq)")
+        self.full_text = self.create_full_text()
+    
+    def create_full_text(self):
+        # Полнотекстовый индекс в самой базе; без FTS5 - общий индекс в памяти
+        exists = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone() is not None
+        try:
+            with self.conn:
+                self.conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+                                  "content, content='messages', content_rowid='id')")
+                self.conn.execute("CREATE TRIGGER IF NOT EXISTS messages_fts_insert "
+                                  "AFTER INSERT ON messages BEGIN "
+                                  "INSERT INTO messages_fts (rowid, content) "
+                                  "VALUES (new.id, new.content); END")
+                if not exists:
+                    # История, записанная до появления индекса
+                    self.conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+        except sqlite3.OperationalError:
+            logging.getLogger('shiligram').info("FTS5 недоступен, индекс поиска строится в памяти")
+            return False
+        return True
+    
+    @staticmethod
+    def message_row(sender, content, timestamp, seq, attachment):
+        # Ссылка на вложение хранится в столбце как JSON
+        msg = {'sender': sender, 'content': content, 'timestamp': timestamp, 'seq': seq}
+        if attachment is not None:
+            msg['attachment'] = json.loads(attachment)
+        return msg
+    
+    @staticmethod
+    def attachment_column(attachment):
+        return json.dumps(attachment, ensure_ascii=False) if attachment is not None else None
+    
+    def load_users(self):
+        self.data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        for table, column in (('users', 'rowid'), ('contacts', 'id'), ('removed_contacts', 'id'),
+                              ('messages', 'id')):
+            self.last_rows[table] = self.conn.execute(
+                f"SELECT MAX({column}) FROM {table}").fetchone()[0] or 0
+        users = {}
+        for username, password in self.conn.execute("SELECT username, password FROM users"):
+            users[username] = User(username, password)
+        for username, contact in self.conn.execute(
+                "SELECT username, contact FROM contacts ORDER BY id"):
+            if username in users:
+                users[username].contacts.add(contact)
+        return users
+    
+    def load_messages(self):
+        # История остаётся на диске и читается по запросу
+        return {}
+    
+    def build_message_index(self):
+        if self.full_text:
+            self.message_index = FullTextIndex(self)
+        else:
+            super().build_message_index()
+    
+    def queue_write(self, func, *args):
+        # Всё, что накопилось до запуска задачи, пишется одной транзакцией
+        with self._lock:
+            self.pending_writes.append((func, args))
+            if len(self.pending_writes) == 1:
+                self.writer.call(self.write_queued)
+    
+    def write_queued(self):
+        # Поток записи, под блокировкой каталога; self._lock берётся только для
+        # обмена очередями, транзакция идёт на своём соединении
+        with self._lock:
+            writes, self.pending_writes = self.pending_writes, []
+        written = []
+        try:
+            with self.write_conn:
+                for func, args in writes:
+                    try:
+                        if func == self.write_message:
+                            written.append(func(*args))
+                        else:
+                            func(*args)
+                    except sqlite3.Error:
+                        logging.getLogger('shiligram').exception("Ошибка записи в базу")
+        finally:
+            # После коммита строки видны с основного соединения: сообщения уходят
+            # из unflushed, а их строки refresh пропустит как свои
+            with self._lock:
+                for func, args in writes:
+                    if func == self.write_message:
+                        self.forget_unflushed(*args)
+                self._own_messages.update(row_id for row_id in written
+                                          if row_id > self.last_rows['messages'])
+    
+    def forget_unflushed(self, conv_key, message):
+        pending = self.unflushed[conv_key]
+        pending.remove(message)
+        if not pending:
+            del self.unflushed[conv_key]
+    
+    def is_unflushed(self, conv_key, message):
+        # Своя строка, закоммиченная, но ещё не убранная из unflushed
+        return any(pending.seq == message.seq and pending.to_dict() == message.to_dict()
+                   for pending in self.unflushed.get(conv_key, ()))
+    
+    def store_user(self, user):
+        self.queue_write(self.write_conn.execute, self.INSERT_USER, (user.username, user.password))
+    
+    def store_users(self, users):
+        # Пачка импорта: ник мог успеть занять другой процесс
+        self.queue_write(self.write_conn.executemany,
+                         "INSERT OR IGNORE INTO users (username, password) VALUES (?, ?)",
+                         [(user.username, user.password) for user in users])
+    
+    def store_contact_changes(self, changes):
+        # Удаления записываются отдельно: иначе другие процессы их не заметят
+        added = [(username, contact) for username, contact, op in changes if op != 'remove']
+        removed = [(username, contact) for username, contact, op in changes if op == 'remove']
+        self.queue_write(self.write_contact_changes, added, removed)
+    
+    def write_contact_changes(self, added, removed):
+        self.write_conn.executemany(self.INSERT_CONTACT, added)
+        self.write_conn.executemany(self.DELETE_CONTACT, removed)
+        self.write_conn.executemany(self.INSERT_REMOVED_CONTACT, removed)
+    
+    def store_message(self, conv_key, message):
+        with self._lock:
+            self.unflushed.setdefault(conv_key, []).append(message)
+            self.queue_write(self.write_message, conv_key, message)
+    
+    def write_message(self, conv_key, message):
+        # Возвращает номер строки; из unflushed сообщение убирает write_queued
+        while True:
+            try:
+                return self.write_conn.execute(self.INSERT_MESSAGE, (
+                    conv_key, message['sender'], message['content'], message['timestamp'],
+                    message['seq'], self.attachment_column(message.attachment))).lastrowid
+            except sqlite3.IntegrityError:
+                # Номер успел занять другой процесс
+                message.seq = (self.write_conn.execute(
+                    self.SELECT_LAST_SEQ, (conv_key,)).fetchone()[0] or 0) + 1
+    
+    def load_conversation(self, conv_key):
+        return self.load_conversation_since(conv_key, 0)
+    
+    def load_conversation_since(self, conv_key, seq):
+        with self._lock:
+            rows = self.conn.execute(self.SELECT_MESSAGES, (conv_key, seq)).fetchall()
+            pending = [message.to_dict() for message in self.unflushed.get(conv_key, ())
+                       if message.seq > seq]
+        # Закоммиченное, но ещё не убранное из unflushed, не повторяется
+        pending_seqs = {msg['seq'] for msg in pending}
+        return [self.message_row(*row) for row in rows if row[3] not in pending_seqs] + pending
+    
+    def load_page(self, conv_key, before, limit):
+        with self._lock:
+            pending = [message.to_dict() for message in self.unflushed.get(conv_key, ())
+                       if before is None or message.seq < before]
+            rows = self.conn.execute(self.SELECT_PAGE, (
+                conv_key, 2 ** 62 if before is None else before,
+                -1 if limit is None else max(limit - len(pending), 0))).fetchall()
+        pending_seqs = {msg['seq'] for msg in pending}
+        page = [self.message_row(*row) for row in reversed(rows)
+                if row[3] not in pending_seqs] + pending
+        return page if limit is None else page[max(len(page) - limit, 0):]
+    
+    def last_seq(self, conv_key):
+        with self._lock:
+            pending = self.unflushed.get(conv_key)
+            if pending:
+                return pending[-1].seq
+            return self.stored_last_seq(conv_key)
+    
+    def stored_last_seq(self, conv_key):
+        with self._lock:
+            return self.conn.execute(self.SELECT_LAST_SEQ, (conv_key,)).fetchone()[0] or 0
+    
+    def conversation_keys(self):
+        with self._lock:
+            keys = [row[0] for row in self.conn.execute(
+                "SELECT DISTINCT conversation FROM messages")]
+            stored = set(keys)
+            return keys + [conv_key for conv_key in self.unflushed if conv_key not in stored]
+    
+    def read_conversation(self, conv_key):
+        return [Message.from_dict(msg, msg['seq']) for msg in self.load_conversation(conv_key)]
+    
+    def refresh(self):
+        # data_version меняется после коммитов других соединений, в том числе write_conn
+        if not self.messages_ready.is_set():
+            return
+        self.schedule_index_save()
+        changes = []
+        with self._lock:
+            version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            if version == self.data_version:
+                return
+            self.data_version = version
+            for rowid, username, password in self.conn.execute(
+                    "SELECT rowid, username, password FROM users WHERE rowid > ? ORDER BY rowid",
+                    (self.last_rows['users'],)).fetchall():
+                self.last_rows['users'] = rowid
+                if username not in self.users:
+                    self.users[username] = User(username, password)
+                    self.username_index.add(username)
+                    changes.append(('user', {'username': username}))
+            for row_id, username, contact in self.conn.execute(
+                    "SELECT id, username, contact FROM contacts WHERE id > ? ORDER BY id",
+                    (self.last_rows['contacts'],)).fetchall():
+                self.last_rows['contacts'] = row_id
+                user = self.users.get(username)
+                if user is not None and self.contact_graph.add(user, contact):
+                    self.contact_versions[username] = self.contact_versions.get(username, 0) + 1
+                    changes.append(('contact', {'username': username, 'contact': contact}))
+            for row_id, username, contact in self.conn.execute(
+                    "SELECT id, username, contact FROM removed_contacts WHERE id > ? ORDER BY id",
+                    (self.last_rows['removed_contacts'],)).fetchall():
+                self.last_rows['removed_contacts'] = row_id
+                user = self.users.get(username)
+                if user is None or self.conn.execute(
+                        "SELECT 1 FROM contacts WHERE username = ? AND contact = ?",
+                        (username, contact)).fetchone() is not None:
+                    # Контакт успели добавить снова
+                    continue
+                if self.contact_graph.remove(user, contact):
+                    self.contact_versions[username] = self.contact_versions.get(username, 0) + 1
+                    changes.append(('contact', {'username': username, 'contact': contact,
+                                                'removed': True}))
+            for row_id, record in self.conn.execute(
+                    "SELECT id, record FROM group_changes WHERE id > ? ORDER BY id",
+                    (self.last_rows['group_changes'],)).fetchall():
+                self.last_rows['group_changes'] = row_id
+                record = json.loads(record)
+                if record.get('origin') == self.origin:
+                    continue
+                changed = self.apply_group_record(record)
+                if changed:
+                    changes.append(('group', {'group': record['group'], 'members': changed}))
+            for row_id, conv_key, sender, content, timestamp, seq, attachment in self.conn.execute(
+                    "SELECT id, conversation, sender, content, timestamp, seq, attachment "
+                    "FROM messages WHERE id > ? ORDER BY id",
+                    (self.last_rows['messages'],)).fetchall():
+                self.last_rows['messages'] = row_id
+                if row_id in self._own_messages:
+                    self._own_messages.discard(row_id)
+                    continue
+                message = Message.from_dict(
+                    self.message_row(sender, content, timestamp, seq, attachment), seq)
+                if self.is_unflushed(conv_key, message):
+                    continue
+                details = self.summarize_message(conv_key, message)
+                if details is None:
+                    continue
+                if self.search_ready.is_set():
+                    self.message_index.add_conversation(conv_key,
+                                                        self.conversation_participants(conv_key))
+                    self.message_index.add(conv_key, message)
+                changes.append(('message', details))
+        for kind, details in changes:
+            self.notify(kind, **details)
+    
+    def store_last_message(self, conv_key, message):
+        # Таблица последних сообщений - сама база
+        pass
+    
+    def load_last_messages(self):
+        # Один запрос по индексу (conversation, seq) вместо запроса на переписку
+        with self._lock:
+            table = {row[0]: self.summary_row(self.message_row(*row[1:]))
+                     for row in self.conn.execute(self.SELECT_LAST_MESSAGES)}
+            for conv_key, pending in self.unflushed.items():
+                table[conv_key] = self.summary_row(pending[-1])
+        return table
+    
+    def write_last_messages(self, table):
+        pass
+    
+    def store_read_cursor(self, username, peer, seq):
+        self.queue_write(self.write_conn.execute, self.REPLACE_READ_CURSOR, (username, peer, seq))
+    
+    def load_read_cursors(self):
+        with self._lock:
+            return self.conn.execute("SELECT username, peer, seq FROM read_cursors").fetchall()
+    
+    def store_group_record(self, record):
+        self.queue_write(self.write_group_record, record)
+    
+    def write_group_record(self, record):
+        # Состав - в таблицах, запись изменения - для refresh других процессов
+        key = record['group']
+        if record['op'] == 'create':
+            self.write_conn.execute(self.INSERT_GROUP, (key, record['title'], record['owner']))
+        if record['op'] == 'leave':
+            self.write_conn.executemany(self.DELETE_GROUP_MEMBER,
+                                        ((key, member) for member in record['members']))
+        else:
+            self.write_conn.executemany(self.INSERT_GROUP_MEMBER,
+                                        ((key, member) for member in record['members']))
+        self.write_conn.execute("INSERT INTO group_changes (record) VALUES (?)",
+                                (json.dumps(record, ensure_ascii=False),))
+    
+    def load_group_records(self):
+        # Текущий состав из таблиц вместо всей истории изменений
+        with self._lock:
+            self.last_rows['group_changes'] = self.conn.execute(
+                "SELECT MAX(id) FROM group_changes").fetchone()[0] or 0
+            members = {}
+            for key, username in self.conn.execute(
+                    "SELECT group_id, username FROM group_members ORDER BY id"):
+                members.setdefault(key, []).append(username)
+            return [{'op': 'create', 'group': key, 'title': title, 'owner': owner,
+                     'members': members.get(key, [])}
+                    for key, title, owner in self.conn.execute(
+                        "SELECT id, title, owner FROM groups").fetchall()]
+    
+    def import_batch(self, batch):
+        # Одна транзакция на пачку вместо транзакции на каждую строку
+        with self._lock, self.conn:
+            next_seqs = {}
+            imported = []
+            for conv_key, msg in batch:
+                seq = next_seqs.get(conv_key)
+                if seq is None:
+                    seq = self.last_seq(conv_key) + 1
+                next_seqs[conv_key] = seq + 1
+                imported.append((conv_key, Message.from_dict(msg, seq)))
+            self.conn.executemany(self.INSERT_MESSAGE, (
+                (conv_key, message.sender, message.content, message['timestamp'], message.seq,
+                 self.attachment_column(message.attachment))
+                for conv_key, message in imported))
+            # Транзакция держит запись в базу: строки пачки - последние len(imported)
+            last_id = self.conn.execute("SELECT MAX(id) FROM messages").fetchone()[0]
+            self._own_messages.update(range(last_id - len(imported) + 1, last_id + 1))
+        self.retain_imported(imported)
+        return imported
+    
+    def finish_import(self):
+        # Свои строки не должны вернуться из refresh как сообщения других процессов
+        with self._lock:
+            self.last_rows['messages'] = self.conn.execute(
+                "SELECT MAX(id) FROM messages").fetchone()[0] or 0
+            self._own_messages = {row_id for row_id in self._own_messages
+                                  if row_id > self.last_rows['messages']}
+        super().finish_import()
+    
+    def export_messages(self):
+        # Отдельное соединение: курсор читает снимок WAL, не держа блокировку базы
+        self.flush()
+        conn = sqlite3.connect(self.db_file)
+        try:
+            for row in conn.execute(
+                    "SELECT conversation, sender, content, timestamp, seq, attachment "
+                    "FROM messages ORDER BY conversation, seq"):
+                yield row[0], Message.from_dict(self.message_row(*row[1:]), row[4])
+        finally:
+            conn.close()
+    
+    def close(self):
+        super().close()
+        self.write_conn.close()
+        self.conn.close()
+
+class ConversationCache:
+    # Примерный расход памяти на одно сообщение сверх длины текста
+    MESSAGE_OVERHEAD = 100
+    
+    def __init__(self, loader, budget, lock=None):
+        self.loader = loader
+        self.budget = budget
+        # Промах, чтение и вставка - под той же блокировкой, что и append:
+        # иначе сообщение, дописанное во время чтения, пропадёт из кэша
+        self.lock = lock if lock is not None else threading.RLock()
+        self.size = 0
+        self.conversations = OrderedDict()
+        self.sizes = {}
+    
+    def get(self, conv_key):
+        with self.lock:
+            if conv_key in self.conversations:
+                self.conversations.move_to_end(conv_key)
+                return self.conversations[conv_key]
+            messages = self.loader(conv_key)
+            if messages is None:
+                return None
+            self.conversations[conv_key] = messages
+            self.sizes[conv_key] = sum(self.MESSAGE_OVERHEAD + len(content)
+                                       for content in messages.contents)
+            self.size += self.sizes[conv_key]
+            self.evict()
+            return messages
+    
+    def append(self, conv_key, message):
+        # Незагруженную переписку не читаем: сообщение уже лежит в шарде
+        with self.lock:
+            if conv_key in self.conversations:
+                self.conversations[conv_key].append(message)
+                size = self.message_size(message)
+                self.sizes[conv_key] += size
+                self.size += size
+                self.conversations.move_to_end(conv_key)
+                self.evict()
+    
+    def drop(self, conv_key):
+        with self.lock:
+            if conv_key in self.conversations:
+                del self.conversations[conv_key]
+                self.size -= self.sizes.pop(conv_key)
+    
+    def evict(self):
+        # Последнюю открытую переписку не выгружаем, даже если она больше бюджета
+        while self.size > self.budget and len(self.conversations) > 1:
+            conv_key, _ = self.conversations.popitem(last=False)
+            self.size -= self.sizes.pop(conv_key)
+    
+    def message_size(self, message):
+        return self.MESSAGE_OVERHEAD + len(message.content)
+
+class ShardedDatabase(Database):
+    OPEN_SHARDS = 64
+    
+    def __init__(self, shards_dir="history", cache_budget=16 * 1024 * 1024, durability='batch',
+                 background=False):
+        self.shards_dir = shards_dir
+        self.manifest_file = os.path.join(shards_dir, "manifest.json")
+        self.manifest_signature = None
+        self._manifest_save_pending = False
+        # Журнал изменений для других процессов: по шардам не видно, что дописано
+        self.updates_file = os.path.join(shards_dir, "updates.journal")
+        self.updates_position = (None, 0)
+        self.unflushed_updates = []
+        self._update_records = 0
+        self._updates_rotation_pending = False
+        self.cache_budget = cache_budget
+        self.seq_counts = {}
+        # Строки шардов, которые поток записи ещё не дописал, и длина файла
+        # до начала текущей дозаписи: чтение не ждёт очередь записи
+        self.unflushed = {}
+        self.shard_bounds = {}
+        self._shard_write_pending = False
+        super().__init__(durability, background)
+    
+    def load_messages(self):
+        if not os.path.exists(self.manifest_file):
+            self.split_into_shards()
+        else:
+            self.manifest_signature = file_signature(self.manifest_file)
+            with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                self.manifest = json.load(f)
+        self.load_updates()
+        return ConversationCache(self.read_shard, self.cache_budget, self._lock)
+    
+    def load_updates(self):
+        # Переписки из журнала, которые другой процесс ещё не внёс в манифест
+        self.updates_position = (None, 0)
+        self._update_records = 0
+        if not os.path.exists(self.updates_file):
+            return
+        inode = os.stat(self.updates_file).st_ino
+        offset = 0
+        for record, offset in self.read_journal(self.updates_file):
+            self._update_records += 1
+            self.manifest.setdefault(record['conv'], self.shard_name(record['conv']))
+        self.updates_position = (inode, offset)
+    
+    def split_into_shards(self):
+        # Однократное разбиение messages.json и журнала на шарды
+        os.makedirs(self.shards_dir, exist_ok=True)
+        self.manifest = {}
+        for conv_key, msgs in super().load_messages().items():
+            with open(self.shard_path(conv_key), 'w', encoding='utf-8') as f:
+                for msg in msgs:
+                    f.write(json.dumps(msg.to_dict(), ensure_ascii=False) + '\n')
+            self.manifest[conv_key] = self.shard_name(conv_key)
+        self._journal_records = 0
+        self.save_manifest()
+    
+    def save_manifest(self):
+        # Повторные сохранения до записи схлопываются в одно
+        with self._lock:
+            if self._manifest_save_pending:
+                return
+            self._manifest_save_pending = True
+        self.writer.call(self.write_manifest)
+    
+    def write_manifest(self):
+        # Поток записи, под блокировкой каталога: сначала переписки других процессов
+        if not self._manifest_save_pending:
+            return
+        self._manifest_save_pending = False
+        self.merge_manifest()
+        with self._lock:
+            data = dict(self.manifest)
+        self.writer.write_replace(self.manifest_file, data, None)
+        self.manifest_signature = file_signature(self.manifest_file)
+    
+    def merge_manifest(self):
+        # Переписки только добавляются, поэтому слияние - объединение
+        signature = file_signature(self.manifest_file)
+        if signature is None or signature == self.manifest_signature:
+            return
+        try:
+            with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except ValueError:
+            return
+        self.manifest_signature = signature
+        with self._lock:
+            for conv_key, name in data.items():
+                self.manifest.setdefault(conv_key, name)
+    
+    @staticmethod
+    def shard_name(conv_key):
+        # Ники могут содержать любые символы, поэтому имя файла - хэш ключа.
+        # Те же имена у файлов поперепискного экспорта в bulk.py
+        return hashlib.sha1(conv_key.encode('utf-8')).hexdigest() + '.jsonl'
+    
+    def shard_path(self, conv_key):
+        return os.path.join(self.shards_dir, self.shard_name(conv_key))
+    
+    def read_shard_lines(self, conv_key):
+        # Записанная часть шарда и строки из очереди; под self._lock поток записи
+        # не может дописать строки, которые уже учтены в unflushed
+        with self._lock:
+            pending = list(self.unflushed.get(conv_key, ()))
+            bound = self.shard_bounds.get(conv_key)
+            try:
+                with open(self.shard_path(conv_key), 'rb') as f:
+                    data = f.read() if bound is None else f.read(bound)
+            except FileNotFoundError:
+                data = b''
+        return data, pending
+    
+    def read_shard(self, conv_key):
+        if conv_key not in self.manifest:
+            return None
+        data, pending = self.read_shard_lines(conv_key)
+        messages = Conversation()
+        for line in data.decode('utf-8').splitlines() + pending:
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                continue
+            messages.append(Message.from_dict(msg, len(messages) + 1))
+        return messages
+    
+    def count_shard(self, conv_key):
+        if conv_key not in self.manifest:
+            return 0
+        data, pending = self.read_shard_lines(conv_key)
+        return data.count(b'\n') + len(pending)
+    
+    def queue_shard_lines(self, conv_key, lines):
+        # Вызывается под self._lock; запись всех ждущих шардов - одной задачей
+        self.unflushed.setdefault(conv_key, []).extend(lines)
+        if not self._shard_write_pending:
+            self._shard_write_pending = True
+            self.writer.call(self.write_shards)
+    
+    def write_shards(self):
+        # Поток записи, под блокировкой каталога: другие процессы сейчас шарды не дописывают
+        with self._lock:
+            self._shard_write_pending = False
+            batch = {conv_key: list(lines) for conv_key, lines in self.unflushed.items()}
+            updates, self.unflushed_updates = self.unflushed_updates, []
+            for conv_key in batch:
+                path = self.shard_path(conv_key)
+                self.shard_bounds[conv_key] = os.path.getsize(path) if os.path.exists(path) else 0
+        for conv_key, lines in batch.items():
+            path = self.shard_path(conv_key)
+            self.writer.write_append(path, ''.join(lines))
+            if len(batch) > self.OPEN_SHARDS:
+                # Пачка импорта: шардов много, файлы не остаются открытыми
+                self.writer.close_file(path)
+        # Запись журнала изменений видна другим процессам только после строки шарда,
+        # новая переписка попадает в манифест в той же задаче
+        if updates:
+            self.writer.write_append(self.updates_file, ''.join(updates))
+        self.write_manifest()
+        with self._lock:
+            for conv_key, lines in batch.items():
+                del self.unflushed[conv_key][:len(lines)]
+                if not self.unflushed[conv_key]:
+                    del self.unflushed[conv_key]
+                del self.shard_bounds[conv_key]
+    
+    def last_seq(self, conv_key):
+        # Номер следующего сообщения не требует загрузки всего шарда
+        if conv_key not in self.seq_counts:
+            self.seq_counts[conv_key] = self.count_shard(conv_key)
+        return self.seq_counts[conv_key]
+    
+    def store_message(self, conv_key, message):
+        line = json.dumps(message.to_dict(), ensure_ascii=False)
+        with self._lock:
+            self.queue_shard_lines(conv_key, [line + '\n'])
+            self.unflushed_updates.append(json.dumps(
+                {'conv': conv_key, 'message': message.to_dict(), 'origin': self.origin},
+                ensure_ascii=False) + '\n')
+            self._update_records += 1
+            if self._update_records >= self.compact_threshold:
+                self.request_rotation()
+            if conv_key not in self.manifest:
+                self.manifest[conv_key] = self.shard_name(conv_key)
+                self.save_manifest()
+            self.seq_counts[conv_key] = message.seq
+            self.messages.append(conv_key, message)
+    
+    def load_conversation(self, conv_key):
+        messages = self.messages.get(conv_key)
+        if messages is None:
+            return []
+        return messages
+    
+    def import_batch(self, batch):
+        # Строки одной переписки дописываются в её шард одной записью
+        groups = OrderedDict()
+        imported = []
+        with self._lock:
+            for conv_key, msg in batch:
+                message = Message.from_dict(msg, self.last_seq(conv_key) + 1)
+                imported.append((conv_key, message))
+                self.seq_counts[conv_key] = message.seq
+                groups.setdefault(conv_key, []).append(
+                    json.dumps(message.to_dict(), ensure_ascii=False) + '\n')
+                self.messages.append(conv_key, message)
+                if conv_key not in self.manifest:
+                    self.manifest[conv_key] = self.shard_name(conv_key)
+            for conv_key, lines in groups.items():
+                self.queue_shard_lines(conv_key, lines)
+            self.save_manifest()
+            self.retain_imported(imported)
+        self.writer.flush()
+        return imported
+    
+    def conversation_keys(self):
+        return self.manifest.keys()
+    
+    def read_conversation(self, conv_key):
+        return self.read_shard(conv_key) or Conversation()
+    
+    def finish_import(self):
+        # Импорт не пишет журнал изменений: другие процессы перечитают шарды целиком
+        with self._lock:
+            self.request_rotation()
+        super().finish_import()
+    
+    def refresh_messages(self):
+        if self._reload_pending:
+            return
+        inode, offset = self.updates_position
+        try:
+            st = os.stat(self.updates_file)
+        except OSError:
+            st = None
+        if inode is not None and (st is None or st.st_ino != inode):
+            # Журнал изменений заменён: что в нём было, уже лежит в шардах
+            self.schedule_reload()
+            return
+        if st is not None and st.st_size > offset:
+            self.apply_updates_tail()
+    
+    def apply_updates_tail(self):
+        applied = []
+        with self._lock:
+            inode, offset = self.updates_position
+            if not os.path.exists(self.updates_file):
+                return applied
+            inode = os.stat(self.updates_file).st_ino
+            for record, offset in self.read_journal(self.updates_file, offset):
+                if record.get('origin') == self.origin:
+                    continue
+                self._update_records += 1
+                conv_key = record['conv']
+                self.manifest.setdefault(conv_key, self.shard_name(conv_key))
+                # Строка уже в шарде: переписка и её счётчик перечитаются при обращении
+                self.messages.drop(conv_key)
+                self.seq_counts.pop(conv_key, None)
+                message = Message.from_dict(record['message'], record['message']['seq'])
+                details = self.summarize_message(conv_key, message)
+                if details is not None:
+                    applied.append((conv_key, message, details))
+            self.updates_position = (inode, offset)
+        for conv_key, message, details in applied:
+            if self.search_ready.is_set():
+                self.message_index.add_conversation(conv_key,
+                                                    self.conversation_participants(conv_key))
+                self.message_index.add(conv_key, message)
+            self.notify('message', **details)
+        return applied
+    
+    def reload_messages(self, written, snapshot=False):
+        # Поток записи, под блокировкой каталога: свои строки до задачи уже в шардах
+        self.merge_manifest()
+        with self._lock:
+            self.messages = ConversationCache(self.read_shard, self.cache_budget, self._lock)
+            self.seq_counts = {}
+            self.load_updates()
+            self.build_summaries()
+            self.summary_versions = {username: self.summary_versions.get(username, 0) + 1
+                                     for username in self.summaries}
+            self._reload_pending = False
+        self.notify('reload')
+    
+    def request_rotation(self):
+        # Вызывается под self._lock
+        if not self._updates_rotation_pending:
+            self._updates_rotation_pending = True
+            self.writer.call(self.rotate_updates)
+    
+    def rotate_updates(self):
+        # Поток записи, под блокировкой каталога: журнал начинается заново,
+        # другие процессы заметят замену и перечитают шарды
+        inode = self.updates_position[0]
+        signature = file_signature(self.updates_file)
+        if inode is not None and (signature is None or signature[0] != inode):
+            self.reload_messages(self._own_count)
+        else:
+            self.apply_updates_tail()
+        with self._lock:
+            self._updates_rotation_pending = False
+            self.writer.close_file(self.updates_file)
+            tmp_file = self.updates_file + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.updates_file)
+            self.updates_position = (os.stat(self.updates_file).st_ino, 0)
+            self._update_records = 0
+    
+    def last_message(self, conv_key):
+        if conv_key not in self.manifest:
+            return None
+        with self._lock:
+            pending = self.unflushed.get(conv_key)
+            last_line = pending[-1] if pending else None
+        if last_line is not None:
+            return Message.from_dict(json.loads(last_line), self.last_seq(conv_key))
+        if not os.path.exists(self.shard_path(conv_key)):
+            return None
+        # Последняя строка шарда читается с конца файла
+        with open(self.shard_path(conv_key), 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(size - 4096, 0))
+            tail = f.read()
+        lines = tail.rstrip(b'\n').rsplit(b'\n', 1)
+        if size > 4096 and len(lines) < 2:
+            conversation = self.read_shard(conv_key)
+            return conversation[-1] if conversation else None
+        try:
+            msg = json.loads(lines[-1])
+        except ValueError:
+            return None
+        return Message.from_dict(msg, self.last_seq(conv_key))
+
+def migrate_json_to_sqlite(db_file="shiligram.db", batch_size=10000):
+    # Снимок и журнал читаются обычным JSON-хранилищем
+    source = Database()
+    target = SQLiteDatabase(db_file)
+    target.import_users(source.users.values())
+    target.import_messages(source.export_messages(), batch_size)
+    source.close()
+    return target
+
+def convert_json_to_archive():
+    # Снимок и журнал сворачиваются в messages.bin, messages.json остаётся копией.
+    # История перечитывается под блокировкой каталога: строки, дописанные другим
+    # процессом после загрузки, попадут в архив, а журнал удаляется до её снятия
+    db = Database()
+    db.close()
+    try:
+        with db.file_lock:
+            MessageArchive.write(db.archive_file, db.load_messages())
+            for path in (db.journal_file, db.journal_file + '.old'):
+                if os.path.exists(path):
+                    os.remove(path)
+    finally:
+        if db.archive is not None:
+            db.archive.close()
+        db.cold_store.close()
+        db.file_lock.close()
+
+BACKENDS = {
+    'json': Database,
+    # То же хранилище, история - в отображаемом в память messages.bin
+    'archive': Database,
+    'sqlite': SQLiteDatabase,
+    'sharded': ShardedDatabase,
+}
+
+def open_database(backend='json', durability='batch', background=False):
+    if backend == 'sqlite' and not os.path.exists("shiligram.db") \
+            and os.path.exists("users.json"):
+        migrate_json_to_sqlite().close()
+    if backend == 'archive' and not os.path.exists("messages.bin"):
+        convert_json_to_archive()
+    return BACKENDS[backend](durability=durability, background=background)
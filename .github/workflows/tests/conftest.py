@@ -0,0 +1,51 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import open_database
+
+BACKENDS = ['json', 'sqlite', 'sharded']
+USERS = ('alice', 'bobby', 'carol', 'dave')
+
+
+@pytest.fixture(autouse=True)
+def data_dir(tmp_path, monkeypatch):
+    # Файлы базы создаются в текущем каталоге
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request):
+    return request.param
+
+
+@pytest.fixture
+def open_db(backend):
+    opened = []
+
+    def opener():
+        db = open_database(backend)
+        opened.append(db)
+        return db
+
+    yield opener
+    for db in opened:
+        if db.writer.thread.is_alive():
+            db.close()
+
+
+def register_all(db, usernames=USERS):
+    for username in usernames:
+        assert db.register_user(username, 'secret123')[0]
+
+
+def contents(messages):
+    return [msg['content'] for msg in messages]
+
+
+def seqs(messages):
+    return [msg['seq'] for msg in messages]
@@ -0,0 +1,54 @@
+import os
+
+from conftest import contents, register_all, seqs
+from storage import Database, convert_json_to_archive, open_database
+
+
+def fill(count):
+    db = Database()
+    register_all(db)
+    for i in range(count):
+        db.send_message('alice', 'bobby', f'm{i}')
+        db.send_message('carol', 'dave', f'c{i}')
+    db.close()
+
+
+def test_archive_serves_history_and_survives_compaction():
+    fill(20)
+    convert_json_to_archive()
+    assert os.path.exists('messages.bin')
+
+    db = Database()
+    assert db.archive is not None
+    assert db.messages['alice_bobby'].archived_count() == 20
+    assert contents(db.get_messages('alice', 'bobby', before=6, limit=3)) == ['m2', 'm3', 'm4']
+
+    db.send_message('alice', 'bobby', 'после архива')
+    old_archive = db.archive
+    db.compact_messages(background=False)
+    assert db.archive is not old_archive
+    assert db.messages['alice_bobby'].archived_count() == 21
+    messages = db.get_messages('alice', 'bobby')
+    assert contents(messages) == [f'm{i}' for i in range(20)] + ['после архива']
+    assert seqs(messages) == list(range(1, 22))
+    db.close()
+
+    db = Database()
+    assert contents(db.get_messages('carol', 'dave')) == [f'c{i}' for i in range(20)]
+    assert contents(db.get_messages('alice', 'bobby'))[-1] == 'после архива'
+    db.close()
+
+
+def test_open_database_converts_json_history_once():
+    fill(5)
+    assert os.path.exists('messages.journal')
+    db = open_database('archive')
+    assert db.archive is not None
+    assert not os.path.exists('messages.journal')
+    assert contents(db.get_messages('alice', 'bobby')) == [f'm{i}' for i in range(5)]
+    db.send_message('alice', 'bobby', 'дальше')
+    db.close()
+
+    db = open_database('archive')
+    assert contents(db.get_messages('alice', 'bobby')) == [f'm{i}' for i in range(5)] + ['дальше']
+    db.close()
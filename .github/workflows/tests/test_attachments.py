@@ -0,0 +1,51 @@
+import io
+import os
+
+from conftest import register_all
+from storage import Database
+
+PHOTO = bytes(range(256)) * 1000
+
+
+def test_identical_files_are_stored_once_and_read_back():
+    db = Database()
+    store = db.attachments
+    ref = store.put(io.BytesIO(PHOTO), 'photo.png')
+    copy = store.put(io.BytesIO(PHOTO), 'copy.png')
+    assert ref['hash'] == copy['hash']
+    assert (ref['name'], copy['name'], ref['size']) == ('photo.png', 'copy.png', len(PHOTO))
+    assert len(os.listdir(os.path.dirname(store.blob_path(ref['hash'])))) == 1
+    assert store.read(ref['hash']) == PHOTO
+    assert b''.join(store.iter_chunks(ref['hash'], 4096)) == PHOTO
+    assert store.is_image(ref) and not store.is_image({'name': 'notes.txt'})
+    db.close()
+
+
+def test_garbage_collection_keeps_referenced_files():
+    db = Database()
+    register_all(db)
+    store = db.attachments
+    ref = store.put(io.BytesIO(PHOTO), 'photo.png')
+    orphan = store.put(io.BytesIO(b'never sent'), 'draft.txt')
+    db.send_message('alice', 'bobby', 'фото', attachment=ref)
+    db.send_message('carol', 'dave', 'то же фото', attachment=dict(ref))
+    db.flush()
+    assert store.load_counts() == ({ref['hash']: 2}, 2)
+
+    # Свежий файл без ссылок защищён сроком GC_GRACE
+    db.writer.call(store.collect_garbage)
+    db.flush()
+    assert store.exists(orphan['hash'])
+
+    store.GC_GRACE = -1
+    db.writer.call(store.collect_garbage)
+    db.flush()
+    assert not store.exists(orphan['hash'])
+    assert store.exists(ref['hash'])
+    assert store.load_counts() == ({ref['hash']: 2}, 1)
+    db.close()
+
+    db = Database()
+    assert db.get_messages('alice', 'bobby')[0]['attachment'] == ref
+    assert db.attachments.read(ref['hash']) == PHOTO
+    db.close()
@@ -0,0 +1,83 @@
+import json
+
+from bulk import export_data, import_data
+from conftest import contents, register_all, seqs
+from storage import ShardedDatabase
+
+
+def chat_summaries(db, username):
+    return dict(db.get_chat_list(username))
+
+
+def test_groups_and_read_cursors_round_trip(open_db, data_dir, monkeypatch):
+    db = open_db()
+    register_all(db)
+    db.add_contact('bobby', 'alice')
+    key = db.create_group('alice', 'Команда', ['bobby', 'carol'])[1]
+    db.send_message('bobby', key, 'первое')
+    db.send_message('bobby', key, 'второе')
+    db.send_message('alice', 'bobby', 'привет')
+    db.mark_read('carol', key)
+    db.mark_read('bobby', 'alice')
+    export_data(db, str(data_dir / 'export.jsonl'))
+    db.close()
+
+    (data_dir / 'copy').mkdir()
+    monkeypatch.chdir(data_dir / 'copy')
+    db = open_db()
+    import_data(db, str(data_dir / 'export.jsonl'))
+    for check in range(2):
+        assert db.group_members(key) == ['alice', 'bobby', 'carol']
+        assert chat_summaries(db, 'carol')[key].title == 'Команда'
+        assert chat_summaries(db, 'carol')[key].unread == 0
+        assert chat_summaries(db, 'alice')[key].unread == 2
+        assert chat_summaries(db, 'bobby')['alice'].unread == 0
+        assert key not in chat_summaries(db, 'dave')
+        assert contents(db.get_messages('carol', key)) == ['первое', 'второе']
+        db.close()
+        db = open_db()
+
+
+def test_users_and_history_round_trip_per_conversation(open_db, data_dir, monkeypatch):
+    db = open_db()
+    register_all(db)
+    db.add_contacts('alice', ['bobby', 'carol'])
+    for i in range(12):
+        db.send_message('alice', 'bobby', f'ab{i}')
+        db.send_message('carol', 'dave', f'cd{i}')
+    assert export_data(db, str(data_dir / 'export'), per_conversation=True) == 24
+    db.close()
+    assert sorted(path.name for path in (data_dir / 'export').iterdir()) == sorted(
+        ['users.jsonl', ShardedDatabase.shard_name('alice_bobby'),
+         ShardedDatabase.shard_name('carol_dave')])
+
+    (data_dir / 'copy').mkdir()
+    monkeypatch.chdir(data_dir / 'copy')
+    db = open_db()
+    db.register_user('alice', 'other-password')
+    assert import_data(db, str(data_dir / 'export'), batch_size=5) == 24
+    assert db.users['alice'].password == 'other-password'
+    assert set(db.users) == {'alice', 'bobby', 'carol', 'dave'}
+    assert sorted(db.users['alice'].contacts) == ['bobby', 'carol']
+    assert contents(db.get_messages('dave', 'carol')) == [f'cd{i}' for i in range(12)]
+    assert seqs(db.get_messages('bobby', 'alice')) == list(range(1, 13))
+    db.close()
+
+
+def test_imported_contacts_are_validated(open_db, data_dir):
+    db = open_db()
+    register_all(db, ('alice',))
+    key = db.create_group('alice', 'Команда', [])[1]
+    with open(data_dir / 'users.jsonl', 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'type': 'user', 'username': 'bobby', 'password': 'secret123',
+                            'contacts': ['bobby', 'ghost', key, 'carol', 'alice']}) + '\n')
+        f.write(json.dumps({'type': 'user', 'username': 'carol', 'password': 'secret123',
+                            'contacts': ['bobby']}) + '\n')
+    import_data(db, str(data_dir / 'users.jsonl'), batch_size=1)
+    for check in range(2):
+        assert list(db.users['bobby'].contacts) == ['carol', 'alice']
+        assert list(db.users['carol'].contacts) == ['bobby']
+        assert set(db.contact_graph.contacted_by('bobby')) == {'carol'}
+        assert db.search_users('bob', 'alice') == ['bobby']
+        db.close()
+        db = open_db()
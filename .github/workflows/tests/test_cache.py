@@ -0,0 +1,43 @@
+import threading
+
+from storage import Conversation, ConversationCache, Message
+
+
+def message(sender, content, seq):
+    return Message.create(sender, content, seq, 0)
+
+
+def test_append_during_load_reaches_cached_conversation():
+    lock = threading.RLock()
+    appended = []
+
+    def loader(conv_key):
+        conversation = Conversation()
+        conversation.append(message('alice', 'первое', 1))
+        # Сообщение дописывают, пока переписка читается с диска
+        writer = threading.Thread(
+            target=lambda: cache.append(conv_key, message('bobby', 'второе', 2)))
+        writer.start()
+        writer.join(0.2)
+        appended.append(writer)
+        return conversation
+
+    cache = ConversationCache(loader, 1024 * 1024, lock)
+    conversation = cache.get('alice_bobby')
+    appended[0].join()
+    assert [message.content for message in conversation] == ['первое', 'второе']
+    assert cache.size == 2 * ConversationCache.MESSAGE_OVERHEAD + len('первое') + len('второе')
+
+
+def test_cache_evicts_least_recent_conversation():
+    def loader(conv_key):
+        conversation = Conversation()
+        conversation.append(message('alice', conv_key * 10, 1))
+        return conversation
+
+    cache = ConversationCache(loader, 3 * (ConversationCache.MESSAGE_OVERHEAD + 10))
+    for conv_key in 'abc':
+        cache.get(conv_key)
+    cache.get('a')
+    cache.get('d')
+    assert list(cache.conversations) == ['c', 'a', 'd']
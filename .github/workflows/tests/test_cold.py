@@ -0,0 +1,64 @@
+import json
+import os
+
+from conftest import contents, register_all, seqs
+from storage import Database
+
+
+def test_cold_segments_round_trip():
+    db = Database()
+    register_all(db)
+    db.cold_after = -1
+    db.cold_segment_size = 10
+    for i in range(35):
+        db.send_message('alice', 'bobby', f'm{i}')
+    db.compact_messages(background=False)
+    assert os.path.getsize(db.cold_file) > 0
+    assert db.messages['alice_bobby'].archived_count() == 30
+    assert contents(db.get_messages('alice', 'bobby')) == [f'm{i}' for i in range(35)]
+    db.close()
+
+    with open(db.messages_file, 'r', encoding='utf-8') as f:
+        snapshot = json.load(f)
+    assert len(snapshot['alice_bobby']['cold']) == 3
+    assert len(snapshot['alice_bobby']['messages']) == 5
+
+    db = Database()
+    messages = db.get_messages('alice', 'bobby')
+    assert contents(messages) == [f'm{i}' for i in range(35)]
+    assert seqs(messages) == list(range(1, 36))
+    assert contents(db.get_messages('alice', 'bobby', before=12, limit=4)) == \
+        ['m7', 'm8', 'm9', 'm10']
+    db.close()
+
+
+def test_unreferenced_cold_space_is_reused():
+    db = Database()
+    register_all(db)
+    db.cold_after = -1
+    db.cold_segment_size = 10
+    for i in range(35):
+        db.send_message('alice', 'bobby', f'm{i}')
+    db.compact_messages(background=False)
+    # Сегменты сжатия, снимок которого так и не записался
+    conversation = db.messages['alice_bobby']
+    live = conversation.archived.segments
+    db.cold_store.write_segments([conversation[i:i + 10] for i in range(0, 30, 10)], live)
+    assert os.path.getsize(db.cold_file) > sum(segment[1] for segment in live)
+
+    for i in range(35, 45):
+        db.send_message('alice', 'bobby', f'm{i}')
+    db.compact_messages(background=False)
+    db.close()
+
+    with open(db.messages_file, 'r', encoding='utf-8') as f:
+        snapshot = json.load(f)
+    segments = snapshot['alice_bobby']['cold']
+    assert len(segments) == 4
+    assert os.path.getsize(db.cold_file) == sum(segment[1] for segment in segments)
+
+    db = Database()
+    messages = db.get_messages('alice', 'bobby')
+    assert contents(messages) == [f'm{i}' for i in range(45)]
+    assert seqs(messages) == list(range(1, 46))
+    db.close()
@@ -0,0 +1,39 @@
+from conftest import register_all
+from storage import ContactGraph, User
+
+
+def test_graph_keeps_reverse_index_in_step():
+    alice, bobby = User('alice', 'secret123'), User('bobby', 'secret123')
+    alice.contacts.add('carol')
+    graph = ContactGraph([alice, bobby])
+    assert graph.add(alice, 'bobby')
+    assert not graph.add(alice, 'bobby')
+    assert graph.add(bobby, 'carol')
+    assert set(graph.contacted_by('carol')) == {'alice', 'bobby'}
+    assert graph.edges == 3
+    assert graph.remove(alice, 'carol')
+    assert not graph.remove(alice, 'carol')
+    assert list(graph.contacted_by('carol')) == ['bobby']
+    assert graph.remove(bobby, 'carol')
+    assert graph.contacted_by('carol') == ()
+    assert 'carol' not in graph.reverse
+    assert (list(alice.contacts), graph.edges) == (['bobby'], 1)
+    assert sorted(ContactGraph.mutual(['x', 'y', 'z'], {'z', 'y'})) == ['y', 'z']
+
+
+def test_contacts_reverse_lookup_and_mutual_survive_restart(open_db):
+    db = open_db()
+    register_all(db)
+    assert db.add_contacts('alice', ['bobby', 'carol', 'alice', 'ghost'])[0]
+    assert db.add_contacts('dave', ['carol', 'bobby'])[0]
+    assert not db.add_contact('alice', 'alice')[0]
+    assert db.remove_contact('alice', 'bobby')[0]
+    assert not db.remove_contact('alice', 'bobby')[0]
+    for check in range(2):
+        assert list(db.users['alice'].contacts) == ['carol']
+        assert sorted(db.contacted_by('carol')) == ['alice', 'dave']
+        assert db.contacted_by('bobby') == ['dave']
+        assert db.mutual_contacts('alice', 'dave') == ['carol']
+        assert db.mutual_contacts('alice', 'ghost') == []
+        db.close()
+        db = open_db()
@@ -0,0 +1,43 @@
+from conftest import contents, register_all
+
+
+def chat_summaries(db, username):
+    return dict(db.get_chat_list(username))
+
+
+def test_group_membership_and_read_cursors(open_db):
+    db = open_db()
+    register_all(db)
+    success, key = db.create_group('alice', 'Команда', ['bobby', 'carol'])
+    assert success
+    assert db.group_members(key) == ['alice', 'bobby', 'carol']
+
+    db.send_message('bobby', key, 'первое')
+    db.send_message('bobby', key, 'второе')
+    assert chat_summaries(db, 'carol')[key].unread == 2
+    assert chat_summaries(db, 'carol')[key].title == 'Команда'
+    assert key not in chat_summaries(db, 'dave')
+
+    db.mark_read('carol', key)
+    assert chat_summaries(db, 'carol')[key].unread == 0
+    assert chat_summaries(db, 'alice')[key].unread == 2
+
+    assert db.leave_group(key, 'carol')[0]
+    assert not db.leave_group(key, 'carol')[0]
+    assert key not in chat_summaries(db, 'carol')
+    assert not db.add_group_members(key, 'carol', ['dave'])[0]
+    assert db.add_group_members(key, 'alice', ['dave'])[0]
+    assert chat_summaries(db, 'dave')[key].unread == 2
+    assert contents(db.get_messages('dave', key)) == ['первое', 'второе']
+    db.close()
+
+    db = open_db()
+    assert db.group_members(key) == ['alice', 'bobby', 'dave']
+    assert chat_summaries(db, 'alice')[key].unread == 2
+    db.mark_read('alice', key)
+    assert key not in chat_summaries(db, 'carol')
+    db.close()
+
+    db = open_db()
+    assert chat_summaries(db, 'alice')[key].unread == 0
+    assert chat_summaries(db, 'dave')[key].unread == 2
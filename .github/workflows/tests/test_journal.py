@@ -0,0 +1,96 @@
+import json
+import os
+import threading
+
+from conftest import contents, register_all, seqs
+from storage import Database
+
+
+def journal_lines(db):
+    with open(db.journal_file, 'rb') as f:
+        return f.read().splitlines()
+
+
+def test_journal_replayed_after_restart():
+    db = Database()
+    register_all(db)
+    for i in range(5):
+        db.send_message('alice', 'bobby', f'm{i}')
+    db.close()
+    assert not os.path.exists(db.messages_file)
+    assert len(journal_lines(db)) == 5
+
+    db = Database()
+    assert contents(db.get_messages('alice', 'bobby')) == [f'm{i}' for i in range(5)]
+    assert seqs(db.get_messages('alice', 'bobby')) == [1, 2, 3, 4, 5]
+    db.close()
+
+
+def test_torn_journal_tail_is_ignored():
+    db = Database()
+    register_all(db)
+    for i in range(3):
+        db.send_message('alice', 'bobby', f'm{i}')
+    db.close()
+    with open(db.journal_file, 'a', encoding='utf-8') as f:
+        f.write('{"conv": "alice_bobby", "mess')
+
+    db = Database()
+    assert contents(db.get_messages('alice', 'bobby')) == ['m0', 'm1', 'm2']
+    db.send_message('alice', 'bobby', 'm3')
+    db.close()
+
+    db = Database()
+    assert contents(db.get_messages('alice', 'bobby')) == ['m0', 'm1', 'm2', 'm3']
+    db.close()
+
+
+def test_compaction_writes_snapshot_and_rotates_journal():
+    db = Database()
+    register_all(db)
+    db.compact_threshold = 10
+    for i in range(25):
+        db.send_message('alice', 'bobby', f'm{i}')
+    db.flush()
+    assert os.path.exists(db.messages_file)
+    assert len(journal_lines(db)) < 25
+    assert not os.path.exists(db.journal_file + '.old')
+    db.close()
+
+    with open(db.messages_file, 'r', encoding='utf-8') as f:
+        snapshot = json.load(f)
+    assert 10 <= len(snapshot['alice_bobby']) <= 25
+
+    db = Database()
+    messages = db.get_messages('alice', 'bobby')
+    assert contents(messages) == [f'm{i}' for i in range(25)]
+    assert seqs(messages) == list(range(1, 26))
+    db.close()
+
+
+def test_compaction_snapshot_ends_at_request_time():
+    db = Database()
+    register_all(db)
+    for i in range(10):
+        db.send_message('alice', 'bobby', f'm{i}')
+    # Поток записи занят: столбцы копируются, когда переписка уже дописана дальше
+    release = threading.Event()
+    db.writer.call(release.wait)
+    db.compact_messages()
+    for i in range(10, 15):
+        db.send_message('alice', 'bobby', f'm{i}')
+    release.set()
+    db.flush()
+
+    with open(db.messages_file, 'r', encoding='utf-8') as f:
+        snapshot = json.load(f)
+    assert [message['content'] for message in snapshot['alice_bobby']] == \
+        [f'm{i}' for i in range(10)]
+    assert len(journal_lines(db)) == 5
+    db.close()
+
+    db = Database()
+    messages = db.get_messages('alice', 'bobby')
+    assert contents(messages) == [f'm{i}' for i in range(15)]
+    assert seqs(messages) == list(range(1, 16))
+    db.close()
@@ -0,0 +1,21 @@
+from conftest import contents, register_all, seqs
+
+
+def test_pagination_and_messages_since(open_db):
+    db = open_db()
+    register_all(db)
+    for i in range(30):
+        db.send_message('alice', 'bobby', f'm{i}')
+
+    def check(db):
+        assert seqs(db.get_messages('alice', 'bobby', limit=10)) == list(range(21, 31))
+        assert seqs(db.get_messages('bobby', 'alice', before=21, limit=10)) == list(range(11, 21))
+        assert seqs(db.get_messages('alice', 'bobby', before=3, limit=10)) == [1, 2]
+        assert list(db.get_messages('alice', 'bobby', before=1, limit=10)) == []
+        assert contents(db.get_messages_since('alice', 'bobby', 27)) == ['m27', 'm28', 'm29']
+        assert list(db.get_messages_since('alice', 'bobby', 30)) == []
+        assert len(db.get_messages('alice', 'bobby')) == 30
+
+    check(db)
+    db.close()
+    check(open_db())
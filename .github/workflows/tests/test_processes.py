@@ -0,0 +1,33 @@
+from conftest import contents, register_all
+
+
+def test_two_instances_share_directory(open_db):
+    first = open_db()
+    register_all(first)
+    first.flush()
+    second = open_db()
+    assert set(second.users) >= {'alice', 'bobby', 'carol', 'dave'}
+
+    events = []
+    second.subscribe(lambda kind, details: events.append((kind, details)))
+    assert first.send_message('alice', 'bobby', 'from first')[0]
+    assert second.send_message('carol', 'dave', 'from second')[0]
+    first.flush()
+    second.flush()
+    first.refresh()
+    second.refresh()
+
+    assert ('message', {'sender': 'alice', 'receiver': 'bobby', 'seq': 1}) in events
+    assert contents(second.get_messages('alice', 'bobby')) == ['from first']
+    assert contents(first.get_messages('carol', 'dave')) == ['from second']
+
+    assert first.send_message('bobby', 'alice', 'reply')[0]
+    first.flush()
+    second.refresh()
+    assert contents(second.get_messages('alice', 'bobby')) == ['from first', 'reply']
+    first.close()
+    second.close()
+
+    db = open_db()
+    assert contents(db.get_messages('alice', 'bobby')) == ['from first', 'reply']
+    assert contents(db.get_messages('carol', 'dave')) == ['from second']
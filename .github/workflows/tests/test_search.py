@@ -0,0 +1,43 @@
+from conftest import register_all
+
+
+def found(db, username, query):
+    return [(peer, msg['content']) for peer, msg in db.search_messages(username, query)]
+
+
+def test_search_sees_messages_before_they_are_written(open_db):
+    db = open_db()
+    register_all(db)
+    key = db.create_group('alice', 'Команда', ['bobby'])[1]
+    db.send_message('alice', 'bobby', 'встреча в пятницу')
+    db.send_message('carol', 'dave', 'встреча отменяется')
+    db.send_message('bobby', key, 'пятница подходит')
+    assert sorted(found(db, 'alice', 'пятница')) == [(key, 'пятница подходит')]
+    assert found(db, 'bobby', 'встреча') == [('alice', 'встреча в пятницу')]
+    assert found(db, 'alice', 'отменяется') == []
+    db.flush()
+    assert found(db, 'bobby', 'встреча') == [('alice', 'встреча в пятницу')]
+    db.close()
+
+    db = open_db()
+    assert found(db, 'dave', 'встреча') == [('carol', 'встреча отменяется')]
+    assert found(db, 'bobby', 'пятница') == [(key, 'пятница подходит')]
+
+
+def test_parallel_index_build_matches_sequential(data_dir):
+    from storage import MessageIndex, open_database
+
+    db = open_database('json')
+    register_all(db)
+    for i in range(30):
+        db.send_message('alice', 'bobby', f'сообщение {i} слово{i % 3}')
+        db.send_message('carol', 'dave', f'другое {i}')
+    index = MessageIndex()
+    db.build_index_parallel(index, list(db.conversation_keys()))
+    for conv_key in db.conversation_keys():
+        assert index.indexed_count(conv_key) == 30
+    assert {token: {conv_key: seqs.tolist() for conv_key, seqs in convs.items()}
+            for token, convs in index.postings.items()} == \
+        {token: {conv_key: seqs.tolist() for conv_key, seqs in convs.items()}
+         for token, convs in db.message_index.postings.items()}
+    db.close()
@@ -0,0 +1,52 @@
+import threading
+
+from conftest import register_all
+from search import SearchPipeline
+from storage import Database
+
+
+def collect():
+    delivered = []
+    done = threading.Event()
+
+    def deliver(generation, users, messages):
+        delivered.append((generation, users, [msg['content'] for peer, msg in messages]))
+        done.set()
+
+    return delivered, done, deliver
+
+
+def test_pipeline_delivers_users_and_messages_in_background():
+    db = Database()
+    register_all(db, ('alice', 'bobby', 'bobcat', 'carol'))
+    db.send_message('bobby', 'alice', 'bob привет')
+    delivered, done, deliver = collect()
+    pipeline = SearchPipeline(db, deliver)
+    generation = pipeline.submit('alice', 'bob')
+    assert done.wait(5)
+    assert delivered == [(generation, ['bobby', 'bobcat'], ['bob привет'])]
+    assert pipeline.worker is not threading.current_thread()
+    db.close()
+
+
+def test_stale_queries_are_not_delivered_and_cache_follows_version():
+    db = Database()
+    register_all(db, ('alice', 'bobby', 'bobcat', 'carol'))
+    delivered, done, deliver = collect()
+    pipeline = SearchPipeline(db, deliver)
+
+    pipeline.generation = 2
+    pipeline.search(1, 'alice', 'bo')
+    assert delivered == []
+    assert pipeline.cache[('alice', 'bo')][1] == ['bobby', 'bobcat']
+
+    # Уточнение полного результата - фильтр по кэшу, без обращения к индексу
+    index, db.username_index = db.username_index, None
+    pipeline.search(2, 'alice', 'bobc')
+    assert delivered[-1][1] == ['bobcat']
+
+    db.username_index = index
+    db.register_user('bobcat2', 'secret123')
+    pipeline.search(2, 'alice', 'bobc')
+    assert delivered[-1][1] == ['bobcat', 'bobcat2']
+    db.close()
@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+from conftest import register_all
+
+
+def chat_list(db, username):
+    return {peer: (summary.snippet, summary.unread) if summary else None
+            for peer, summary in db.get_chat_list(username)}
+
+
+def fill(db):
+    register_all(db)
+    db.add_contacts('alice', ['bobby', 'carol'])
+    key = db.create_group('alice', 'Команда', ['bobby'])[1]
+    db.send_message('bobby', 'alice', 'привет')
+    db.send_message('carol', 'alice', 'x' * 200)
+    db.send_message('bobby', key, 'в группе')
+    return key
+
+
+def no_history(conv_key):
+    raise AssertionError(f"история {conv_key} прочитана при запуске")
+
+
+def test_summaries_load_without_reading_history(open_db):
+    db = open_db()
+    key = fill(db)
+    expected = chat_list(db, 'alice')
+    assert expected == {key: ('в группе', 1), 'carol': ('x' * 60 + '…', 1),
+                        'bobby': ('привет', 1)}
+    db.close()
+
+    db = open_db()
+    assert chat_list(db, 'alice') == expected
+    db.last_message = no_history
+    db.build_summaries()
+    assert chat_list(db, 'alice') == expected
+    db.send_message('alice', 'bobby', 'ответ')
+    db.close()
+
+    db = open_db()
+    db.last_message = no_history
+    db.build_summaries()
+    assert chat_list(db, 'alice')['bobby'] == ('ответ', 0)
+
+
+def test_missing_table_is_rebuilt_from_history(open_db, backend):
+    if backend == 'sqlite':
+        pytest.skip("таблица последних сообщений - сама база")
+    db = open_db()
+    fill(db)
+    expected = chat_list(db, 'alice')
+    db.close()
+    os.remove(db.summaries_file)
+
+    db = open_db()
+    assert chat_list(db, 'alice') == expected
+    db.flush()
+    assert os.path.exists(db.summaries_file)
+    db.last_message = no_history
+    db.build_summaries()
+    assert chat_list(db, 'alice') == expected
@@ -0,0 +1,18 @@
+from storage import UsernameIndex
+
+
+def test_exact_then_prefix_then_substring_ranking():
+    index = UsernameIndex(['Anna', 'annabel', 'anna_k', 'joanna', 'hanna', 'bob'])
+    assert index.search('anna') == ['Anna', 'anna_k', 'annabel', 'hanna', 'joanna']
+    assert index.search('ANN', limit=2) == ['Anna', 'anna_k']
+    assert index.search('anna', exclude='Anna') == ['anna_k', 'annabel', 'hanna', 'joanna']
+    assert index.search('zzz') == []
+
+
+def test_short_queries_and_added_names():
+    index = UsernameIndex(['bob', 'robert'])
+    index.add('Bobby')
+    index.add('lobo')
+    assert index.search('bo') == ['bob', 'Bobby', 'lobo']
+    assert index.search('ob') == ['bob', 'lobo', 'Bobby', 'robert']
+    assert index.search('bert') == ['robert']
@@ -0,0 +1,41 @@
+import threading
+
+from storage import FileLock, PersistenceWriter
+
+
+def test_writer_survives_failed_commits(data_dir):
+    writer = PersistenceWriter('batch')
+    writer.replace('broken.json', {'value': object()})
+    writer.append('journal.txt', 'первая\n')
+    writer.flush()
+    assert (data_dir / 'journal.txt').read_text(encoding='utf-8') == 'первая\n'
+
+    sync_dirty = writer.sync_dirty
+
+    def failing_sync():
+        writer.sync_dirty = sync_dirty
+        raise ValueError('сбой fsync')
+
+    writer.sync_dirty = failing_sync
+    writer.append('journal.txt', 'вторая\n')
+    writer.flush()
+    assert writer.thread.is_alive()
+    assert (data_dir / 'journal.txt').read_text(encoding='utf-8') == 'первая\nвторая\n'
+    writer.close()
+
+
+def test_flush_returns_when_directory_lock_fails(data_dir):
+    lock = FileLock(str(data_dir / 'missing' / 'shiligram.lock'))
+    writer = PersistenceWriter('batch', lock=lock)
+    writer.append('journal.txt', 'строка\n')
+    flushed = threading.Thread(target=writer.flush)
+    flushed.start()
+    flushed.join(5)
+    assert not flushed.is_alive()
+    assert writer.thread.is_alive()
+
+    (data_dir / 'missing').mkdir()
+    writer.append('journal.txt', 'ещё\n')
+    writer.flush()
+    assert (data_dir / 'journal.txt').read_text(encoding='utf-8') == 'ещё\n'
+    writer.close()